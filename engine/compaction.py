@@ -0,0 +1,444 @@
+import gzip
+import io
+import json
+import logging
+import math
+import os
+import re
+import time
+import uuid
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta, timezone
+
+from .matomo_event_receiver import schema as event_schema
+
+logger = logging.getLogger(__name__)
+
+COMPACTED_PREFIX = "compacted-"
+# athena, spark and hive ignore objects starting with _ or . => files in progress are invisible to queries
+HIDDEN_PREFIX = "_compacting-"
+MANIFEST_NAME = "_compaction.json"
+
+DEFAULT_TARGET_SIZE_MB = 128
+# firehose buffers up to 900s, retries and the async enricher add some more
+DEFAULT_GRACE_SECONDS = 30 * 60
+
+GZIP_MAGIC = b"\x1f\x8b"
+PARQUET_MAGIC = b"PAR1"
+PARQUET_SORT_KEYS = ["site_id", "event_datetime"]
+
+# e.g. dt=2020-04-06/hour=09/ or dt=2020-04-06/site_id=1/ relative to the enriched prefix
+RE_PARTITION = re.compile(r"^dt=(?P<dt>\d{4}-\d{2}-\d{2})/(?:hour=(?P<hour>\d{2})/)?(?:site_id=[^/]+/)?$")
+# firehose default prefix of stacks created before the hive style partitions e.g. 2020/04/06/09/<name>
+RE_LEGACY_KEY = re.compile(r"^(?P<year>\d{4})/(?P<month>\d{2})/(?P<day>\d{2})/(?P<hour>\d{2})/(?P<name>[^/]+)$")
+
+Partition = namedtuple("Partition", ["path", "start", "end", "keys"])
+CompactionResult = namedtuple("CompactionResult", ["path", "objects_in", "objects_out", "bytes_in", "bytes_out"])
+
+
+class UnreadableObject(ValueError):
+    """
+    an object of a partition can not be decoded e.g. unknown compression => the partition is skipped, nothing deleted
+    """
+
+
+def _is_hidden(key):
+    return key.rsplit("/", 1)[-1][:1] in ("_", ".")
+
+
+def decode_hadoop_snappy(data):
+    """
+    firehose HADOOP_SNAPPY: blocks of [uncompressed length] followed by chunks of [compressed length][raw snappy],
+    big endian uint32 lengths. Raises UnreadableObject if data is not in this format
+    """
+    # optional dependency, pyarrow ships a snappy codec
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise UnreadableObject("decoding HADOOP_SNAPPY objects requires pyarrow, pip install pyarrow")
+
+    codec = pa.Codec("snappy")
+    blocks, offset = [], 0
+    while offset < len(data):
+        block_length, offset = _read_uint32(data, offset)
+        block_bytes = 0
+        while block_bytes < block_length:
+            chunk_length, offset = _read_uint32(data, offset)
+            end = offset + chunk_length
+            if not chunk_length or end > len(data):
+                raise UnreadableObject("truncated HADOOP_SNAPPY chunk")
+            compressed = data[offset:end]
+            offset = end
+            try:
+                chunk = codec.decompress(compressed, decompressed_size=_snappy_length(compressed)).to_pybytes()
+            except pa.ArrowException as e:
+                raise UnreadableObject(f"invalid snappy chunk: {e}")
+            blocks.append(chunk)
+            block_bytes += len(chunk)
+        if block_bytes != block_length:
+            raise UnreadableObject("HADOOP_SNAPPY block length mismatch")
+    return b"".join(blocks)
+
+
+def _read_uint32(data, offset):
+    end = offset + 4
+    if end > len(data):
+        raise UnreadableObject("truncated HADOOP_SNAPPY length")
+    return int.from_bytes(data[offset:end], "big"), end
+
+
+def _snappy_length(compressed):
+    # raw snappy starts with the uncompressed length as little endian varint
+    length = 0
+    for position, byte in enumerate(compressed[:5]):
+        length |= (byte & 0x7F) << (7 * position)
+        if not byte & 0x80:
+            return length
+    raise UnreadableObject("invalid snappy length")
+
+
+def json_records_to_table(records):
+    """
+    enriched events read from json lines => pyarrow table of the enriched schema
+    """
+    # optional dependency, only required to write parquet
+    import pyarrow as pa
+
+    # event_datetime is a string in json events => cast to the timestamp of the table schema
+    table = pa.Table.from_pylist(
+        records, schema=event_schema.schema_to_arrow_schema(event_schema.ENRICHED, timestamps_as_strings=True)
+    )
+    return table.cast(event_schema.schema_to_arrow_schema(event_schema.ENRICHED))
+
+
+class LocalStorage:
+    """
+    Objects below a local directory, keys are / separated paths relative to root
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def list(self, prefix):
+        """
+        :return: list of (key, size)
+        """
+        objects = []
+        for dir_path, _, file_names in os.walk(self._path(prefix)):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                objects.append((key, os.path.getsize(path)))
+        return sorted(objects)
+
+    def read(self, key):
+        with io.open(self._path(key), "rb") as fh:
+            return fh.read()
+
+    def write(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with io.open(f"{path}.tmp", "wb") as fh:
+            fh.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def publish(self, hidden_key, key):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self._path(hidden_key), path)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+class S3Storage:
+    """
+    Objects below a S3 bucket, works with any boto3 compatible S3 client e.g. moto for local tests
+    """
+
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    def list(self, prefix):
+        objects = []
+        for page in self.s3_client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            objects.extend((obj["Key"], obj["Size"]) for obj in page.get("Contents", []))
+        return sorted(objects)
+
+    def read(self, key):
+        return self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def write(self, key, data):
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def publish(self, hidden_key, key):
+        # a single copy is atomic, readers see either no object or the complete one
+        self.s3_client.copy_object(Bucket=self.bucket, Key=key, CopySource={"Bucket": self.bucket, "Key": hidden_key})
+        self.s3_client.delete_object(Bucket=self.bucket, Key=hidden_key)
+
+    def exists(self, key):
+        return bool(self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=key, MaxKeys=1).get("KeyCount"))
+
+    def delete(self, keys):
+        keys = list(keys)
+        # max 1000 keys per request
+        for start in range(0, len(keys), 1000):
+            end = start + 1000
+            self.s3_client.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": [{"Key": key} for key in keys[start:end]], "Quiet": True}
+            )
+
+
+def migrate_legacy_layout(storage, prefix, hourly_partitions=True, dry_run=False):
+    """
+    Moves the objects of the firehose default layout below prefix to the hive style partitions read by the glue
+    table e.g. events/enriched/2020/04/06/09/<name> => events/enriched/dt=2020-04-06/hour=09/<name>. Object names are
+    kept => runs can be repeated, the objects of an interrupted run are moved by the next one.
+
+    :param hourly_partitions: False => dt partitions only, see DeliveryProfile.hourly_partitions
+    :return: list of (key, new key)
+    """
+    moves = []
+    prefix_length = len(prefix)
+    for key, _ in storage.list(prefix):
+        match = RE_LEGACY_KEY.match(key[prefix_length:])
+        if not match:
+            continue
+        partition = "dt={year}-{month}-{day}/".format(**match.groupdict())
+        if hourly_partitions:
+            partition += f"hour={match.group('hour')}/"
+        moves.append((key, f"{prefix}{partition}{match.group('name')}"))
+
+    if not dry_run:
+        for key, new_key in moves:
+            # publish is a copy and delete => the object is never missing from both locations
+            storage.publish(key, new_key)
+    return moves
+
+
+class Compactor:
+    """
+    Merges the small objects of closed time partitions into a few files of about target_size_mb.
+
+    A partition is compacted in steps, the manifest makes an interrupted run recoverable:
+    1. write the merged files with hidden names
+    2. write the manifest (sources, targets)
+    3. publish the targets, delete the sources, delete the manifest
+    Interrupted runs with a manifest are rolled forward, hidden files without a manifest are removed.
+
+    parquet: the merged files are written as parquet below target_prefix, sorted by site_id and event_datetime
+    """
+
+    def __init__(
+        self,
+        storage,
+        prefix,
+        target_prefix=None,
+        parquet=False,
+        target_size_mb=DEFAULT_TARGET_SIZE_MB,
+        grace_seconds=DEFAULT_GRACE_SECONDS,
+        clock=time.time,
+    ):
+        self.storage = storage
+        self.prefix = prefix
+        self.target_prefix = target_prefix or prefix
+        self.parquet = parquet
+        self.target_size = target_size_mb * 1024 * 1024
+        self.grace_seconds = grace_seconds
+        self.clock = clock
+
+    def partitions(self, prefix=None):
+        prefix = prefix or self.prefix
+        keys = defaultdict(list)
+        for key, size in self.storage.list(prefix):
+            path, _ = key.rsplit("/", 1)
+            keys[f"{path}/"].append((key, size))
+
+        partitions = []
+        prefix_length = len(prefix)
+        for path, path_keys in sorted(keys.items()):
+            partition_path = path[prefix_length:]
+            match = RE_PARTITION.match(partition_path)
+            if not match:
+                continue
+            start = datetime.strptime(match.group("dt"), "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            if match.group("hour"):
+                start += timedelta(hours=int(match.group("hour")))
+                end = start + timedelta(hours=1)
+            else:
+                end = start + timedelta(days=1)
+            partitions.append(Partition(partition_path, start, end, path_keys))
+        return partitions
+
+    def is_closed(self, partition):
+        return partition.end.timestamp() + self.grace_seconds <= self.clock()
+
+    def needs_compaction(self, partition):
+        visible = [key for key, _ in partition.keys if not _is_hidden(key)]
+        if self.parquet and self.target_prefix != self.prefix:
+            # conversion => every visible object is moved to the parquet prefix
+            return bool(visible)
+        uncompacted = [key for key in visible if not key.rsplit("/", 1)[-1].startswith(COMPACTED_PREFIX)]
+        return len(visible) > 1 and bool(uncompacted)
+
+    def recover(self):
+        """
+        finishes or cleans up runs interrupted during a previous compaction
+        """
+        for prefix in {self.prefix, self.target_prefix}:
+            for partition in self.partitions(prefix):
+                manifest_key = f"{prefix}{partition.path}{MANIFEST_NAME}"
+                hidden_keys = [key for key, _ in partition.keys if key.rsplit("/", 1)[-1].startswith(HIDDEN_PREFIX)]
+                if any(key == manifest_key for key, _ in partition.keys):
+                    self._finish(json.loads(self.storage.read(manifest_key)), manifest_key)
+                elif hidden_keys:
+                    self.storage.delete(hidden_keys)
+
+    def _finish(self, manifest, manifest_key):
+        for target in manifest["targets"]:
+            if self.storage.exists(target["hidden_key"]):
+                self.storage.publish(target["hidden_key"], target["key"])
+        self.storage.delete(manifest["sources"])
+        self.storage.delete([manifest_key])
+
+    def _read_json_lines(self, key):
+        """
+        :return: the json lines of an uncompressed, gzip or HADOOP_SNAPPY object, every line is checked to be json
+        """
+        data = self.storage.read(key)
+        if data[:2] == GZIP_MAGIC:
+            data = gzip.decompress(data)
+        elif data[:1] not in (b"{", b""):
+            data = decode_hadoop_snappy(data)
+        if data and not data.endswith(b"\n"):
+            data += b"\n"
+        for line in filter(None, data.splitlines()):
+            try:
+                json.loads(line)
+            except ValueError:
+                raise UnreadableObject(f"{key} is not json lines, unknown compression")
+        return data
+
+    def _merge_json(self, sources, rows_in):
+        # files are rolled over after a source, sources are small compared to the target size
+        buffer, gzip_file = io.BytesIO(), None
+        for key in sources:
+            if gzip_file is None:
+                buffer = io.BytesIO()
+                gzip_file = gzip.GzipFile(fileobj=buffer, mode="wb")
+            data = self._read_json_lines(key)
+            rows_in[0] += data.count(b"\n")
+            gzip_file.write(data)
+            if buffer.tell() >= self.target_size:
+                gzip_file.close()
+                gzip_file = None
+                yield buffer.getvalue()
+        if gzip_file is not None:
+            gzip_file.close()
+            yield buffer.getvalue()
+
+    def _merge_parquet(self, sources, bytes_in, rows_in):
+        # optional dependency, only required to write parquet
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrow_schema = event_schema.schema_to_arrow_schema(event_schema.ENRICHED)
+        tables, records = [], []
+        for key in sources:
+            data = self.storage.read(key)
+            if data[:4] == PARQUET_MAGIC:
+                tables.append(pq.read_table(io.BytesIO(data), schema=arrow_schema))
+            else:
+                records.extend(json.loads(line) for line in self._read_json_lines(key).splitlines() if line)
+        if records:
+            tables.append(json_records_to_table(records))
+        table = pa.concat_tables(tables)
+        rows_in[0] = table.num_rows
+
+        # sorted => row group statistics of site_id and event_datetime allow to skip row groups
+        sort_keys = [(name, "ascending") for name in PARQUET_SORT_KEYS if name in table.column_names]
+        if sort_keys:
+            table = table.sort_by(sort_keys)
+
+        files_count = max(1, math.ceil(bytes_in / self.target_size))
+        rows_per_file = math.ceil(table.num_rows / files_count)
+        for offset in range(0, table.num_rows, rows_per_file):
+            buffer = io.BytesIO()
+            pq.write_table(table.slice(offset, rows_per_file), buffer, compression="snappy")
+            yield buffer.getvalue()
+
+    def compact_partition(self, partition):
+        sources = [key for key, _ in partition.keys if not _is_hidden(key)]
+        bytes_in = sum(size for key, size in partition.keys if not _is_hidden(key))
+        target_path = f"{self.target_prefix}{partition.path}"
+        run_id = uuid.uuid4().hex[:8]
+        extension = "parquet" if self.parquet else "json.gz"
+
+        # events read from the sources, set while merging
+        rows_in = [0]
+        if self.parquet:
+            merged_files = self._merge_parquet(sources, bytes_in, rows_in)
+        else:
+            for key in sources:
+                if self.storage.read(key)[:4] == PARQUET_MAGIC:
+                    raise UnreadableObject(f"{key} is a parquet file, compact parquet partitions with parquet enabled")
+            merged_files = self._merge_json(sources, rows_in)
+
+        targets = []
+        bytes_out = rows_out = 0
+        for index, data in enumerate(merged_files):
+            name = f"{COMPACTED_PREFIX}{run_id}-{index:04d}.{extension}"
+            target = {"hidden_key": f"{target_path}{HIDDEN_PREFIX}{name}", "key": f"{target_path}{name}"}
+            self.storage.write(target["hidden_key"], data)
+            targets.append(target)
+            bytes_out += len(data)
+            rows_out += self._count_rows(target["hidden_key"])
+
+        # the sources are deleted below => the written targets have to contain every event
+        if rows_out != rows_in[0]:
+            self.storage.delete([target["hidden_key"] for target in targets])
+            raise UnreadableObject(f"{partition.path}: {rows_in[0]} events read, {rows_out} written")
+
+        manifest_key = f"{target_path}{MANIFEST_NAME}"
+        self.storage.write(manifest_key, json.dumps({"sources": sources, "targets": targets}).encode("utf-8"))
+        self._finish({"sources": sources, "targets": targets}, manifest_key)
+        return CompactionResult(partition.path, len(sources), len(targets), bytes_in, bytes_out)
+
+    def _count_rows(self, key):
+        # read back what was written, not what was meant to be written
+        data = self.storage.read(key)
+        if self.parquet:
+            import pyarrow.parquet as pq
+
+            return pq.read_metadata(io.BytesIO(data)).num_rows
+        return gzip.decompress(data).count(b"\n")
+
+    def run(self):
+        self.recover()
+        results = []
+        for partition in self.partitions():
+            if self.is_closed(partition) and self.needs_compaction(partition):
+                try:
+                    results.append(self.compact_partition(partition))
+                except UnreadableObject as e:
+                    # the sources are left in place
+                    logger.warning(f"skipped {partition.path}: {e}")
+        return results
+
+    def run_forever(self, interval_seconds, callback=None, sleep=time.sleep):
+        while True:
+            results = self.run()
+            if callback:
+                callback(results)
+            sleep(interval_seconds)
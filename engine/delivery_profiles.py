@@ -0,0 +1,83 @@
+from collections import namedtuple
+
+# Firehose limits of the S3 destination
+MAX_INTERVAL_SECONDS = 900
+MAX_SIZE_MB = 128
+# record format conversion (parquet) and dynamic partitioning require a buffer size of at least 64 MiB
+MIN_PARQUET_SIZE_MB = 64
+MIN_DYNAMIC_PARTITIONING_SIZE_MB = 64
+
+DeliveryProfile = namedtuple(
+    "DeliveryProfile",
+    [
+        "name",
+        "description",
+        "interval_seconds",
+        "size_mb",
+        # CompressionFormat of json files, one of GZIP, HADOOP_SNAPPY
+        "json_compression",
+        # ParquetSerDe Compression, one of GZIP, SNAPPY
+        "parquet_compression",
+        # False => daily partitions only, fewer prefixes to list for profiles writing a few large objects per hour
+        "hourly_partitions",
+    ],
+)
+
+# Glue table compressionType of the json compression formats
+JSON_COMPRESSION_TYPES = {"GZIP": "gzip", "HADOOP_SNAPPY": "snappy"}
+
+PROFILES = [
+    DeliveryProfile("low-latency", "events are visible after about a minute", 60, 1, "GZIP", "SNAPPY", True),
+    DeliveryProfile("balanced", "default, flush every minute or 25 MB", 60, 25, "GZIP", "SNAPPY", True),
+    DeliveryProfile(
+        "throughput",
+        "max buffer, few large objects, fast to read",
+        MAX_INTERVAL_SECONDS,
+        MAX_SIZE_MB,
+        "HADOOP_SNAPPY",
+        "SNAPPY",
+        False,
+    ),
+    DeliveryProfile(
+        "cheap-storage",
+        "max buffer, best compression ratio",
+        MAX_INTERVAL_SECONDS,
+        MAX_SIZE_MB,
+        "GZIP",
+        "GZIP",
+        False,
+    ),
+]
+
+DEFAULT_PROFILE = "balanced"
+
+PROFILES_BY_NAME = {profile.name: profile for profile in PROFILES}
+
+
+def get_profile(name=None):
+    try:
+        return PROFILES_BY_NAME[name or DEFAULT_PROFILE]
+    except KeyError:
+        raise ValueError(f"Unknown delivery profile '{name}', choose one of {', '.join(PROFILES_BY_NAME)}")
+
+
+def buffer_size_mb(profile, output_format, dynamic_partitioning=False):
+    """
+    :param dynamic_partitioning: partitions by record fields e.g. site_id, firehose rejects smaller buffers
+    """
+    size_mb = profile.size_mb
+    if output_format == "parquet":
+        size_mb = max(size_mb, MIN_PARQUET_SIZE_MB)
+    if dynamic_partitioning:
+        size_mb = max(size_mb, MIN_DYNAMIC_PARTITIONING_SIZE_MB)
+    return size_mb
+
+
+def partition_prefix(profile):
+    """
+    Firehose prefix expression of the time partitions, timestamps are the UTC arrival time at firehose
+    e.g. dt=!{timestamp:yyyy-MM-dd}/hour=!{timestamp:HH}/ => dt=2020-04-06/hour=09/
+    """
+    if profile.hourly_partitions:
+        return "dt=!{timestamp:yyyy-MM-dd}/hour=!{timestamp:HH}/"
+    return "dt=!{timestamp:yyyy-MM-dd}/"
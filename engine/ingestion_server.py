@@ -0,0 +1,429 @@
+"""
+Self-hosted ingestion server, an alternative to API Gateway + a Lambda invocation per request for high traffic.
+One worker process per core accepts keep-alive HTTP connections on a shared socket with asyncio, the events are
+processed by the event receiver code and delivered in large batches to Firehose or S3. The results of remote lookups
+are shared by the workers.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from . import compaction, local_server
+
+# api gateway payload limit
+MAX_BODY_BYTES = 10 * 1024 * 1024
+# idle keep-alive connections are closed after this many seconds
+KEEP_ALIVE_TIMEOUT = 60
+DEFAULT_FLUSH_INTERVAL = 1
+DEFAULT_DRAIN_TIMEOUT = 30
+# records not delivered yet, kept in memory up to this size and spilled to disk above it
+DEFAULT_BUFFER_MEMORY_MB = 64
+# requests are rejected with 503 above this share of the buffer limits => clients retry while the downstream catches up
+BACKPRESSURE_THRESHOLD = 0.9
+RETRY_AFTER_SECONDS = 5
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    411: "Length Required",
+    413: "Payload Too Large",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+}
+
+
+def response(status, body=b"", keep_alive=True, headers=None):
+    head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", f"Content-Length: {len(body)}"]
+    if not keep_alive:
+        head.append("Connection: close")
+    head.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+    return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+
+def firehose_sink(boto_session):
+    """
+    records are sent to the firehose delivery stream of the stack, dead letters to its bucket
+    """
+
+    def _create(enricher):
+        # async enrichment mode => firehose invokes the enricher lambda
+        return boto_session.client("firehose"), boto_session.client("s3")
+
+    return _create
+
+
+def storage_sink(create_storage, prefix_expression, **delivery_stream_kwargs):
+    """
+    records are buffered and written by a local_server.LocalDeliveryStream, without firehose
+    :param create_storage: called in every worker e.g. lambda: compaction.S3Storage(session.client("s3"), bucket)
+    """
+
+    def _create(enricher):
+        storage = create_storage()
+        delivery_stream = local_server.LocalDeliveryStream(
+            storage, prefix_expression, enricher=enricher, name=f"ingestion-{os.getpid()}", **delivery_stream_kwargs
+        )
+        return delivery_stream, local_server.LocalS3Client(storage)
+
+    return _create
+
+
+def local_sink(path, prefix_expression, **delivery_stream_kwargs):
+    return storage_sink(lambda: compaction.LocalStorage(path), prefix_expression, **delivery_stream_kwargs)
+
+
+class IngestionWorker:
+    """
+    One worker process: an asyncio server for the connections, a single processing thread for the receiver code
+    => the receiver runs one request at a time like in a lambda container, the event loop keeps serving connections
+    while lookups are waiting for a remote backend.
+
+    :param sink_factory: called in the worker, enricher module => firehose client, s3 client
+        e.g. firehose_sink, storage_sink or local_sink
+    :param trust_forwarded_for: the client ip is the first ip of X-Forwarded-For e.g. behind a load balancer
+    :param buffer_memory_mb: see buffer.BoundedBuffer max_memory_bytes, the spill files are written to $TMPDIR
+    """
+
+    def __init__(
+        self,
+        sock,
+        environment,
+        sink_factory,
+        shared_cache_items=None,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        trust_forwarded_for=False,
+        buffer_memory_mb=DEFAULT_BUFFER_MEMORY_MB,
+    ):
+        self.sock = sock
+        self.environment = environment
+        self.sink_factory = sink_factory
+        self.shared_cache_items = shared_cache_items
+        self.flush_interval = flush_interval
+        self.trust_forwarded_for = trust_forwarded_for
+        self.buffer_memory_mb = buffer_memory_mb
+        self.draining = False
+        self._idle = set()
+        self._active = 0
+        self._stop = None
+        self._processing = ThreadPoolExecutor(max_workers=1)
+
+    def _load(self):
+        handler_module, enricher_module = local_server.load_receiver(self.environment)
+        import enrichment
+        import s3_sink
+        import shared_cache
+        from buffer import BoundedBuffer, BufferFull
+        from delivery import FirehoseDelivery
+
+        if self.shared_cache_items is not None:
+            enrichment.SHARED_CACHE = shared_cache.LocalSharedCache(
+                ttl=enrichment.LOOKUP_CACHE_TTL,
+                negative_ttl=enrichment.LOOKUP_CACHE_TTL_NEGATIVE,
+                items=self.shared_cache_items,
+            )
+        firehose_client, s3_client = self.sink_factory(
+            enricher_module if self.environment.get("ENRICHMENT_MODE") == "async" else None
+        )
+        s3_sink._s3_client = s3_client
+        self.handler_module = handler_module
+        self.firehose_client = firehose_client
+        # records of many requests => put_record_batch with up to 500 records, at least every flush_interval.
+        # A failing or slow downstream fills the buffer, the requests are rejected before it is full
+        delivery = FirehoseDelivery(firehose_client, self.environment["DELIVERY_STREAM_NAME"])
+        self.buffer = BoundedBuffer(
+            delivery.put,
+            max_age_seconds=self.flush_interval,
+            max_memory_bytes=self.buffer_memory_mb * 1024 * 1024,
+        )
+        self.buffer_full_error = BufferFull
+        self.dead_letters = []
+        self.bots = []
+
+    # processing thread
+
+    def _process(self, event_in):
+        if self.buffer.pressure >= BACKPRESSURE_THRESHOLD:
+            raise self.buffer_full_error(f"{len(self.buffer)} records not delivered yet")
+        dead_letters, bots = self.handler_module.process_event(event_in, self.buffer)
+        self.dead_letters.extend(dead_letters)
+        self.bots.extend(bots)
+
+    def _flush(self, force=False):
+        # due batches only, failures are retried with backoff. force => all, raises if the downstream fails
+        self.buffer.flush(force=force)
+        errors = []
+        self.dead_letters = self._write(self.handler_module.write_dead_letters, self.dead_letters, errors)
+        self.bots = self._write(self.handler_module.write_bots, self.bots, errors)
+        if isinstance(self.firehose_client, local_server.LocalDeliveryStream):
+            self.firehose_client.flush(force=force)
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _write(write_func, records, errors):
+        """
+        :return: records left to write, all of them if write_func failed => written by the next flush
+        """
+        if not records:
+            return records
+        try:
+            write_func(records)
+        except Exception as e:
+            errors.append(e)
+            return records
+        return []
+
+    # event loop
+
+    async def _run_in_processing(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._processing, func, *args)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._run_in_processing(self._flush)
+            except Exception:
+                # e.g. firehose not reachable, the next requests and flushes go on
+                traceback.print_exc()
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, target, version = request_line.decode("latin-1").split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip()] = value.strip()
+        return method, target, version, headers
+
+    async def _handle_connection(self, reader, writer):
+        source_ip = writer.get_extra_info("peername")[0]
+        try:
+            while not self.draining:
+                self._idle.add(writer)
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), KEEP_ALIVE_TIMEOUT)
+                finally:
+                    self._idle.discard(writer)
+                if request is None:
+                    break
+                self._active += 1
+                try:
+                    keep_alive = await self._handle_request(reader, writer, source_ip, *request)
+                finally:
+                    self._active -= 1
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # idle, closed by the client or not http
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader, writer, source_ip, method, target, version, headers):
+        header_values = {name.lower(): value for name, value in headers.items()}
+        connection = header_values.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+        keep_alive = keep_alive and not self.draining
+
+        if "transfer-encoding" in header_values:
+            # chunked request bodies are not supported, the body can not be skipped => close the connection
+            writer.write(response(411, keep_alive=False))
+            await writer.drain()
+            return False
+        content_length = int(header_values.get("content-length") or 0)
+        if content_length > MAX_BODY_BYTES:
+            writer.write(response(413, keep_alive=False))
+            await writer.drain()
+            return False
+        body = (await reader.readexactly(content_length)).decode("utf-8") if content_length else None
+
+        if self.trust_forwarded_for and "x-forwarded-for" in header_values:
+            source_ip = header_values["x-forwarded-for"].split(",")[0].strip()
+
+        url = urlsplit(target)
+        if url.path not in local_server.RECEIVER_PATHS:
+            writer.write(response(404, b"Not Found", keep_alive))
+        else:
+            event_in = local_server.proxy_event(method, url.path, url.query, headers, body, source_ip)
+            try:
+                await self._run_in_processing(self._process, event_in)
+            except self.buffer_full_error:
+                # the events added before the buffer got full are delivered, the client sends them again
+                writer.write(response(503, keep_alive=keep_alive, headers={"Retry-After": RETRY_AFTER_SECONDS}))
+            except Exception:
+                traceback.print_exc()
+                writer.write(response(502, b'{"message": "Internal server error"}', keep_alive))
+            else:
+                writer.write(response(200, keep_alive=keep_alive))
+        await writer.drain()
+        return keep_alive
+
+    async def _drain(self, timeout):
+        # stop accepting, close idle keep-alive connections, let running requests finish, deliver the buffers
+        self.draining = True
+        self._server.close()
+        for writer in list(self._idle):
+            writer.close()
+        deadline = time.monotonic() + timeout
+        while self._active and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        try:
+            await self._run_in_processing(self._flush, True)
+        except Exception:
+            traceback.print_exc()
+            print(
+                f"worker {os.getpid()}: {len(self.buffer)} events, {len(self.dead_letters)} dead letters and "
+                f"{len(self.bots)} bots not delivered",
+                file=sys.stderr,
+            )
+            # the worker exits => its spill files are removed
+            self.buffer.discard()
+
+    async def serve(self, drain_timeout=DEFAULT_DRAIN_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signal_number, self._stop.set)
+        await self._run_in_processing(self._load)
+
+        self._server = await asyncio.start_server(self._handle_connection, sock=self.sock)
+        flusher = asyncio.ensure_future(self._flush_periodically())
+        await self._stop.wait()
+        flusher.cancel()
+        await self._drain(drain_timeout)
+
+
+def remote_lookups_enabled(environment):
+    """
+    ipinfo / userstack, local lookups are faster than sharing their results between the workers
+    """
+    return (
+        environment.get("IP_GEOCODING_ENABLED") == "true" and environment.get("GEOLOCATION_BACKEND") != "local"
+    ) or (
+        environment.get("DEVICE_DETECTION_ENABLED") == "true" and environment.get("DEVICE_DETECTION_BACKEND") != "local"
+    )
+
+
+def _worker_main(drain_timeout, *args):
+    asyncio.run(IngestionWorker(*args).serve(drain_timeout))
+
+
+class IngestionServer:
+    """
+    Binds the socket and forks the worker processes, the kernel distributes the connections among them.
+
+    :param workers: number of worker processes, defaults to one per core
+    :param environment: of the receiver e.g. local_server.receiver_environment(cfg)
+    :param sink_factory: see IngestionWorker
+    :param share_lookup_cache: results of remote lookups are shared by the workers via a multiprocessing manager
+    :param trust_forwarded_for: see IngestionWorker
+    :param buffer_memory_mb: see IngestionWorker
+    """
+
+    def __init__(
+        self,
+        environment,
+        sink_factory,
+        host="127.0.0.1",
+        port=8080,
+        workers=None,
+        share_lookup_cache=True,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        drain_timeout=DEFAULT_DRAIN_TIMEOUT,
+        trust_forwarded_for=False,
+        buffer_memory_mb=DEFAULT_BUFFER_MEMORY_MB,
+    ):
+        self.environment = dict(environment, METRICS_ENABLED="false", SHARED_CACHE="off")
+        self.sink_factory = sink_factory
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.share_lookup_cache = share_lookup_cache
+        self.flush_interval = flush_interval
+        self.drain_timeout = drain_timeout
+        self.trust_forwarded_for = trust_forwarded_for
+        self.buffer_memory_mb = buffer_memory_mb
+        self.address = None
+        self._processes = []
+        self._manager = None
+
+    def start(self):
+        # the workers are forked => sink_factory may be a closure
+        context = multiprocessing.get_context("fork")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(1024)
+        sock.setblocking(False)
+        self.address = sock.getsockname()
+
+        shared_cache_items = None
+        if self.share_lookup_cache and self.workers > 1 and remote_lookups_enabled(self.environment):
+            self._manager = context.Manager()
+            shared_cache_items = self._manager.dict()
+
+        for _ in range(self.workers):
+            process = context.Process(
+                target=_worker_main,
+                args=(
+                    self.drain_timeout,
+                    sock,
+                    self.environment,
+                    self.sink_factory,
+                    shared_cache_items,
+                    self.flush_interval,
+                    self.trust_forwarded_for,
+                    self.buffer_memory_mb,
+                ),
+            )
+            process.start()
+            self._processes.append(process)
+        sock.close()
+
+    def stop(self):
+        """
+        graceful drain: workers stop accepting, finish running requests and deliver their buffers
+        """
+        for process in self._processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.drain_timeout + 5
+        for process in self._processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        # the workers hold proxies of the manager dict until they exited => shut the manager down afterwards
+        self._processes = []
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def serve_forever(self):
+        stop = []
+        previous_handlers = {
+            signal_number: signal.signal(signal_number, lambda *args: stop.append(True))
+            for signal_number in (signal.SIGTERM, signal.SIGINT)
+        }
+        self.start()
+        try:
+            while not stop and all(process.is_alive() for process in self._processes):
+                time.sleep(0.2)
+        finally:
+            self.stop()
+            for signal_number, handler in previous_handlers.items():
+                signal.signal(signal_number, handler)
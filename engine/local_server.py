@@ -0,0 +1,358 @@
+"""
+Runs the event receiver without AWS: a threaded HTTP server translates requests into API Gateway proxy events for
+lambda_handler, a local stand-in of the Firehose delivery stream buffers the records and writes gzipped json lines or
+parquet objects in the layout of the S3 bucket.
+"""
+
+import base64
+import gzip
+import importlib
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from . import compaction
+from .stack import S3_BOTS_PREFIX, S3_DEAD_LETTER_PREFIX, S3_ENRICHED_ERROR_PREFIX
+
+RECEIVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "matomo_event_receiver")
+
+# same paths as the API Gateway resources of the stack
+RECEIVER_PATHS = ("/matomo-event-receiver", "/matomo-event-receiver/", "/matomo.php")
+
+LOCAL_BUCKET = "local"
+DELIVERY_STREAM_NAME = "local-event-compressor"
+
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+# !{timestamp:yyyy-MM-dd} / !{partitionKeyFromQuery:site_id} of the firehose prefix expressions
+RE_PREFIX_EXPRESSION = re.compile(r"!\{(?P<namespace>timestamp|partitionKeyFromQuery):(?P<value>[^}]+)\}")
+TIMESTAMP_FORMATS = {"yyyy-MM-dd": "%Y-%m-%d", "HH": "%H"}
+
+
+def receiver_environment(cfg):
+    """
+    environment of the receiver lambda as configured by ./stream-steam config, without the AWS resources
+    """
+    return {
+        "S3_BUCKET": LOCAL_BUCKET,
+        "DEAD_LETTER_PREFIX": S3_DEAD_LETTER_PREFIX,
+        "DELIVERY_STREAM_NAME": DELIVERY_STREAM_NAME,
+        "SKIP_NONE_FIELDS": cfg.get("skip_none_fields") or "false",
+        "ENRICHMENT_MODE": cfg.get("enrichment_mode") or "sync",
+        "IP_ADDRESS_MASKING_ENABLED": cfg.get("ip_address_masking_enabled") or "false",
+        "METRICS_ENABLED": cfg.get("metrics_enabled") or "false",
+        "SAMPLE_RATES": cfg.get("sample_rates") or "",
+        "SITE_RATE_LIMIT": cfg.get("site_rate_limit") or "0",
+        "BOT_FILTER_MODE": cfg.get("bot_filter_mode") or "off",
+        "BOTS_PREFIX": S3_BOTS_PREFIX,
+        "BOT_IP_RANGES": cfg.get("bot_ip_ranges") or "",
+        "IP_GEOCODING_ENABLED": cfg.get("ip_geocoding_enabled") or "false",
+        "GEOLOCATION_BACKEND": cfg.get("geolocation_backend") or "ipinfo",
+        "IP_INFO_API_TOKEN": cfg.get("ip_info_api_token") or "",
+        "USERSTACK_API_TOKEN": cfg.get("userstack_api_token") or "",
+        "DEVICE_DETECTION_ENABLED": cfg.get("device_detection_enabled") or "false",
+        "DEVICE_DETECTION_BACKEND": cfg.get("device_detection_backend") or "userstack",
+        # the shared lookup cache is a DynamoDB table of the stack
+        "SHARED_CACHE": "off",
+    }
+
+
+def load_receiver(environment):
+    """
+    imports the receiver modules the way lambda does, the environment is read at import time
+    :return: the lambda and the enricher module
+    """
+    os.environ.update(environment)
+    # no region / credentials required, the clients created at import time are replaced
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+    if RECEIVER_PATH not in sys.path:
+        sys.path.insert(0, RECEIVER_PATH)
+    # "lambda" is a keyword => import by name
+    return importlib.import_module("lambda"), importlib.import_module("enricher")
+
+
+def render_prefix(expression, arrival, site_id=None):
+    """
+    e.g. events/enriched/dt=!{timestamp:yyyy-MM-dd}/site_id=!{partitionKeyFromQuery:site_id}/
+    => events/enriched/dt=2020-04-06/site_id=1/
+    """
+
+    def _replace(match):
+        if match.group("namespace") == "timestamp":
+            return arrival.strftime(TIMESTAMP_FORMATS[match.group("value")])
+        return str(site_id)
+
+    return RE_PREFIX_EXPRESSION.sub(_replace, expression)
+
+
+def format_request_time(value):
+    """
+    e.g. 2020-04-06 09:07:05 UTC => 06/Apr/2020:09:07:05 +0000, the format of API Gateway requestContext.requestTime
+    """
+    return f"{value:%d}/{MONTHS[value.month - 1]}/{value:%Y:%H:%M:%S} +0000"
+
+
+def proxy_event(method, path, query, headers, body, source_ip, now=None):
+    """
+    API Gateway proxy integration event of a HTTP request
+    see https://docs.aws.amazon.com/apigateway/latest/developerguide/set-up-lambda-proxy-integrations.html
+    """
+    now = now or datetime.now(timezone.utc)
+    # http header names are case insensitive e.g. user-agent of http/2 clients and proxies
+    user_agent = next((value for name, value in (headers or {}).items() if name.lower() == "user-agent"), None)
+    query_params = parse_qsl(query, keep_blank_values=True)
+    multi_value_query_params = {}
+    for name, value in query_params:
+        multi_value_query_params.setdefault(name, []).append(value)
+    return {
+        "resource": path,
+        "path": path,
+        "httpMethod": method,
+        "headers": headers or None,
+        "queryStringParameters": dict(query_params) or None,
+        "multiValueQueryStringParameters": multi_value_query_params or None,
+        "body": body,
+        "isBase64Encoded": False,
+        "requestContext": {
+            "httpMethod": method,
+            "path": path,
+            "requestTime": format_request_time(now),
+            "requestTimeEpoch": int(now.timestamp() * 1000),
+            "identity": {"sourceIp": source_ip, "userAgent": user_agent},
+        },
+    }
+
+
+class LocalS3Client:
+    """
+    put_object of the boto3 S3 client, objects are written to the storage e.g. dead letters of s3_sink
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def put_object(self, Bucket, Key, Body):
+        self.storage.write(Key, Body if isinstance(Body, bytes) else Body.encode("utf-8"))
+        return {}
+
+
+class LocalDeliveryStream:
+    """
+    Stand-in for the Firehose delivery stream, implements put_record_batch of the boto3 Firehose client.
+    Records are buffered per partition, a partition is written as one object as soon as its buffer reaches
+    buffer_size_mb or is older than buffer_seconds. Object names follow firehose e.g.
+    events/enriched/dt=2020-04-06/hour=09/local-event-compressor-1-2020-04-06-09-07-05-<uuid>.gz
+
+    :param prefix_expression: firehose prefix of the stack e.g. events/enriched/dt=!{timestamp:yyyy-MM-dd}/
+    :param storage: compaction.LocalStorage or compaction.S3Storage
+    :param enricher: enricher lambda module, async enrichment mode => records are transformed before they are buffered
+    :param name: prefix of the object names
+    """
+
+    def __init__(
+        self,
+        storage,
+        prefix_expression,
+        parquet=False,
+        json_compression="GZIP",
+        parquet_compression="SNAPPY",
+        buffer_size_mb=1,
+        buffer_seconds=60,
+        enricher=None,
+        name=DELIVERY_STREAM_NAME,
+        clock=time.monotonic,
+    ):
+        self.storage = storage
+        self.prefix_expression = prefix_expression
+        self.parquet = parquet
+        self.json_compression = json_compression
+        self.parquet_compression = parquet_compression
+        self.buffer_size = buffer_size_mb * 1024 * 1024
+        self.buffer_seconds = buffer_seconds
+        self.enricher = enricher
+        self.name = name
+        self.clock = clock
+        self.records_in = 0
+        self.objects_out = 0
+        # prefix => (created_at, records, bytes)
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def _transform(self, records):
+        # firehose data transformation, same contract as the lambda processor
+        records_in = [
+            {"recordId": str(index), "data": base64.b64encode(data).decode()} for index, data in enumerate(records)
+        ]
+        records_out = []
+        for record in self.enricher.lambda_handler({"records": records_in}, None)["records"]:
+            data = base64.b64decode(record["data"])
+            if record["result"] == "Ok":
+                records_out.append(data)
+            elif record["result"] == "ProcessingFailed":
+                self._write_error("processing-failed", [data])
+        return records_out
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        records = [record["Data"] for record in Records]
+        if self.enricher is not None:
+            records = self._transform(records)
+
+        arrival = datetime.now(timezone.utc)
+        with self._lock:
+            self.records_in += len(Records)
+            for data in records:
+                site_id = None
+                if "partitionKeyFromQuery" in self.prefix_expression:
+                    site_id = json.loads(data).get("site_id") or "unknown"
+                prefix = render_prefix(self.prefix_expression, arrival, site_id)
+                created_at, buffered, buffered_bytes = self._buffers.get(prefix, (self.clock(), [], 0))
+                buffered.append(data)
+                self._buffers[prefix] = (created_at, buffered, buffered_bytes + len(data))
+            self._flush(force=False)
+        return {"FailedPutCount": 0, "RequestResponses": [{"RecordId": uuid.uuid4().hex} for _ in Records]}
+
+    def flush(self, force=False):
+        """
+        writes the buffers which are full or too old, force => all buffers e.g. on shutdown
+        """
+        with self._lock:
+            self._flush(force)
+
+    def _flush(self, force):
+        now = self.clock()
+        for prefix, (created_at, records, records_bytes) in list(self._buffers.items()):
+            if force or records_bytes >= self.buffer_size or now - created_at >= self.buffer_seconds:
+                del self._buffers[prefix]
+                self._write(prefix, records)
+
+    def _object_key(self, prefix, extension):
+        now = datetime.now(timezone.utc)
+        return f"{prefix}{self.name}-1-{now:%Y-%m-%d-%H-%M-%S}-{uuid.uuid4()}{extension}"
+
+    def _write(self, prefix, records):
+        if self.parquet:
+            # optional dependency, only required to write parquet
+            import pyarrow.parquet as pq
+
+            table = compaction.json_records_to_table([json.loads(record) for record in records])
+            buffer = io.BytesIO()
+            pq.write_table(table, buffer, compression=self.parquet_compression.lower())
+            self.storage.write(self._object_key(prefix, ".parquet"), buffer.getvalue())
+        elif self.json_compression == "UNCOMPRESSED":
+            self.storage.write(self._object_key(prefix, ""), b"".join(records))
+        else:
+            # hadoop snappy is not in the standard library => gzip, the json serde reads both
+            self.storage.write(self._object_key(prefix, ".gz"), gzip.compress(b"".join(records)))
+        self.objects_out += 1
+
+    def _write_error(self, error_output_type, records):
+        prefix = f"{S3_ENRICHED_ERROR_PREFIX}{error_output_type}/dt={datetime.now(timezone.utc):%Y-%m-%d}/"
+        self.storage.write(self._object_key(prefix, ""), b"".join(records))
+
+
+class ReceiverRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, every response has a content length
+    protocol_version = "HTTP/1.1"
+    server_version = "StreamSteamLocal"
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        if url.path not in RECEIVER_PATHS:
+            self._respond(404, {}, b"Not Found")
+            return
+
+        content_length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(content_length).decode("utf-8") if content_length else None
+        event_in = proxy_event(
+            self.command, url.path, url.query, dict(self.headers.items()), body, self.client_address[0]
+        )
+        try:
+            result = self.server.invoke(event_in)
+        except Exception:
+            # api gateway answers 502 if the lambda fails
+            traceback.print_exc()
+            self._respond(502, {"Content-Type": "application/json"}, b'{"message": "Internal server error"}')
+            return
+        body = result.get("body") or ""
+        self._respond(result.get("statusCode", 200), result.get("headers") or {}, body.encode("utf-8"))
+
+    def _respond(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class LocalReceiverServer(ThreadingHTTPServer):
+    """
+    Connections are handled by one thread each, lambda_handler is invoked one request at a time like in a single
+    lambda container => the lookup cache and the metrics need no locking.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, handler_module, delivery_stream, verbose=False):
+        super().__init__(address, ReceiverRequestHandler)
+        self.handler_module = handler_module
+        self.delivery_stream = delivery_stream
+        self.verbose = verbose
+        self.invocations = 0
+        self._invoke_lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+
+    def invoke(self, event_in):
+        with self._invoke_lock:
+            self.invocations += 1
+            return self.handler_module.lambda_handler(event_in, None)
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(1):
+            self.delivery_stream.flush()
+
+    def serve_forever(self, poll_interval=0.5):
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self._stopped.set()
+            self.delivery_stream.flush(force=True)
+
+
+def create_server(
+    storage, prefix_expression, environment, host="127.0.0.1", port=8080, verbose=False, **delivery_stream_kwargs
+):
+    """
+    loads the receiver with the given environment, firehose and s3 are replaced by local stand-ins writing to storage
+    """
+    handler_module, enricher_module = load_receiver(environment)
+    import s3_sink
+
+    s3_sink._s3_client = LocalS3Client(storage)
+    delivery_stream = LocalDeliveryStream(
+        storage,
+        prefix_expression,
+        enricher=enricher_module if environment.get("ENRICHMENT_MODE") == "async" else None,
+        **delivery_stream_kwargs,
+    )
+    handler_module.firehose_client = delivery_stream
+    return LocalReceiverServer((host, port), handler_module, delivery_stream, verbose=verbose)
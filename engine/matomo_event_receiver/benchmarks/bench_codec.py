@@ -0,0 +1,73 @@
+"""
+Microbenchmark of the json codecs for a batch of validated, enriched events vs. json.dumps(event) + "\n"
+
+e.g. python engine/matomo_event_receiver/benchmarks/bench_codec.py
+"""
+import json
+import os
+import sys
+import timeit
+
+# the receiver modules are deployed flat into the lambda zip and import each other by their module name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from codec import CODECS  # noqa: E402 isort:skip
+from device_detection import LocalBackend  # noqa: E402 isort:skip
+from validator import validate_event  # noqa: E402 isort:skip
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.163 Safari/537.36"
+
+EVENT = {
+    "site_id": "1",
+    "random_part": 448318,
+    "visitor_id_created_ts": 1586169210,
+    "visitor_visit_count": 3,
+    "referral_ts": 0,
+    "visitor_last_visit_ts": 1586175191,
+    "display_resolutions": "1920x1080",
+    "language": "de",
+    "event_datetime": "2020-04-06 12:33:11",
+    "performance_generation_time_ms": 12,
+    "page_view_id": "Zo7ZdA",
+    "page_view_url": "http://127.0.0.1:1234/",
+    "action_name": "StreamSteam Web Tracking Demo",
+    "ip": "1.2.3.0",
+    "user_agent": USER_AGENT,
+    "supports_cookie": True,
+    "supports_pdf": True,
+    "send_image": False,
+    "geo_info": None,
+    "device_info": LocalBackend().lookup(USER_AGENT),
+}
+
+BATCH_SIZE = 50
+
+
+def main(number=2000):
+    events = [validate_event(EVENT)[0] for _ in range(BATCH_SIZE)]
+    events_skip_none = [validate_event(EVENT, skip_none=True)[0] for _ in range(BATCH_SIZE)]
+
+    def _legacy():
+        return [(json.dumps(event) + "\n").encode("utf-8") for event in events]
+
+    legacy = min(timeit.repeat(_legacy, number=number, repeat=3)) / number / BATCH_SIZE
+    print(f"json.dumps + concat:    {legacy * 1e6:8.2f} us/event {len(_legacy()[0]):6d} bytes")
+    for name, codec_class in CODECS.items():
+        try:
+            codec = codec_class()
+        except ImportError:
+            print(f"{name}: not installed")
+            continue
+        for label, batch in (("", events), (" skip none", events_skip_none)):
+            per_record = min(
+                timeit.repeat(lambda: [codec.dumps_line(event) for event in batch], number=number, repeat=3)
+            )
+            per_record = per_record / number / BATCH_SIZE
+            print(
+                f"{name + label + ':':23s} {per_record * 1e6:8.2f} us/event {len(codec.dumps_line(batch[0])):6d} bytes"
+                f" speedup {legacy / per_record:5.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Import time / cold start report of the event receiver lambda, every run starts a fresh interpreter
+
+e.g. python engine/matomo_event_receiver/benchmarks/bench_cold_start.py --runs 10 --json report.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+RECEIVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+ARTIFACT_PATH = os.path.join(RECEIVER_PATH, "dist", "matomo_event_receiver.zip")
+
+# "lambda" is a keyword => import by name
+IMPORT_HANDLER = (
+    "import importlib, time; t = time.perf_counter(); importlib.import_module('{module}'); "
+    "print(time.perf_counter() - t)"
+)
+
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "eu-central-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "DELIVERY_STREAM_NAME": "benchmark",
+}
+
+
+def import_once(module, environment):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_HANDLER.format(module=module)],
+        cwd=RECEIVER_PATH,
+        env=environment,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    # e.g. "import time:       356 |      12875 | boto3", nested imports are indented
+    top_level = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "[us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if name.startswith("  "):
+            continue
+        top_level[name.strip()] = int(cumulative)
+    return float(result.stdout.strip()), top_level
+
+
+def report(module, runs, environment):
+    totals = []
+    modules = defaultdict(list)
+    for _ in range(runs):
+        total, top_level = import_once(module, environment)
+        totals.append(total * 1000)
+        for name, cumulative in top_level.items():
+            modules[name].append(cumulative / 1000)
+
+    return {
+        "module": module,
+        "runs": runs,
+        "import_ms_median": statistics.median(totals),
+        "import_ms_min": min(totals),
+        "import_ms_max": max(totals),
+        "top_level_imports_ms": dict(
+            sorted(
+                ((name, statistics.median(values)) for name, values in modules.items()),
+                key=lambda item: item[1],
+                reverse=True,
+            )[:15]
+        ),
+        "artifact_bytes": os.path.getsize(ARTIFACT_PATH) if os.path.exists(ARTIFACT_PATH) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--module", default="lambda", help="handler module e.g. lambda or enricher")
+    parser.add_argument(
+        "--env", action="append", default=[], help="additional environment e.g. --env ENRICHMENT_MODE=async"
+    )
+    parser.add_argument("--json", dest="json_path", help="write the report to this file")
+    args = parser.parse_args()
+
+    environment = dict(os.environ, **ENVIRONMENT)
+    environment.update(kv.split("=", 1) for kv in args.env)
+
+    result = report(args.module, args.runs, environment)
+    print(f"{result['module']}: median {result['import_ms_median']:.1f} ms over {result['runs']} runs")
+    print(f"min {result['import_ms_min']:.1f} ms, max {result['import_ms_max']:.1f} ms")
+    if result["artifact_bytes"]:
+        print(f"artifact {result['artifact_bytes'] / 1024:.0f} KiB")
+    print("slowest top level imports:")
+    for name, ms in result["top_level_imports_ms"].items():
+        print(f"  {ms:8.1f} ms  {name}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as fh:
+            json.dump(result, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
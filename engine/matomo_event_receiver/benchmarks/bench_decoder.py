@@ -0,0 +1,84 @@
+"""
+Microbenchmark of the table driven param decoder vs. the loop over schema.INCOMING it replaced
+
+e.g. python engine/matomo_event_receiver/benchmarks/bench_decoder.py
+"""
+import os
+import sys
+import timeit
+
+# the receiver modules are deployed flat into the lambda zip and import each other by their module name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import schema  # noqa: E402 isort:skip
+from decoder import decode_params  # noqa: E402 isort:skip
+
+# a typical page view sent by the web tracking client
+PARAMS = {
+    "idsite": "1",
+    "rec": "1",
+    "r": "448318",
+    "h": "14",
+    "m": "33",
+    "s": "11",
+    "url": "http://127.0.0.1:1234/",
+    "_id": "5b4d4d3f82c5e2d1",
+    "_idts": "1586169210",
+    "_idvc": "3",
+    "_idn": "0",
+    "_refts": "0",
+    "_viewts": "1586175191",
+    "send_image": "0",
+    "pdf": "1",
+    "qt": "0",
+    "realp": "0",
+    "wma": "0",
+    "dir": "0",
+    "fla": "0",
+    "java": "0",
+    "gears": "0",
+    "ag": "0",
+    "cookie": "1",
+    "res": "1920x1080",
+    "gt_ms": "12",
+    "pv_id": "Zo7ZdA",
+    "action_name": "StreamSteam Web Tracking Demo",
+    "cdt": "1586176391",
+}
+
+
+def decode_params_legacy(post_data, query_str_data=None):
+    query_str_data = query_str_data or {}
+    event_out = {}
+    for param in schema.INCOMING:
+        if param.name_in in post_data:
+            event_out[param.name_out] = post_data[param.name_in]
+        elif param.name_in in query_str_data:
+            event_out[param.name_out] = query_str_data[param.name_in]
+
+        # cast values
+        if param.name_out in event_out:
+            if param.type == bool:
+                event_out[param.name_out] = bool(int(event_out[param.name_out]))
+            elif param.type == int:
+                if event_out[param.name_out] == "":
+                    event_out[param.name_out] = None
+                else:
+                    event_out[param.name_out] = int(event_out[param.name_out])
+            else:
+                event_out[param.name_out] = param.type(event_out[param.name_out])
+    return event_out
+
+
+def main(number=100000):
+    assert decode_params_legacy(PARAMS) == decode_params(PARAMS)[0]
+
+    legacy = min(timeit.repeat(lambda: decode_params_legacy(PARAMS), number=number, repeat=3)) / number
+    compiled = min(timeit.repeat(lambda: decode_params(PARAMS), number=number, repeat=3)) / number
+    print(f"legacy loop:    {legacy * 1e6:8.2f} us/event")
+    print(f"compiled table: {compiled * 1e6:8.2f} us/event")
+    print(f"speedup:        {legacy / compiled:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""
+Offline load test of the event receiver lambda_handler. Synthesises API Gateway proxy events, drives the handler
+in-process with a stubbed Firehose client and stubbed lookup backends and reports events/sec, per stage latency
+percentiles and the peak RSS.
+
+e.g. python engine/matomo_event_receiver/benchmarks/bench_receiver.py --requests 2000 --json report.json
+     python engine/matomo_event_receiver/benchmarks/bench_receiver.py --baseline report.json --max-regression 10
+     python engine/matomo_event_receiver/benchmarks/bench_receiver.py --replay captured_events.jsonl
+     python engine/matomo_event_receiver/benchmarks/bench_receiver.py --metrics
+     python engine/matomo_event_receiver/benchmarks/bench_receiver.py --cold-cache --lookup-latency-ms 20 \
+        --shared-cache-latency-ms 5
+"""
+import argparse
+import functools
+import importlib
+import json
+import os
+import random
+import resource
+import sys
+import time
+from collections import defaultdict
+from urllib.parse import urlencode
+
+RECEIVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# set before the handler is imported, clients are created at import time
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "eu-central-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "DELIVERY_STREAM_NAME": "benchmark",
+    "S3_BUCKET": "benchmark",
+    "ENRICHMENT_MODE": "sync",
+    "DEVICE_DETECTION_ENABLED": "true",
+    "IP_GEOCODING_ENABLED": "true",
+}
+
+BULK_SIZE = 50
+
+USER_AGENT_TEMPLATES = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{major}.0.{minor}.0 "
+    "Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_{major}) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+    "Version/13.{minor} Safari/605.1.15",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 13_{major} like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+    "Version/13.0 Mobile/15E148 Safari/604.{minor}",
+    "Mozilla/5.0 (Linux; Android 10; SM-G9{major}F) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/80.0.{minor}.0 Mobile Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:{major}.0) Gecko/20100101 Firefox/{major}.{minor}",
+    "Mozilla/5.0 (compatible; Googlebot/2.{major}; +http://www.google.com/bot.html)",
+]
+
+GEO_INFO = {
+    "ip": None,
+    "hostname": None,
+    "city": "Munich",
+    "region": "Bavaria",
+    "country": "DE",
+    "loc": {"latitude": 48.1374, "longitude": 11.5755},
+    "org": "AS3320 Deutsche Telekom AG",
+    "postal": "80331",
+    "timezone": "Europe/Berlin",
+}
+
+
+class StubFirehose:
+    def __init__(self):
+        self.records = 0
+        self.bytes = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.records += len(Records)
+        self.bytes += sum(len(record["Data"]) for record in Records)
+        return {"FailedPutCount": 0, "RequestResponses": [{"RecordId": "benchmark"} for _ in Records]}
+
+
+class StubBackend:
+    """
+    lookup backend without I/O, latency_ms simulates a remote provider
+    """
+
+    def __init__(self, name, result, remote, latency_ms=0):
+        self.name = name
+        self.remote = remote
+        self.result = result
+        self.latency = latency_ms / 1000
+
+    def lookup(self, key):
+        if self.latency:
+            time.sleep(self.latency)
+        return dict(self.result)
+
+
+class EventFactory:
+    def __init__(self, ua_cardinality, ip_cardinality, seed=42):
+        self.random = random.Random(seed)
+        self.user_agents = [
+            USER_AGENT_TEMPLATES[index % len(USER_AGENT_TEMPLATES)].format(major=index % 20, minor=index)
+            for index in range(ua_cardinality)
+        ]
+        self.ips = [
+            f"{self.random.randint(1, 223)}.{self.random.randint(0, 255)}.{self.random.randint(0, 255)}."
+            f"{self.random.randint(1, 254)}"
+            for _ in range(ip_cardinality)
+        ]
+
+    def params(self):
+        return {
+            "idsite": str(self.random.randint(1, 5)),
+            "rec": "1",
+            "r": str(self.random.randint(100000, 999999)),
+            "url": f"https://example.com/page/{self.random.randint(1, 500)}",
+            "urlref": "https://www.google.com/",
+            "_id": f"{self.random.getrandbits(64):016x}",
+            "_idts": str(1586169210 + self.random.randint(0, 86400)),
+            "_idvc": str(self.random.randint(1, 20)),
+            "_viewts": "1586175191",
+            "send_image": "0",
+            "pdf": "1",
+            "cookie": "1",
+            "res": self.random.choice(["1920x1080", "1440x900", "375x812"]),
+            "gt_ms": str(self.random.randint(5, 500)),
+            "pv_id": f"{self.random.getrandbits(24):06x}",
+            "action_name": "StreamSteam Load Test",
+            "cdt": str(1586176391 + self.random.randint(0, 3600)),
+        }
+
+    def _event(self, method, query, body):
+        return {
+            "resource": "/matomo-event-receiver",
+            "path": "/matomo-event-receiver",
+            "httpMethod": method,
+            "headers": {"Accept-Language": "de-DE,de;q=0.9,en;q=0.8", "Content-Type": "application/json"},
+            "queryStringParameters": query,
+            "body": body,
+            "isBase64Encoded": False,
+            "requestContext": {
+                "identity": {
+                    "userAgent": self.random.choice(self.user_agents),
+                    "sourceIp": self.random.choice(self.ips),
+                },
+                "requestTime": "06/Apr/2020:09:07:05 +0000",
+            },
+        }
+
+    def get(self):
+        return self._event("GET", self.params(), None)
+
+    def post(self):
+        return self._event("POST", None, json.dumps({"requests": [f"?{urlencode(self.params())}"]}))
+
+    def bulk(self):
+        return self._event(
+            "POST", None, json.dumps({"requests": [f"?{urlencode(self.params())}" for _ in range(BULK_SIZE)]})
+        )
+
+
+SCENARIOS = ["get", "post", "bulk"]
+
+
+def load_handler(environment):
+    os.environ.update(environment)
+    sys.path.insert(0, RECEIVER_PATH)
+    # "lambda" is a keyword => import by name
+    return importlib.import_module("lambda")
+
+
+class StageTimer:
+    """
+    wraps module attributes, durations are recorded per call
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self._patched = []
+
+    def wrap(self, owner, attribute, stage):
+        func = getattr(owner, attribute)
+
+        @functools.wraps(func)
+        def _timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.durations[stage].append(time.perf_counter() - start)
+
+        setattr(owner, attribute, _timed)
+        self._patched.append((owner, attribute, func))
+
+    def restore(self):
+        for owner, attribute, func in reversed(self._patched):
+            setattr(owner, attribute, func)
+        self._patched = []
+
+
+def percentiles(durations):
+    durations = sorted(durations)
+
+    def _at(fraction):
+        return durations[min(len(durations) - 1, int(len(durations) * fraction))] * 1e6
+
+    return {"calls": len(durations), "p50_us": _at(0.5), "p90_us": _at(0.9), "p99_us": _at(0.99)}
+
+
+def run_scenario(handler, events, cold_cache=False):
+    import enrichment
+
+    timer = StageTimer()
+
+    # pass 1: throughput of the unmodified handler
+    start = time.perf_counter()
+    for event in events:
+        if cold_cache:
+            enrichment.LOOKUP_CACHE.clear()
+        handler.lambda_handler(event, None)
+    elapsed = time.perf_counter() - start
+    events_count = handler.firehose_client.records
+
+    # pass 2: per stage latencies, wrapping adds some overhead => not part of the throughput
+    import delivery
+
+    timer.wrap(handler, "parse_requests", "parse")
+    timer.wrap(handler, "decode_event", "decode")
+    timer.wrap(enrichment, "enrich_events", "enrich")
+    timer.wrap(handler, "validate_event", "validate")
+    timer.wrap(handler.CODEC, "dumps_line", "serialize")
+    timer.wrap(delivery.FirehoseDelivery, "put", "deliver")
+    invocations = []
+    try:
+        for event in events:
+            if cold_cache:
+                enrichment.LOOKUP_CACHE.clear()
+            invocation_start = time.perf_counter()
+            handler.lambda_handler(event, None)
+            invocations.append(time.perf_counter() - invocation_start)
+    finally:
+        timer.restore()
+
+    stages = {stage: percentiles(durations) for stage, durations in timer.durations.items()}
+    stages["invocation"] = percentiles(invocations)
+    return {
+        "requests": len(events),
+        "events": events_count,
+        "seconds": elapsed,
+        "events_per_sec": events_count / elapsed,
+        "stages": stages,
+    }
+
+
+def metric_percentiles(records):
+    """
+    per invocation timings of the embedded metric format records, same units as the stage percentiles
+    """
+    durations = defaultdict(list)
+    for record in records:
+        for metric in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]:
+            if metric["Unit"] == "Milliseconds":
+                durations[metric["Name"]].append(record[metric["Name"]] / 1000)
+    return {name: percentiles(values) for name, values in sorted(durations.items())}
+
+
+def peak_rss_mib():
+    # linux reports KiB, macOS bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="default: all scenarios")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario")
+    parser.add_argument("--ua-cardinality", type=int, default=200, help="distinct user agents")
+    parser.add_argument("--ip-cardinality", type=int, default=5000, help="distinct ips")
+    parser.add_argument("--lookup-latency-ms", type=float, default=0, help="simulated latency of remote lookups")
+    parser.add_argument(
+        "--local-backends", action="store_true", help="use the local device detection backend instead of a stub"
+    )
+    parser.add_argument(
+        "--cold-cache", action="store_true", help="clear the per container lookup cache before every request"
+    )
+    parser.add_argument(
+        "--shared-cache-latency-ms",
+        type=float,
+        help="enable the shared lookup cache, local stand-in with this latency per batch request",
+    )
+    parser.add_argument("--replay", help="json lines file of captured API Gateway events, replaces the scenarios")
+    parser.add_argument(
+        "--env", action="append", default=[], help="additional environment e.g. --env SKIP_NONE_FIELDS=true"
+    )
+    parser.add_argument(
+        "--metrics", action="store_true", help="enable the handler metrics, reports the per invocation timings"
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_path", help="write the report to this file")
+    parser.add_argument("--baseline", help="report of a previous run, exit with 1 if throughput regressed")
+    parser.add_argument("--max-regression", type=float, default=10, help="allowed throughput regression in percent")
+    args = parser.parse_args()
+
+    environment = dict(ENVIRONMENT)
+    environment.update(kv.split("=", 1) for kv in args.env)
+    if args.metrics:
+        environment["METRICS_ENABLED"] = "true"
+    handler = load_handler(environment)
+    handler.firehose_client = StubFirehose()
+
+    import enrichment
+
+    if args.local_backends:
+        import device_detection
+
+        enrichment.LOOKUP_BACKENDS["user_agent"] = device_detection.LocalBackend()
+    else:
+        enrichment.LOOKUP_BACKENDS["user_agent"] = StubBackend(
+            "stub-device", {"type": "browser", "name": "Chrome"}, True, args.lookup_latency_ms
+        )
+    enrichment.LOOKUP_BACKENDS["ip"] = StubBackend("stub-geo", GEO_INFO, True, args.lookup_latency_ms)
+    if args.shared_cache_latency_ms is not None:
+        import shared_cache
+
+        enrichment.SHARED_CACHE = shared_cache.LocalSharedCache(
+            ttl=enrichment.LOOKUP_CACHE_TTL, latency_ms=args.shared_cache_latency_ms
+        )
+
+    if args.replay:
+        with open(args.replay) as fh:
+            workloads = {"replay": [json.loads(line) for line in fh if line.strip()]}
+    else:
+        factory = EventFactory(args.ua_cardinality, args.ip_cardinality, args.seed)
+        workloads = {
+            scenario: [getattr(factory, scenario)() for _ in range(args.requests)]
+            for scenario in args.scenario or SCENARIOS
+        }
+
+    report = {"python": sys.version.split()[0], "codec": handler.CODEC.name, "scenarios": {}}
+    for name, events in workloads.items():
+        handler.firehose_client = StubFirehose()
+        enrichment.LOOKUP_CACHE.clear()
+        if enrichment.SHARED_CACHE is not None:
+            enrichment.SHARED_CACHE.clear()
+        if args.metrics:
+            from metrics import MemorySink
+
+            handler.metrics.sink = MemorySink()
+        result = run_scenario(handler, events, args.cold_cache)
+        if args.metrics:
+            result["metrics"] = metric_percentiles(handler.metrics.sink.records)
+        report["scenarios"][name] = result
+
+        print(
+            f"{name}: {result['requests']} requests, {result['events']} events, {result['events_per_sec']:.0f} events/s"
+        )
+        for stage, stats in result["stages"].items():
+            print(
+                f"  {stage:10s} calls {stats['calls']:7d}  p50 {stats['p50_us']:9.1f} us  "
+                f"p90 {stats['p90_us']:9.1f} us  p99 {stats['p99_us']:9.1f} us"
+            )
+        for metric, stats in result.get("metrics", {}).items():
+            print(
+                f"  {metric:22s} p50 {stats['p50_us']:9.1f} us  "
+                f"p90 {stats['p90_us']:9.1f} us  p99 {stats['p99_us']:9.1f} us"
+            )
+    report["peak_rss_mib"] = peak_rss_mib()
+    print(f"peak RSS {report['peak_rss_mib']:.1f} MiB")
+
+    if args.json_path:
+        with open(args.json_path, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        regressed = False
+        for name, result in report["scenarios"].items():
+            if name not in baseline["scenarios"]:
+                continue
+            baseline_rate = baseline["scenarios"][name]["events_per_sec"]
+            change = (result["events_per_sec"] - baseline_rate) / baseline_rate * 100
+            print(f"{name}: {change:+.1f}% vs. baseline ({baseline_rate:.0f} events/s)")
+            if change < -args.max_regression:
+                regressed = True
+        if regressed:
+            print(f"throughput regressed by more than {args.max_regression}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
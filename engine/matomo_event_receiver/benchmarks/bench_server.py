@@ -0,0 +1,172 @@
+"""
+Load test of the self-hosted ingestion server. Starts the server with a local sink, client processes send the
+synthesised requests of bench_receiver.py over keep-alive connections, reports requests/sec, events/sec and the
+request latency percentiles.
+
+e.g. python engine/matomo_event_receiver/benchmarks/bench_server.py --workers 4 --clients 8 --requests 20000
+"""
+import argparse
+import gzip
+import http.client
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from bench_receiver import EventFactory, peak_rss_mib, percentiles
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+
+from engine import ingestion_server, local_server  # noqa: E402 isort:skip
+
+ENVIRONMENT = {
+    "S3_BUCKET": local_server.LOCAL_BUCKET,
+    "DELIVERY_STREAM_NAME": local_server.DELIVERY_STREAM_NAME,
+    "ENRICHMENT_MODE": "sync",
+    "IP_ADDRESS_MASKING_ENABLED": "true",
+    # no network => built-in device detection, no geolocation
+    "DEVICE_DETECTION_ENABLED": "true",
+    "DEVICE_DETECTION_BACKEND": "local",
+    "IP_GEOCODING_ENABLED": "false",
+}
+
+PREFIX_EXPRESSION = "events/enriched/dt=!{timestamp:yyyy-MM-dd}/hour=!{timestamp:HH}/"
+
+
+def http_requests(factory, scenario, count):
+    """
+    the api gateway events of the factory as (method, url, body, headers)
+    """
+    requests = []
+    for _ in range(count):
+        event = getattr(factory, scenario)()
+        url = event["path"]
+        if event["queryStringParameters"]:
+            url += f"?{urlencode(event['queryStringParameters'])}"
+        headers = dict(
+            event["headers"],
+            **{
+                "User-Agent": event["requestContext"]["identity"]["userAgent"],
+                "X-Forwarded-For": event["requestContext"]["identity"]["sourceIp"],
+            },
+        )
+        body = event["body"].encode("utf-8") if event["body"] else None
+        requests.append((event["httpMethod"], url, body, headers))
+    return requests
+
+
+def _client(address, requests, results):
+    connection = http.client.HTTPConnection(*address)
+    latencies, errors = [], 0
+    for method, url, body, headers in requests:
+        start = time.perf_counter()
+        connection.request(method, url, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors += 1
+    connection.close()
+    results.put((latencies, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="server processes")
+    parser.add_argument("--clients", type=int, default=4, help="client processes, one connection each")
+    parser.add_argument("--requests", type=int, default=5000, help="requests in total")
+    parser.add_argument("--scenario", choices=["get", "post", "bulk"], default="get")
+    parser.add_argument("--ua-cardinality", type=int, default=200, help="distinct user agents")
+    parser.add_argument("--ip-cardinality", type=int, default=5000, help="distinct ips")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_path", help="write the report to this file")
+    args = parser.parse_args()
+
+    factory = EventFactory(args.ua_cardinality, args.ip_cardinality, args.seed)
+    requests = http_requests(factory, args.scenario, args.requests)
+    events_per_request = len(json.loads(requests[0][2])["requests"]) if requests[0][2] else 1
+
+    output_path = tempfile.mkdtemp(prefix="bench-server-")
+    server = ingestion_server.IngestionServer(
+        ENVIRONMENT,
+        ingestion_server.local_sink(output_path, PREFIX_EXPRESSION, buffer_size_mb=64, buffer_seconds=60),
+        port=0,
+        workers=args.workers,
+        trust_forwarded_for=True,
+    )
+    server.start()
+    # warm up: every worker loads the receiver
+    time.sleep(2)
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    step = args.clients
+    clients = [
+        context.Process(target=_client, args=(server.address, requests[index::step], results))
+        for index in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    latencies, errors = [], 0
+    for _ in clients:
+        client_latencies, client_errors = results.get()
+        latencies.extend(client_latencies)
+        errors += client_errors
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.join()
+
+    drain_start = time.perf_counter()
+    server.stop()
+    drain_seconds = time.perf_counter() - drain_start
+
+    objects, events_written = count_written(output_path)
+    report = {
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "workers": server.workers,
+        "clients": args.clients,
+        "scenario": args.scenario,
+        "requests": len(latencies),
+        "errors": errors,
+        "events": len(latencies) * events_per_request,
+        "seconds": elapsed,
+        "requests_per_sec": len(latencies) / elapsed,
+        "events_per_sec": len(latencies) * events_per_request / elapsed,
+        "latency": percentiles(latencies),
+        "drain_seconds": drain_seconds,
+        "objects_written": objects,
+        "events_written": events_written,
+        "peak_rss_mib": peak_rss_mib(),
+    }
+    print(
+        f"{report['scenario']}: {report['workers']} workers, {report['clients']} clients, {report['requests']} requests "
+        f"({report['errors']} errors), {report['requests_per_sec']:.0f} requests/s, "
+        f"{report['events_per_sec']:.0f} events/s"
+    )
+    latency = report["latency"]
+    print(f"  latency p50 {latency['p50_us']:.0f} us  p90 {latency['p90_us']:.0f} us  p99 {latency['p99_us']:.0f} us")
+    print(f"  drained in {drain_seconds:.2f}s, {events_written} events in {objects} objects written to {output_path}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+
+def count_written(path):
+    objects, events = 0, 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            objects += 1
+            if file_name.endswith(".gz"):
+                with gzip.open(os.path.join(dir_path, file_name)) as fh:
+                    events += sum(1 for _ in fh)
+    return objects, events
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Microbenchmark of the fast path timestamp parsers vs. the dateutil / strptime based parsing they replaced
+
+e.g. python engine/matomo_event_receiver/benchmarks/bench_timestamps.py
+"""
+import os
+import sys
+import timeit
+from datetime import datetime, timezone
+
+from dateutil.parser import parse as date_parse
+
+# the receiver modules are deployed flat into the lambda zip and import each other by their module name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import timestamps  # noqa: E402 isort:skip
+
+REQUEST_TIME = "06/Apr/2020:09:07:05 +0000"
+SAMPLES = {
+    "unix seconds": "1586164025",
+    "iso-8601": "2020-04-06T09:07:05+00:00",
+    "iso-8601 Z": "2020-04-06T09:07:05Z",
+    "api gw requestTime": None,
+}
+
+
+def event_datetime_legacy(event_datetime, request_time):
+    if event_datetime:
+        if event_datetime.isnumeric():
+            event_datetime = datetime.fromtimestamp(int(event_datetime))
+        else:
+            event_datetime = date_parse(event_datetime)
+    if event_datetime is None:
+        event_datetime = datetime.strptime(request_time, "%d/%b/%Y:%H:%M:%S %z")
+    event_datetime = event_datetime.astimezone(timezone.utc).replace(tzinfo=None)
+    return event_datetime.astimezone(timezone.utc).replace(tzinfo=None).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def event_datetime_fast(event_datetime, request_time):
+    parsed = None
+    if event_datetime:
+        parsed = timestamps.parse(event_datetime)
+    if parsed is None:
+        parsed = timestamps.parse_request_time(request_time)
+    return timestamps.format_utc(parsed)
+
+
+def main(number=20000):
+    for name, sample in SAMPLES.items():
+        assert event_datetime_legacy(sample, REQUEST_TIME) == event_datetime_fast(sample, REQUEST_TIME), name
+
+        legacy = min(timeit.repeat(lambda: event_datetime_legacy(sample, REQUEST_TIME), number=number, repeat=3))
+        fast = min(timeit.repeat(lambda: event_datetime_fast(sample, REQUEST_TIME), number=number, repeat=3))
+        print(
+            f"{name:20} legacy: {legacy / number * 1e6:7.2f} us  fast: {fast / number * 1e6:7.2f} us  "
+            f"speedup: {legacy / fast:6.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
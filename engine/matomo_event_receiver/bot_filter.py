@@ -0,0 +1,135 @@
+import ipaddress
+import os
+import socket
+from bisect import bisect_right
+
+import s3_sink
+from codec import CODEC
+from device_detection import CRAWLER_TOKENS, compile_crawler_pattern
+
+BOT_FILTER_MODES = ("off", "drop", "route")
+# routed bot events, written by s3_sink like the dead letters
+BOTS_PREFIX = os.environ.get("BOTS_PREFIX", "events/bots/")
+# one CIDR per line, # comments e.g. the ranges published by the search engines
+IP_RANGES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "bot_ip_ranges.txt")
+# ::ffff:0:0/96
+IPV4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+
+
+def parse_ip_ranges(lines):
+    """
+    e.g. ["66.249.64.0/27  # googlebot", "", "2001:4860:4801:10::/64"] => [IPv4Network(...), IPv6Network(...)]
+    """
+    networks = []
+    for line in lines:
+        line = line.partition("#")[0].strip()
+        if line:
+            networks.append(ipaddress.ip_network(line, strict=False))
+    return networks
+
+
+class IpRanges:
+    """
+    Sorted, merged (first, last) address intervals per ip version, a lookup is one bisect
+    """
+
+    def __init__(self, networks):
+        self._starts, self._ends = {}, {}
+        for version in (4, 6):
+            intervals = sorted(
+                (int(network.network_address), int(network.broadcast_address))
+                for network in networks
+                if network.version == version
+            )
+            merged = []
+            for first, last in intervals:
+                if merged and first <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], last)
+                else:
+                    merged.append([first, last])
+            self._starts[version] = [first for first, _ in merged]
+            self._ends[version] = [last for _, last in merged]
+
+    def __len__(self):
+        return sum(len(starts) for starts in self._starts.values())
+
+    def __contains__(self, ip):
+        # inet_pton is about five times faster than ipaddress.ip_address
+        for version, family in ((4, socket.AF_INET), (6, socket.AF_INET6)):
+            try:
+                packed = socket.inet_pton(family, ip)
+                break
+            except OSError:
+                continue
+        else:
+            return False
+        # e.g. ::ffff:66.249.70.1 of dual stack sockets => the ipv4 ranges, like geolocation.LocalBackend.lookup
+        if version == 6 and packed.startswith(IPV4_MAPPED_PREFIX):
+            # the last 4 of the 16 bytes
+            version, packed = 4, packed[-4:]
+        address = int.from_bytes(packed, "big")
+        position = bisect_right(self._starts[version], address) - 1
+        return position >= 0 and address <= self._ends[version][position]
+
+
+class BotFilter:
+    """
+    Detects crawlers by their user agent (the crawler tokens of the device detection) and by ip ranges before any
+    lookup is done => bots cost no device detection and geolocation requests.
+    """
+
+    def __init__(self, ip_ranges=None):
+        self.crawler_pattern = compile_crawler_pattern(CRAWLER_TOKENS)
+        self.ip_ranges = ip_ranges or IpRanges([])
+
+    def category(self, event):
+        """
+        :return: crawler category e.g. "search-engine", "ip-range" or None for other clients
+        """
+        user_agent = event.get("user_agent")
+        if user_agent:
+            crawler_match = self.crawler_pattern.search(user_agent.lower())
+            if crawler_match:
+                return CRAWLER_TOKENS[crawler_match.group(0)]
+        if event.get("ip") and event["ip"] in self.ip_ranges:
+            return "ip-range"
+        return None
+
+    def split(self, events):
+        """
+        :return: events of other clients, bot records {"category": ..., "event": ...}
+        """
+        events_out, bots = [], []
+        for event in events:
+            category = self.category(event)
+            if category is None:
+                events_out.append(event)
+            else:
+                bots.append({"category": category, "event": event})
+        return events_out, bots
+
+
+def write_bots(bots):
+    return s3_sink.put(BOTS_PREFIX, CODEC.dumps_lines(bots, default=str))
+
+
+def load_ip_ranges(path=IP_RANGES_PATH):
+    """
+    BOT_IP_RANGES (comma separated CIDRs) and the ranges of path if it exists
+    """
+    lines = (os.environ.get("BOT_IP_RANGES") or "").split(",")
+    if path and os.path.exists(path):
+        with open(path) as fh:
+            lines.extend(fh)
+    return IpRanges(parse_ip_ranges(lines))
+
+
+def get_bot_filter(mode):
+    """
+    off => None, every event is enriched
+    """
+    if mode not in BOT_FILTER_MODES:
+        raise ValueError(f"Unknown bot filter mode '{mode}', choose one of {', '.join(BOT_FILTER_MODES)}")
+    if mode == "off":
+        return None
+    return BotFilter(load_ip_ranges())
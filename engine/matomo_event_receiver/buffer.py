@@ -0,0 +1,258 @@
+import logging
+import os
+import struct
+import tempfile
+import time
+import uuid
+from collections import deque
+
+from delivery import MAX_BATCH_BYTES, MAX_BATCH_RECORDS, MAX_RECORD_BYTES, DeliveryError
+
+DEFAULT_MAX_AGE_SECONDS = 1
+DEFAULT_MAX_MEMORY_BYTES = 64 * 1024 * 1024
+# lambda provides 512 MB /tmp
+DEFAULT_MAX_SPILL_BYTES = 256 * 1024 * 1024
+# flush everything when less time is left in the invocation
+DEFAULT_DEADLINE_MARGIN_MS = 1000
+
+RETRY_BACKOFF_BASE_SECONDS = 0.1
+RETRY_BACKOFF_MAX_SECONDS = 30
+# a forced flush waits between its attempts, at most this long per wait
+FORCE_MAX_ATTEMPTS = 6
+FORCE_BACKOFF_MAX_SECONDS = 2
+
+# spill files: every record is prefixed by its length
+FRAME_HEADER = struct.Struct(">I")
+
+logger = logging.getLogger()
+
+
+class BufferFull(Exception):
+    """
+    memory and spill limit reached, the downstream is slower than the producer => callers should reject or retry later
+    """
+
+
+class BoundedBuffer:
+    """
+    Collects records and hands them in batches to flush_func as soon as the pending records reach max_records,
+    max_bytes or max_age_seconds, whichever comes first. The buffer is the only retry layer: a failing flush keeps
+    its records, they are retried after an exponential backoff, a forced flush waits and retries up to
+    FORCE_MAX_ATTEMPTS times. Records above max_memory_bytes are spilled to files below spill_dir, add raises
+    BufferFull if memory and spill limit are reached. Not thread safe.
+
+    :param flush_func: called with a list of records, at most max_records / max_bytes e.g. FirehoseDelivery.put.
+        A DeliveryError keeps its records only, the other records of the batch count as delivered
+    :param context: lambda context, see set_context
+    """
+
+    def __init__(
+        self,
+        flush_func,
+        max_records=MAX_BATCH_RECORDS,
+        max_bytes=MAX_BATCH_BYTES,
+        max_age_seconds=DEFAULT_MAX_AGE_SECONDS,
+        max_record_bytes=MAX_RECORD_BYTES,
+        max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES,
+        max_spill_bytes=DEFAULT_MAX_SPILL_BYTES,
+        spill_dir=None,
+        deadline_margin_ms=DEFAULT_DEADLINE_MARGIN_MS,
+        context=None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.flush_func = flush_func
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.max_record_bytes = max_record_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.max_spill_bytes = max_spill_bytes
+        self.spill_dir = spill_dir or tempfile.gettempdir()
+        self.deadline_margin_ms = deadline_margin_ms
+        self.context = context
+        self.clock = clock
+        self.sleep = sleep
+        self._deadline_flushed = False
+        # records handed to flush_func successfully
+        self.flushed = 0
+        self._records = deque()
+        self._memory_bytes = 0
+        # oldest first: (path, records count, bytes)
+        self._segments = deque()
+        self._spilled_records = 0
+        self._spilled_bytes = 0
+        self._oldest_at = None
+        self._retry_at = 0
+        self._failures = 0
+
+    def __len__(self):
+        return len(self._records) + self._spilled_records
+
+    @property
+    def pending_bytes(self):
+        return self._memory_bytes + self._spilled_bytes
+
+    @property
+    def pressure(self):
+        """
+        share of memory and spill limit in use, 1 => add raises BufferFull
+        """
+        return self.pending_bytes / (self.max_memory_bytes + self.max_spill_bytes)
+
+    def set_context(self, context):
+        """
+        lambda context of the current invocation => everything is flushed before the invocation times out
+        """
+        self.context = context
+        self._deadline_flushed = False
+
+    def add(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if len(data) > self.max_record_bytes:
+            raise ValueError(f"Record exceeds the record size limit of {self.max_record_bytes} bytes")
+        if self.pending_bytes + len(data) > self.max_memory_bytes + self.max_spill_bytes:
+            raise BufferFull(f"{len(self)} records ({self.pending_bytes} bytes) not flushed yet")
+
+        if self._oldest_at is None:
+            self._oldest_at = self.clock()
+        self._records.append(data)
+        self._memory_bytes += len(data)
+        if self._memory_bytes > self.max_memory_bytes:
+            self._spill()
+
+        if self._deadline_near():
+            # once, what is added afterwards is flushed when due or by the caller at the end of the invocation
+            self._deadline_flushed = True
+            self.flush(force=True)
+        elif self.due():
+            self.flush()
+
+    def due(self):
+        if not len(self) or self.clock() < self._retry_at:
+            return False
+        return (
+            len(self) >= self.max_records
+            or self.pending_bytes >= self.max_bytes
+            or self.clock() - self._oldest_at >= self.max_age_seconds
+        )
+
+    def _deadline_near(self):
+        if self.context is None or self._deadline_flushed:
+            return False
+        return self.context.get_remaining_time_in_millis() <= self.deadline_margin_ms
+
+    def flush(self, force=False):
+        """
+        flushes batches as long as they are due, force => all records e.g. at the end of an invocation or on shutdown
+        :return: number of records flushed
+        """
+        flushed = 0
+        attempts = 0
+        while len(self) and (force or self.due()):
+            from_segment = bool(self._segments)
+            batch = self._read_segment(self._segments[0][0]) if from_segment else self._memory_batch()
+            try:
+                self.flush_func(batch)
+                undelivered, error = [], None
+            except DeliveryError as e:
+                undelivered, error = e.records, e
+            except Exception as e:
+                undelivered, error = batch, e
+
+            self._remove(batch, from_segment)
+            # the undelivered records are the oldest => first of the next batch
+            self._records.extendleft(reversed(undelivered))
+            self._memory_bytes += sum(len(record) for record in undelivered)
+            delivered = len(batch) - len(undelivered)
+            flushed += delivered
+            self.flushed += delivered
+            if error is None:
+                self._failures, self._retry_at = 0, 0
+                continue
+
+            self._failures += 1
+            attempts += 1
+            backoff = min(RETRY_BACKOFF_BASE_SECONDS * 2 ** (self._failures - 1), RETRY_BACKOFF_MAX_SECONDS)
+            self._retry_at = self.clock() + backoff
+            if not force:
+                logger.warning(
+                    f"{len(undelivered)} records not flushed, retry in {backoff}s: {error.__class__.__name__}"
+                )
+                return flushed
+            if attempts >= FORCE_MAX_ATTEMPTS:
+                raise error
+            self.sleep(min(backoff, FORCE_BACKOFF_MAX_SECONDS))
+
+        if not len(self):
+            self._oldest_at = None
+        return flushed
+
+    def discard(self):
+        """
+        drops the pending records and removes their spill files e.g. after a failed invocation, the records are lost
+        :return: number of records dropped
+        """
+        discarded = len(self)
+        for path, _, _ in self._segments:
+            try:
+                os.remove(path)
+            except OSError:
+                logger.warning(f"spill file {path} not removed")
+        self._segments.clear()
+        self._spilled_records, self._spilled_bytes = 0, 0
+        self._records.clear()
+        self._memory_bytes = 0
+        self._oldest_at = None
+        return discarded
+
+    def _remove(self, batch, from_segment):
+        if from_segment:
+            path, count, segment_bytes = self._segments.popleft()
+            os.remove(path)
+            self._spilled_records -= count
+            self._spilled_bytes -= segment_bytes
+        else:
+            for _ in batch:
+                self._memory_bytes -= len(self._records.popleft())
+
+    def _memory_batch(self):
+        # records stay in the buffer until the flush succeeded
+        batch, batch_bytes = [], 0
+        for record in self._records:
+            if len(batch) == self.max_records or (batch and batch_bytes + len(record) > self.max_bytes):
+                break
+            batch.append(record)
+            batch_bytes += len(record)
+        return batch
+
+    def _spill(self):
+        # oldest records first, one segment per batch => a segment is flushed with one flush_func call
+        while self._memory_bytes > self.max_memory_bytes:
+            batch = self._memory_batch()
+            batch_bytes = sum(len(record) for record in batch)
+            path = os.path.join(self.spill_dir, f"stream-steam-buffer-{os.getpid()}-{uuid.uuid4().hex}.spill")
+            with open(path, "wb") as fh:
+                for record in batch:
+                    fh.write(FRAME_HEADER.pack(len(record)))
+                    fh.write(record)
+            for _ in batch:
+                self._records.popleft()
+            self._memory_bytes -= batch_bytes
+            self._segments.append((path, len(batch), batch_bytes))
+            self._spilled_records += len(batch)
+            self._spilled_bytes += batch_bytes
+
+    @staticmethod
+    def _read_segment(path):
+        with open(path, "rb") as fh:
+            data = fh.read()
+        records, offset = [], 0
+        while offset < len(data):
+            (length,) = FRAME_HEADER.unpack_from(data, offset)
+            offset += FRAME_HEADER.size
+            end = offset + length
+            records.append(data[offset:end])
+            offset = end
+        return records
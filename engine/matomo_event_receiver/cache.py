@@ -0,0 +1,69 @@
+import time
+from collections import Counter, OrderedDict
+
+DEFAULT_MAX_ENTRIES = 10000
+
+# cached result of a lookup without result e.g. a private ip => the key is not looked up again until it expires
+NOT_FOUND = object()
+
+
+class LookupCache:
+    """
+    Bounded LRU cache for lookup results, shared by multiple namespaces e.g. user_agent and ip.
+
+    :param max_entries: max number of entries over all namespaces, least recently used entries are evicted first
+    :param ttl: seconds an entry stays valid per namespace e.g. {"ip": 86400}, namespaces without ttl never expire
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl or {}
+        self.clock = clock
+        self.hits = Counter()
+        self.misses = Counter()
+        self.evictions = Counter()
+        # (namespace, key) => (expires_at, value)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, namespace, key):
+        entry = self._entries.get((namespace, key))
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at is None or expires_at > self.clock():
+                self._entries.move_to_end((namespace, key))
+                self.hits[namespace] += 1
+                return value
+            # stale
+            del self._entries[(namespace, key)]
+            self.evictions[namespace] += 1
+        self.misses[namespace] += 1
+        return None
+
+    def set(self, namespace, key, value, ttl=None):
+        """
+        :param ttl: overrides the ttl of the namespace e.g. for NOT_FOUND entries
+        """
+        if ttl is None:
+            ttl = self.ttl.get(namespace)
+        expires_at = self.clock() + ttl if ttl is not None else None
+        self._entries[(namespace, key)] = (expires_at, value)
+        self._entries.move_to_end((namespace, key))
+
+        while len(self._entries) > self.max_entries:
+            (evicted_namespace, _), _ = self._entries.popitem(last=False)
+            self.evictions[evicted_namespace] += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self, namespace):
+        hits, misses = self.hits[namespace], self.misses[namespace]
+        return {
+            "hits": hits,
+            "misses": misses,
+            "evictions": self.evictions[namespace],
+            "hit_ratio": hits / (hits + misses) if hits + misses else None,
+        }
@@ -0,0 +1,73 @@
+import json
+import os
+
+
+class StdlibCodec:
+    """
+    json of the standard library, compact separators
+    """
+
+    name = "stdlib"
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(separators=(",", ":"), allow_nan=False)
+        self._encoder_default_str = json.JSONEncoder(separators=(",", ":"), default=str)
+        self.loads = json.loads
+
+    def dumps_line(self, obj):
+        return f"{self._encoder.encode(obj)}\n".encode("utf-8")
+
+    def dumps_lines(self, objs, default=None):
+        encode = self._encoder_default_str.encode if default is str else self._encoder.encode
+        return "".join([f"{encode(obj)}\n" for obj in objs]).encode("utf-8")
+
+
+class OrjsonCodec:
+    """
+    https://github.com/ijl/orjson, serializes straight to utf-8 bytes. Non finite floats are written as null,
+    events are validated before they are serialized.
+    """
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self._dumps = orjson.dumps
+        self._option = orjson.OPT_APPEND_NEWLINE
+        self.loads = orjson.loads
+
+    def dumps_line(self, obj):
+        return self._dumps(obj, option=self._option)
+
+    def dumps_lines(self, objs, default=None):
+        dumps, option = self._dumps, self._option
+        lines = []
+        for obj in objs:
+            try:
+                lines.append(dumps(obj, default=default, option=option))
+            except TypeError:
+                # e.g. ints beyond 64 bit in dead letters => stdlib json, which has no such limits
+                lines.append(f"{json.dumps(obj, separators=(',', ':'), default=default)}\n".encode("utf-8"))
+        return b"".join(lines)
+
+
+CODECS = {codec.name: codec for codec in (StdlibCodec, OrjsonCodec)}
+
+
+def get_codec(name="auto"):
+    """
+    auto => orjson if installed, stdlib otherwise
+    """
+    if name == "auto":
+        try:
+            return OrjsonCodec()
+        except ImportError:
+            return StdlibCodec()
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown json codec '{name}', choose one of auto, {', '.join(CODECS)}")
+
+
+CODEC = get_codec(os.environ.get("JSON_CODEC", "auto"))
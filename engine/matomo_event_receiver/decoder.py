@@ -0,0 +1,87 @@
+import math
+from collections import Counter
+
+import schema
+
+# matomo clients send flags as 0 / 1 => precomputed
+BOOL_VALUES = {"0": False, "1": True}
+
+
+def _cast_bool(value):
+    try:
+        return BOOL_VALUES[value]
+    except KeyError:
+        return bool(int(value))
+
+
+# values outside 64 bit can not be serialized by orjson, the validator checks the range of the schema
+INT64_MIN, INT64_MAX = -(2 ** 63), 2 ** 63 - 1
+
+
+def _cast_int(value):
+    if value == "":
+        return None
+    value = int(value)
+    if not INT64_MIN <= value <= INT64_MAX:
+        raise ValueError(f"{value} exceeds 64 bit")
+    return value
+
+
+def _cast_float(value):
+    value = float(value)
+    # float accepts nan and inf, neither can be stored as a double of the table
+    if not math.isfinite(value):
+        raise ValueError(f"{value} is not a finite number")
+    return value
+
+
+# values arrive as str => no cast required for str fields
+CASTERS = {str: None, bool: _cast_bool, int: _cast_int, float: _cast_float}
+
+
+def compile_incoming(fields):
+    """
+    compiles an incoming schema into a lookup table incoming param => (name out, caster, priority)
+    e.g. {"idsite": ("site_id", None, None), "r": ("random_part", _cast_int, None), ...}
+
+    params mapped to the same name out e.g. ip and cip get a priority, the field defined last in the schema wins
+    """
+    name_out_counts = Counter(field.name_out for field in fields)
+    return {
+        field.name_in: (
+            field.name_out,
+            CASTERS.get(field.type, field.type),
+            priority if name_out_counts[field.name_out] > 1 else None,
+        )
+        for priority, field in enumerate(fields)
+    }
+
+
+DECODER = compile_incoming(schema.INCOMING)
+
+
+def decode_params(params, decoder=DECODER):
+    """
+    maps incoming params to readable ones and casts the values, only params present are visited
+    e.g. {"idsite": "1", "r": "x"} => ({"site_id": "1"}, {"random_part": "invalid literal for int()..."})
+    :return: decoded values, cast errors per field
+    """
+    decoded, errors, priorities = {}, {}, {}
+    for name_in, value in params.items():
+        entry = decoder.get(name_in)
+        if entry is None:
+            continue
+        name_out, cast, priority = entry
+        if priority is not None:
+            if priorities.get(name_out, -1) > priority:
+                continue
+            priorities[name_out] = priority
+
+        if cast is None:
+            decoded[name_out] = value
+            continue
+        try:
+            decoded[name_out] = cast(value)
+        except (TypeError, ValueError) as e:
+            errors[name_out] = str(e)
+    return decoded, errors
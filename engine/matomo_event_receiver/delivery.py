@@ -0,0 +1,80 @@
+# see https://docs.aws.amazon.com/firehose/latest/APIReference/API_PutRecordBatch.html
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+MAX_RECORD_BYTES = 1000 * 1024
+
+
+class DeliveryError(RuntimeError):
+    """
+    :param records: not delivered, the other records of the put are delivered => retry these only
+    """
+
+    def __init__(self, message, records):
+        super().__init__(message)
+        self.records = records
+
+
+class FirehoseDelivery:
+    """
+    Accumulates records and delivers them to a Firehose delivery stream via put_record_batch. One attempt per batch,
+    records Firehose rejects (FailedPutCount > 0) are raised with a DeliveryError => retried by the caller
+    e.g. buffer.BoundedBuffer, records already accepted are never sent twice.
+    """
+
+    def __init__(self, firehose_client, delivery_stream_name):
+        self.firehose_client = firehose_client
+        self.delivery_stream_name = delivery_stream_name
+        self._records = []
+
+    def __len__(self):
+        # records not delivered yet
+        return len(self._records)
+
+    def add(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if len(data) > MAX_RECORD_BYTES:
+            raise ValueError(f"Record exceeds the Firehose record size limit of {MAX_RECORD_BYTES} bytes")
+        self._records.append(data)
+
+    def flush(self):
+        records, self._records = self._records, []
+        return self.put(records)
+
+    def put(self, records):
+        """
+        delivers records right away e.g. as flush_func of a buffer.BoundedBuffer
+        """
+        failed, errors = [], []
+        batches = list(self._batches(records))
+        for index, batch in enumerate(batches):
+            try:
+                response = self.firehose_client.put_record_batch(
+                    DeliveryStreamName=self.delivery_stream_name, Records=[{"Data": record} for record in batch]
+                )
+            except Exception as e:
+                # nothing of this and the following batches is delivered
+                not_delivered = failed + [record for remaining in batches[index:] for record in remaining]
+                raise DeliveryError(f"{len(not_delivered)} records not delivered: {e}", not_delivered) from e
+            if response["FailedPutCount"]:
+                # responses are in the same order as the records sent
+                for record, record_response in zip(batch, response["RequestResponses"]):
+                    if "ErrorCode" in record_response:
+                        failed.append(record)
+                        errors.append(record_response)
+        if failed:
+            raise DeliveryError(f"{len(failed)} records not delivered, first error: {errors[0]}", failed)
+        return len(records)
+
+    @staticmethod
+    def _batches(records):
+        # split records in chunks which respect the record count and payload size limits of put_record_batch
+        batch, batch_bytes = [], 0
+        for record in records:
+            if len(batch) == MAX_BATCH_RECORDS or batch_bytes + len(record) > MAX_BATCH_BYTES:
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(record)
+            batch_bytes += len(record)
+        if batch:
+            yield batch
@@ -0,0 +1,252 @@
+import os
+import re
+from collections import namedtuple
+
+from http_client import CircuitBreaker, get_json
+
+API_USERSTACK_ENDPOINT = "http://api.userstack.com/detect"
+
+OsRule = namedtuple("OsRule", ["pattern", "name", "code", "family", "family_code", "family_vendor"])
+DeviceRule = namedtuple("DeviceRule", ["pattern", "type", "brand", "brand_code", "name"])
+BrowserRule = namedtuple("BrowserRule", ["pattern", "name", "engine"])
+
+# rules are evaluated top down, first match wins
+# name templates are formatted with the named groups of the pattern e.g. {version}
+OS_RULES = [
+    OsRule(r"Windows NT 10\.0", "Windows 10", "windows_10", "Windows", "windows", "Microsoft Corporation."),
+    OsRule(r"Windows NT 6\.3", "Windows 8.1", "windows_8_1", "Windows", "windows", "Microsoft Corporation."),
+    OsRule(r"Windows NT 6\.2", "Windows 8", "windows_8", "Windows", "windows", "Microsoft Corporation."),
+    OsRule(r"Windows NT 6\.1", "Windows 7", "windows_7", "Windows", "windows", "Microsoft Corporation."),
+    OsRule(r"Windows", "Windows", "windows", "Windows", "windows", "Microsoft Corporation."),
+    OsRule(r"(?:iPhone|iPad|iPod).*? OS (?P<version>\d+)", "iOS {version}", "ios", "iOS", "ios", "Apple Inc."),
+    OsRule(r"Mac OS X (?P<version>\d+[._]\d+)", "macOS {version}", "macos", "macOS", "macos", "Apple Inc."),
+    OsRule(r"Android (?P<version>\d+(?:\.\d+)?)", "Android {version}", "android", "Android", "android", "Google Inc."),
+    OsRule(r"Android", "Android", "android", "Android", "android", "Google Inc."),
+    OsRule(r"CrOS", "Chrome OS", "chrome_os", "Chrome OS", "chrome_os", "Google Inc."),
+    OsRule(r"Linux", "Linux", "linux", "Linux", "linux", "Linux Foundation."),
+]
+
+DEVICE_RULES = [
+    DeviceRule(r"iPad", "tablet", "Apple", "apple", "iPad"),
+    DeviceRule(r"iPhone", "smartphone", "Apple", "apple", "iPhone"),
+    DeviceRule(r"iPod", "smartphone", "Apple", "apple", "iPod Touch"),
+    DeviceRule(r"Macintosh", "desktop", "Apple", "apple", "Mac"),
+    DeviceRule(r"Android.*(?:SM-|Samsung|SAMSUNG)", "smartphone", "Samsung", "samsung", "Galaxy"),
+    DeviceRule(r"Android.*Pixel", "smartphone", "Google", "google", "Pixel"),
+    DeviceRule(r"Android.*(?:HUAWEI|Huawei)", "smartphone", "Huawei", "huawei", "Smartphone"),
+    DeviceRule(r"Android.*(?:Redmi|Xiaomi|\bMi )", "smartphone", "Xiaomi", "xiaomi", "Smartphone"),
+    DeviceRule(r"Android.*Mobile", "smartphone", "Unknown", "unknown", "Smartphone"),
+    DeviceRule(r"Android", "tablet", "Unknown", "unknown", "Tablet"),
+    DeviceRule(r"Windows Phone|Mobile", "smartphone", "Unknown", "unknown", "Smartphone"),
+    DeviceRule(r"Windows|X11|CrOS|Linux", "desktop", "Unknown", "unknown", "Desktop"),
+]
+
+BROWSER_RULES = [
+    BrowserRule(r"Edge?/(?P<version>[\d.]+)", "Edge", "Blink"),
+    BrowserRule(r"(?:OPR|Opera)/(?P<version>[\d.]+)", "Opera", "Blink"),
+    BrowserRule(r"SamsungBrowser/(?P<version>[\d.]+)", "Samsung Internet", "Blink"),
+    BrowserRule(r"(?:Firefox|FxiOS)/(?P<version>[\d.]+)", "Firefox", "Gecko"),
+    BrowserRule(r"(?:Chrome|CriOS)/(?P<version>[\d.]+)", "Chrome", "WebKit/Blink"),
+    BrowserRule(r"Version/(?P<version>[\d.]+).*Safari/", "Safari", "WebKit"),
+    BrowserRule(r"(?:MSIE |Trident/.*rv:)(?P<version>[\d.]+)", "Internet Explorer", "Trident"),
+]
+
+# lowercase token => crawler category
+CRAWLER_TOKENS = {
+    "googlebot": "search-engine",
+    "adsbot-google": "search-engine",
+    "bingbot": "search-engine",
+    "yandexbot": "search-engine",
+    "baiduspider": "search-engine",
+    "duckduckbot": "search-engine",
+    "slurp": "search-engine",
+    "applebot": "search-engine",
+    "petalbot": "search-engine",
+    "uptimerobot": "monitoring",
+    "pingdom": "monitoring",
+    "statuscake": "monitoring",
+    "site24x7": "monitoring",
+    "ahrefsbot": "marketing",
+    "semrushbot": "marketing",
+    "mj12bot": "marketing",
+    "dotbot": "marketing",
+    "facebookexternalhit": "link-checker",
+    "twitterbot": "link-checker",
+    "linkedinbot": "link-checker",
+    "slackbot": "link-checker",
+    "telegrambot": "link-checker",
+    "feedfetcher": "feed-fetcher",
+    "headlesschrome": "tool",
+    "phantomjs": "tool",
+    "python-requests": "tool",
+    "curl/": "tool",
+    "wget/": "tool",
+    "crawler": "unknown",
+    "spider": "unknown",
+    "bot": "unknown",
+}
+# parts of names e.g. cubot (phones) or abbott => match whole words only
+GENERIC_CRAWLER_TOKENS = ("crawler", "spider", "bot")
+
+
+def _compile_rules(rules):
+    return [rule._replace(pattern=re.compile(rule.pattern)) for rule in rules]
+
+
+def _trie_pattern(node):
+    # e.g. {"b": {"o": {"t": {"": ""}}}, "i": ...}} => b(?:ot|ingbot), the greedy optional end => the longest token wins
+    # a non empty end is a guard the token has to pass e.g. for generic tokens
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items()) if char]
+    end = node.get("")
+    if not branches:
+        return end or ""
+    pattern = branches[0] if len(branches) == 1 and "" not in node else f"(?:{'|'.join(branches)})"
+    if "" not in node:
+        return pattern
+    return f"(?:{pattern}|{end})" if end else f"{pattern}?"
+
+
+def compile_crawler_pattern(tokens, generic_tokens=GENERIC_CRAWLER_TOKENS):
+    # the tokens as a trie instead of a flat alternation => at every position of the user agent only the tokens
+    # starting with its character are tried, an automaton over all tokens like Aho-Corasick
+    # match against the lowercased user agent, re.IGNORECASE is an order of magnitude slower
+    trie = {}
+    for token in tokens:
+        node = trie
+        for char in token:
+            node = node.setdefault(char, {})
+        # generic tokens: neither preceded nor followed by a word character, checked after the token matched =>
+        # no extra pass over the user agent
+        node[""] = rf"\b(?<!\w{re.escape(token)})" if token in generic_tokens else ""
+    return re.compile(_trie_pattern(trie))
+
+
+class UserstackBackend:
+    """
+    Device detection via the https://userstack.com API
+    """
+
+    name = "userstack"
+    remote = True
+
+    def __init__(self):
+        self.circuit_breaker = CircuitBreaker(self.name)
+
+    def lookup(self, user_agent):
+        response_json = get_json(
+            API_USERSTACK_ENDPOINT,
+            {"access_key": os.environ["USERSTACK_API_TOKEN"], "ua": user_agent},
+            circuit_breaker=self.circuit_breaker,
+        )
+        if "error" in response_json:
+            raise RuntimeError(f"User Agent Lookup not successful, response was: {response_json}")
+        return response_json
+
+
+class LocalBackend:
+    """
+    In-process, rule based user agent classifier. Fills the same structure as userstack (schema.DEVICE_INFO).
+    """
+
+    name = "local"
+    remote = False
+
+    os_rules = _compile_rules(OS_RULES)
+    device_rules = _compile_rules(DEVICE_RULES)
+    browser_rules = _compile_rules(BROWSER_RULES)
+    crawler_pattern = compile_crawler_pattern(CRAWLER_TOKENS)
+
+    @staticmethod
+    def _match(rules, user_agent):
+        for rule in rules:
+            match = rule.pattern.search(user_agent)
+            if match:
+                return rule, match.groupdict()
+        return None, {}
+
+    def lookup(self, user_agent):
+        device_info = {
+            "ua": user_agent,
+            "type": "unknown",
+            "brand": None,
+            "name": None,
+            "url": None,
+            "os": {
+                "name": None,
+                "code": None,
+                "url": None,
+                "family": None,
+                "family_code": None,
+                "family_vendor": None,
+                "icon": None,
+                "icon_large": None,
+            },
+            "device": {
+                "is_mobile_device": False,
+                "type": "unknown",
+                "brand": None,
+                "brand_code": None,
+                "brand_url": None,
+                "name": None,
+            },
+            "browser": {"name": None, "version": None, "version_major": None, "engine": None},
+            "crawler": {"is_crawler": False, "category": None, "last_seen": None},
+        }
+
+        crawler_match = self.crawler_pattern.search(user_agent.lower())
+        if crawler_match:
+            device_info["type"] = "crawler"
+            device_info["crawler"]["is_crawler"] = True
+            device_info["crawler"]["category"] = CRAWLER_TOKENS[crawler_match.group(0)]
+
+        os_rule, groups = self._match(self.os_rules, user_agent)
+        if os_rule:
+            version = (groups.get("version") or "").replace("_", ".")
+            device_info["os"].update(
+                {
+                    "name": os_rule.name.format(version=version),
+                    "code": os_rule.code,
+                    "family": os_rule.family,
+                    "family_code": os_rule.family_code,
+                    "family_vendor": os_rule.family_vendor,
+                }
+            )
+
+        device_rule, _ = self._match(self.device_rules, user_agent)
+        if device_rule:
+            device_info["device"].update(
+                {
+                    "is_mobile_device": device_rule.type in ("smartphone", "tablet"),
+                    "type": device_rule.type,
+                    "brand": device_rule.brand,
+                    "brand_code": device_rule.brand_code,
+                    "name": device_rule.name,
+                }
+            )
+
+        browser_rule, groups = self._match(self.browser_rules, user_agent)
+        if browser_rule:
+            version = groups.get("version")
+            device_info["browser"].update(
+                {
+                    "name": browser_rule.name,
+                    "version": version,
+                    "version_major": version.split(".")[0] if version else None,
+                    "engine": browser_rule.engine,
+                }
+            )
+            device_info["name"] = browser_rule.name
+            if not crawler_match:
+                device_info["type"] = "mobile-browser" if device_info["device"]["is_mobile_device"] else "browser"
+
+        return device_info
+
+
+BACKENDS = {backend.name: backend for backend in (UserstackBackend, LocalBackend)}
+
+
+def get_backend(name):
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown device detection backend '{name}', choose one of {', '.join(BACKENDS)}")
@@ -0,0 +1,54 @@
+import base64
+import os
+
+from codec import CODEC
+from enrichment import enrich_events
+from validator import dead_letter, validate_event, write_dead_letters
+
+SKIP_NONE_FIELDS = os.environ.get("SKIP_NONE_FIELDS") == "true"
+
+
+def lambda_handler(event_in, context):
+    """
+    Kinesis Firehose data transformation, enriches the raw events written by the event receiver in batches.
+    see https://docs.aws.amazon.com/firehose/latest/dev/data-transformation.html
+    """
+    records_out = {}
+    events = []
+    record_ids = []
+    for record in event_in["records"]:
+        try:
+            event = CODEC.loads(base64.b64decode(record["data"]))
+        except ValueError:
+            # not recoverable => let firehose write the record to the error output prefix
+            records_out[record["recordId"]] = {
+                "recordId": record["recordId"],
+                "result": "ProcessingFailed",
+                "data": record["data"],
+            }
+        else:
+            events.append(event)
+            record_ids.append(record["recordId"])
+
+    # failed lookups leave device_info / geo_info empty, the events are delivered without them
+    enrich_events(events)
+
+    dead_letters = []
+    for record_id, event in zip(record_ids, events):
+        validated, errors = validate_event(event, skip_none=SKIP_NONE_FIELDS)
+        if errors:
+            # written to the dead letter prefix => dropped from the delivery stream
+            dead_letters.append(dead_letter(event, errors))
+            records_out[record_id] = {"recordId": record_id, "result": "Dropped", "data": ""}
+            continue
+        records_out[record_id] = {
+            "recordId": record_id,
+            "result": "Ok",
+            "data": base64.b64encode(CODEC.dumps_line(validated)).decode("ascii"),
+        }
+
+    if dead_letters:
+        write_dead_letters(dead_letters)
+
+    # firehose expects the records in the order received
+    return {"records": [records_out[record["recordId"]] for record in event_in["records"]]}
@@ -0,0 +1,226 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import shared_cache
+from cache import DEFAULT_MAX_ENTRIES, NOT_FOUND, LookupCache
+from metrics import NULL_METRICS
+
+# namespace => backend, created on first use => only enabled backends are imported and initialized
+LOOKUP_BACKENDS = {}
+
+# bounded pool for remote lookups, user agent and ip lookups of a batch are fanned out together
+LOOKUP_MAX_WORKERS = int(os.environ.get("LOOKUP_MAX_WORKERS", 8))
+_EXECUTOR = None
+
+logger = logging.getLogger()
+
+# geo data of an ip may change over time => shorter ttl
+LOOKUP_CACHE_TTL = {
+    "user_agent": int(os.environ.get("LOOKUP_CACHE_TTL_USER_AGENT", 7 * 24 * 60 * 60)),
+    "ip": int(os.environ.get("LOOKUP_CACHE_TTL_IP", 24 * 60 * 60)),
+}
+# keys without lookup result e.g. private ips
+LOOKUP_CACHE_TTL_NEGATIVE = int(os.environ.get("LOOKUP_CACHE_TTL_NEGATIVE", 60 * 60))
+
+# 1st tier: per container lookup cache
+LOOKUP_CACHE = LookupCache(
+    max_entries=int(os.environ.get("LOOKUP_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)), ttl=LOOKUP_CACHE_TTL
+)
+
+# 2nd tier: shared by all containers, survives cold starts e.g. dynamodb, off => None
+SHARED_CACHE = shared_cache.get_shared_cache(
+    os.environ.get("SHARED_CACHE", "off"), ttl=LOOKUP_CACHE_TTL, negative_ttl=LOOKUP_CACHE_TTL_NEGATIVE
+)
+
+# backend lookup failed => the key is not cached and looked up again
+LOOKUP_FAILED = object()
+
+
+def _executor():
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(max_workers=LOOKUP_MAX_WORKERS)
+    return _EXECUTOR
+
+
+class UnavailableBackend:
+    """
+    Stands in for a backend that could not be created e.g. the local geo database is missing => the events are stored
+    without the info instead of failing
+    """
+
+    remote = False
+
+    def __init__(self, name):
+        self.name = name
+
+    def lookup(self, key):
+        return LOOKUP_FAILED
+
+
+def _create_backend(namespace):
+    if namespace == "user_agent":
+        import device_detection
+
+        return device_detection.get_backend(os.environ.get("DEVICE_DETECTION_BACKEND", "userstack"))
+    import geolocation
+
+    return geolocation.get_backend(os.environ.get("GEOLOCATION_BACKEND", "ipinfo"))
+
+
+def get_backend(namespace):
+    if namespace not in LOOKUP_BACKENDS:
+        try:
+            LOOKUP_BACKENDS[namespace] = _create_backend(namespace)
+        except Exception:
+            logger.exception(f"{namespace} lookup backend not available, events are stored without the info")
+            LOOKUP_BACKENDS[namespace] = UnavailableBackend(namespace)
+    return LOOKUP_BACKENDS[namespace]
+
+
+def _lookup(backend, key):
+    # a failing or slow provider must not stall the ingestion => event is stored without the info
+    try:
+        return backend.lookup(key)
+    except Exception as e:
+        # exception messages of remote backends may contain the request url including the api token
+        logger.warning(f"{backend.name} lookup failed for {key}: {e.__class__.__name__}")
+        return LOOKUP_FAILED
+
+
+def _shared_get(misses):
+    # an unavailable shared cache must not stall the ingestion => the backends are asked instead
+    try:
+        return SHARED_CACHE.get_many((namespace, key) for namespace, keys in misses.items() for key in keys)
+    except Exception as e:
+        logger.warning(f"shared lookup cache get failed: {e.__class__.__name__}: {e}")
+        return {}
+
+
+def _shared_put(entries):
+    try:
+        SHARED_CACHE.put_many(entries)
+    except Exception as e:
+        logger.warning(f"shared lookup cache put failed: {e.__class__.__name__}: {e}")
+
+
+def _remember(namespace, key, result, entries):
+    """
+    caches a backend result in the 1st tier and collects it for the write behind to the 2nd tier
+    :param entries: None => the result is not written to the 2nd tier
+    :return: the result, None if the lookup failed or found nothing
+    """
+    if result is LOOKUP_FAILED:
+        return None
+    if result is None:
+        LOOKUP_CACHE.set(namespace, key, NOT_FOUND, ttl=LOOKUP_CACHE_TTL_NEGATIVE)
+        result_cached = NOT_FOUND
+    else:
+        LOOKUP_CACHE.set(namespace, key, result)
+        result_cached = result
+    if entries is not None:
+        entries[(namespace, key)] = result_cached
+    return result
+
+
+def lookup(keys, metrics=NULL_METRICS):
+    """
+    resolves the given keys per namespace: per container cache, shared cache, backends
+    remote lookups of cache misses run concurrently. The shared cache is used for remote backends only, a local lookup
+    is faster than the round trip to the shared cache
+    e.g. {"user_agent": {"Mozilla/5.0 ..."}, "ip": {"1.2.3.4"}} => {"user_agent": {"Mozilla/5.0 ...": {...}}, "ip": {...}}
+    metrics: lookup_<namespace> is the time until all backend lookups of the namespace are resolved
+    """
+    results = {namespace: {} for namespace in keys}
+
+    # 1st tier
+    misses = {}
+    for namespace, namespace_keys in keys.items():
+        namespace_misses = misses[namespace] = set()
+        for key in namespace_keys:
+            cached = LOOKUP_CACHE.get(namespace, key)
+            if cached is None:
+                namespace_misses.add(key)
+            else:
+                results[namespace][key] = None if cached is NOT_FOUND else cached
+
+    # 2nd tier, one batch get for the misses of all namespaces with remote backends
+    shared_misses = {}
+    if SHARED_CACHE is not None:
+        shared_misses = {
+            namespace: namespace_misses
+            for namespace, namespace_misses in misses.items()
+            if namespace_misses and get_backend(namespace).remote
+        }
+    if shared_misses:
+        with metrics.timer("shared_cache_get"):
+            shared = _shared_get(shared_misses)
+        for (namespace, key), cached in shared.items():
+            if cached is NOT_FOUND:
+                LOOKUP_CACHE.set(namespace, key, NOT_FOUND, ttl=LOOKUP_CACHE_TTL_NEGATIVE)
+                results[namespace][key] = None
+            else:
+                LOOKUP_CACHE.set(namespace, key, cached)
+                results[namespace][key] = cached
+            misses[namespace].discard(key)
+        if metrics.enabled:
+            for namespace in shared_misses:
+                metrics.put(f"shared_cache_hits_{namespace}", sum(1 for hit in shared if hit[0] == namespace))
+
+    # backends
+    entries = {}
+    futures = []
+    started, finished = {}, {}
+    for namespace, namespace_misses in misses.items():
+        if not namespace_misses:
+            continue
+        if metrics.enabled:
+            started[namespace] = metrics.clock()
+        backend = get_backend(namespace)
+        for key in namespace_misses:
+            if backend.remote:
+                futures.append((namespace, key, _executor().submit(_lookup, backend, key)))
+            else:
+                results[namespace][key] = _remember(namespace, key, _lookup(backend, key), None)
+        if metrics.enabled:
+            finished[namespace] = metrics.clock()
+
+    for namespace, key, future in futures:
+        results[namespace][key] = _remember(namespace, key, future.result(), entries)
+        if metrics.enabled:
+            finished[namespace] = metrics.clock()
+
+    for namespace, finished_at in finished.items():
+        metrics.add_timing(f"lookup_{namespace}", finished_at - started[namespace])
+
+    # write behind => the response does not wait for the shared cache. A frozen container finishes the write on its
+    # next invocation.
+    if SHARED_CACHE is not None and entries:
+        _executor().submit(_shared_put, entries)
+    return results
+
+
+def enrich_events(events, metrics=NULL_METRICS):
+    """
+    adds device_info and geo_info to a batch of events, every distinct user agent and ip is resolved once
+    """
+    # events may come without user_agent / ip keys if SKIP_NONE_FIELDS is enabled
+    keys = {}
+    if os.environ.get("DEVICE_DETECTION_ENABLED") == "true":
+        keys["user_agent"] = {event.get("user_agent") for event in events} - {None, ""}
+    if os.environ.get("IP_GEOCODING_ENABLED") == "true":
+        keys["ip"] = {event.get("ip") for event in events} - {None, ""}
+    if not keys:
+        return events
+
+    results = lookup(keys, metrics)
+    for event in events:
+        # Device lookup
+        if "user_agent" in results:
+            event["device_info"] = results["user_agent"].get(event.get("user_agent"))
+        # IP lookup
+        if "ip" in results:
+            event["geo_info"] = results["ip"].get(event.get("ip"))
+
+    return events
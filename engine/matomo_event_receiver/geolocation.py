@@ -0,0 +1,193 @@
+import csv
+import io
+import ipaddress
+import json
+import mmap
+import os
+import struct
+
+API_IPINFO_ENDPOINT = "https://ipinfo.io"
+
+DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "geo.db")
+
+# Database layout, all values big endian:
+# header          magic, number of IPv4 ranges, number of IPv6 ranges, number of locations
+# IPv4 ranges     sorted by start: start ip (uint32), end ip (uint32), location index (uint32)
+# IPv6 ranges     sorted by start: start ip (16 bytes), end ip (16 bytes), location index (uint32)
+# offsets         number of locations + 1 offsets (uint32) into the locations blob
+# locations blob  utf-8 encoded json objects e.g. {"city": "Munich", ..., "loc": "48.1374,11.5755"}
+DATABASE_MAGIC = b"SSGEODB1"
+HEADER = struct.Struct(">8sIII")
+RANGE_V4 = struct.Struct(">III")
+RANGE_V6 = struct.Struct(">16s16sI")
+OFFSET = struct.Struct(">I")
+
+LOCATION_FIELDS = ["city", "region", "country", "loc", "org", "postal", "timezone"]
+
+
+def split_loc(geo_info):
+    # split lon lat string in coords
+    # e.g "48.1374,11.5755" => [latitude=48.1374, longitude=11.5755]
+    long_lat_str = geo_info.get("loc") or ""
+    if "," in long_lat_str:
+        latitude, longitude = long_lat_str.split(",")
+        geo_info["loc"] = {"latitude": float(latitude), "longitude": float(longitude)}
+    else:
+        geo_info["loc"] = {
+            "latitude": None,
+            "longitude": None,
+        }
+    return geo_info
+
+
+class IPInfoBackend:
+    """
+    IP geolocation via the https://ipinfo.io API
+    """
+
+    name = "ipinfo"
+    remote = True
+
+    def __init__(self):
+        # imported on use, the cli imports this module for the database tools outside of the lambda package
+        from http_client import CircuitBreaker, get_json
+
+        self.circuit_breaker = CircuitBreaker(self.name)
+        self._get_json = get_json
+
+    def lookup(self, ip):
+        response_json = self._get_json(
+            f"{API_IPINFO_ENDPOINT}/{ip}",
+            {"token": os.environ["IP_INFO_API_TOKEN"]},
+            circuit_breaker=self.circuit_breaker,
+        )
+        return split_loc(response_json)
+
+
+class LocalBackend:
+    """
+    IP geolocation backed by a memory mapped range database, see write_database for the layout.
+    Lookups are binary searches over the sorted ranges, pages are loaded lazily by the OS.
+    """
+
+    name = "local"
+    remote = False
+
+    def __init__(self, path=None):
+        path = path or os.environ.get("GEO_DATABASE_PATH") or DATABASE_PATH
+        with io.open(path, "rb") as fh:
+            self._db = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._v4_count, self._v6_count, self._locations_count = HEADER.unpack_from(self._db, 0)
+        if magic != DATABASE_MAGIC:
+            raise ValueError(f"{path} is not a geo database")
+        self._v4_offset = HEADER.size
+        self._v6_offset = self._v4_offset + self._v4_count * RANGE_V4.size
+        self._offsets_offset = self._v6_offset + self._v6_count * RANGE_V6.size
+        self._locations_offset = self._offsets_offset + (self._locations_count + 1) * OFFSET.size
+
+    def _search(self, ip_key, ranges_offset, ranges_count, range_struct):
+        # find the last range starting at or before ip_key
+        low, high = 0, ranges_count
+        while low < high:
+            middle = (low + high) // 2
+            start = range_struct.unpack_from(self._db, ranges_offset + middle * range_struct.size)[0]
+            if start <= ip_key:
+                low = middle + 1
+            else:
+                high = middle
+        if not low:
+            return None
+
+        _, end, location_index = range_struct.unpack_from(self._db, ranges_offset + (low - 1) * range_struct.size)
+        if ip_key > end:
+            return None
+        return location_index
+
+    def _location(self, location_index):
+        start, end = struct.unpack_from(">II", self._db, self._offsets_offset + location_index * OFFSET.size)
+        start, end = self._locations_offset + start, self._locations_offset + end
+        return json.loads(self._db[start:end])
+
+    def lookup(self, ip):
+        ip_address = ipaddress.ip_address(ip)
+        if ip_address.version == 6 and ip_address.ipv4_mapped:
+            ip_address = ip_address.ipv4_mapped
+
+        if ip_address.version == 4:
+            location_index = self._search(int(ip_address), self._v4_offset, self._v4_count, RANGE_V4)
+        else:
+            location_index = self._search(ip_address.packed, self._v6_offset, self._v6_count, RANGE_V6)
+
+        geo_info = {"ip": ip, "hostname": None}
+        geo_info.update(dict.fromkeys(LOCATION_FIELDS))
+        if location_index is not None:
+            geo_info.update(self._location(location_index))
+        return split_loc(geo_info)
+
+
+def write_database(path, ranges):
+    """
+    :param ranges: iterable of (start ip, end ip, location dict) e.g. ("1.0.0.0", "1.0.0.255", {"country": "AU"})
+    """
+    v4_ranges, v6_ranges = [], []
+    locations, location_indexes = [], {}
+
+    for start_ip, end_ip, location in ranges:
+        start_ip, end_ip = ipaddress.ip_address(start_ip), ipaddress.ip_address(end_ip)
+        if start_ip.version != end_ip.version:
+            raise ValueError(f"IP versions of range {start_ip} - {end_ip} differ")
+
+        location_blob = json.dumps({k: location.get(k) for k in LOCATION_FIELDS}, sort_keys=True).encode("utf-8")
+        if location_blob not in location_indexes:
+            location_indexes[location_blob] = len(locations)
+            locations.append(location_blob)
+
+        if start_ip.version == 4:
+            v4_ranges.append((int(start_ip), int(end_ip), location_indexes[location_blob]))
+        else:
+            v6_ranges.append((start_ip.packed, end_ip.packed, location_indexes[location_blob]))
+
+    with io.open(path, "wb") as fh:
+        fh.write(HEADER.pack(DATABASE_MAGIC, len(v4_ranges), len(v6_ranges), len(locations)))
+        for v4_range in sorted(v4_ranges):
+            fh.write(RANGE_V4.pack(*v4_range))
+        for v6_range in sorted(v6_ranges):
+            fh.write(RANGE_V6.pack(*v6_range))
+
+        offset = 0
+        fh.write(OFFSET.pack(offset))
+        for location_blob in locations:
+            offset += len(location_blob)
+            fh.write(OFFSET.pack(offset))
+        for location_blob in locations:
+            fh.write(location_blob)
+
+    return len(v4_ranges) + len(v6_ranges)
+
+
+def write_database_from_csv(csv_path, path):
+    """
+    builds the database from a csv file with the header
+    start_ip,end_ip,city,region,country,latitude,longitude,org,postal,timezone
+    """
+
+    def _ranges(reader):
+        for row in reader:
+            location = {k: row.get(k) or None for k in LOCATION_FIELDS}
+            if row.get("latitude") and row.get("longitude"):
+                location["loc"] = f"{row['latitude']},{row['longitude']}"
+            yield row["start_ip"], row["end_ip"], location
+
+    with io.open(csv_path, newline="", encoding="utf-8") as fh:
+        return write_database(path, _ranges(csv.DictReader(fh)))
+
+
+BACKENDS = {backend.name: backend for backend in (IPInfoBackend, LocalBackend)}
+
+
+def get_backend(name):
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown geolocation backend '{name}', choose one of {', '.join(BACKENDS)}")
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (float(os.environ.get("LOOKUP_CONNECT_TIMEOUT", 1)), float(os.environ.get("LOOKUP_READ_TIMEOUT", 2)))
+POOL_MAXSIZE = int(os.environ.get("LOOKUP_MAX_WORKERS", 8))
+
+# module level => connections are kept alive and reused across invocations of a warm container
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    # requests is imported on first use, containers with local lookup backends only never pay for the import
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            _session = requests.Session()
+            _session.mount("http://", HTTPAdapter(pool_maxsize=POOL_MAXSIZE))
+            _session.mount("https://", HTTPAdapter(pool_maxsize=POOL_MAXSIZE))
+    return _session
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails fast after failure_threshold consecutive failures. After reset_timeout seconds one trial call is let
+    through, the circuit closes again if it succeeds.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def _acquire(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self.clock() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"Circuit {self.name} is open, skipping call")
+            # half open => let this call through, block others until it finished
+            self.opened_at = self.clock()
+
+    def call(self, func, *args, **kwargs):
+        self._acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = self.clock()
+            raise
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+        return result
+
+
+def get_json(url, params=None, circuit_breaker=None):
+    def _get():
+        response = get_session().get(url, params=params, timeout=TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+    if circuit_breaker:
+        return circuit_breaker.call(_get)
+    return _get()
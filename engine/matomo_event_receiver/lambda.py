@@ -1,29 +1,74 @@
-import json
+import logging
 import os
-from collections import defaultdict
-from datetime import datetime, timezone
-from urllib.parse import parse_qsl, urlparse
+from urllib.parse import parse_qsl
 
 import boto3
-import requests
-import schema
-from anonymizeip import anonymize_ip
-from dateutil.parser import parse as date_parse
-
+import timestamps
+from buffer import BoundedBuffer
+from codec import CODEC
+from decoder import decode_params
+from delivery import FirehoseDelivery
+from metrics import get_metrics
+from sampling import get_sampler
+from validator import dead_letter, validate_event, write_dead_letters
+
+# created at init => the client setup is part of the cold start, not of the first request
 firehose_client = boto3.client("firehose")
-s3_client = boto3.client("s3")
 
-API_USERSTACK_ENDPOINT = "http://api.userstack.com/detect"
-API_IPINFO_ENDPOINT = "https://ipinfo.io"
+logger = logging.getLogger()
 
+# opt-in per stage timings, lookup cache and batch stats as embedded metric format log lines, METRICS_ENABLED=true
+metrics = get_metrics()
 
-LOOKUP_CACHE = {
-    "user_agent": defaultdict(dict),
-    "ip": defaultdict(dict),
-}
+# fields without value are left out of the enriched events
+SKIP_NONE_FIELDS = os.environ.get("SKIP_NONE_FIELDS") == "true"
 
+# crawlers are dropped or routed to BOTS_PREFIX before the enrichment, None => bots are enriched like other clients
+BOT_FILTER_MODE = os.environ.get("BOT_FILTER_MODE") or "off"
 
-def lambda_handler(event_in, context):
+
+def get_bot_filter(mode):
+    # bot_filter imports device_detection which compiles its rule tables => not part of the cold start if off
+    if mode == "off":
+        return None
+    from bot_filter import get_bot_filter
+
+    return get_bot_filter(mode)
+
+
+def write_bots(bots):
+    from bot_filter import write_bots
+
+    return write_bots(bots)
+
+
+bot_filter = get_bot_filter(BOT_FILTER_MODE)
+
+# per site / event category sample rates and the site rate limit, None => all events are kept
+sampler = get_sampler()
+
+
+def parse_requests(event_in):
+    """
+    returns the params of every request contained in event_in, e.g. a Matomo bulk POST
+    {"requests": ["?idsite=1&action_name=foo", "?idsite=1&action_name=bar"]}
+    => [{"idsite": "1", "action_name": "foo"}, {"idsite": "1", "action_name": "bar"}]
+    """
+    query_str_data = event_in.get("queryStringParameters", {}) or {}
+    if event_in.get("body") is None:
+        return [query_str_data]
+
+    requests_data = []
+    for request in CODEC.loads(event_in["body"])["requests"]:
+        # post data takes precedence over query string params
+        # e.g. "?idsite=1&action_name=foo" => "idsite=1&action_name=foo", same as urlparse(request).query
+        request_data = dict(query_str_data)
+        request_data.update(parse_qsl(request.partition("?")[2].partition("#")[0]))
+        requests_data.append(request_data)
+    return requests_data
+
+
+def decode_event(event_in, request_data):
     event_out = {
         "user_agent": event_in["requestContext"]["identity"]["userAgent"],
         "ip": event_in["requestContext"]["identity"]["sourceIp"],
@@ -31,122 +76,142 @@ def lambda_handler(event_in, context):
         "geo_info": None,
     }
 
-    # extract post data
-    post_data = {}
-    if event_in.get("body") is not None:
-        post_data = json.loads(event_in["body"])["requests"][0]
-        post_data = dict(parse_qsl(urlparse(post_data).query))
-
     # map incoming event_in params to readable ones and cast values - simple sanity checks... ;)
-    query_str_data = event_in.get("queryStringParameters", {}) or {}
-    for param in schema.INCOMING:
-        if param.name_in in post_data:
-            event_out[param.name_out] = post_data[param.name_in]
-        elif param.name_in in query_str_data:
-            event_out[param.name_out] = query_str_data[param.name_in]
-
-        # cast values
-        if param.name_out in event_out:
-            if param.type == bool:
-                event_out[param.name_out] = bool(int(event_out[param.name_out]))
-            elif param.type == int:
-                if event_out[param.name_out] == "":
-                    event_out[param.name_out] = None
-                else:
-                    event_out[param.name_out] = int(event_out[param.name_out])
-            else:
-                event_out[param.name_out] = param.type(event_out[param.name_out])
-
-    # Device lookup
-    device_detection_enabled = True if os.environ.get("DEVICE_DETECTION_ENABLED") == "true" else False
-    if device_detection_enabled and event_out["user_agent"]:
-        # cache hit?
-        cached = LOOKUP_CACHE["user_agent"][event_out["user_agent"]]
-        if cached:
-            device_info = cached
-        else:
-            response = requests.get(
-                API_USERSTACK_ENDPOINT,
-                {"access_key": os.environ["USERSTACK_API_TOKEN"], "ua": event_out["user_agent"]},
-            )
-            response.raise_for_status()
-            response_json = response.json()
-
-            if "error" in response_json:
-                raise RuntimeError(f"User Agent Lookup not successful, response was: {response_json}")
-            device_info = response_json
-            LOOKUP_CACHE["user_agent"][event_out["user_agent"]] = response_json
-        event_out["device_info"] = device_info
-
-    # mask ip address
-    if os.environ.get("IP_ADDRESS_MASKING_ENABLED") == "true":
-        event_out["ip"] = anonymize_ip(event_out["ip"])
-
-    # IP lookup
-    ip_geocoding_enabled = True if os.environ.get("IP_GEOCODING_ENABLED") == "true" else False
-    if ip_geocoding_enabled and event_out["ip"]:
-        # cache hit?
-        cached = LOOKUP_CACHE["ip"][event_out["ip"]]
-        if cached:
-            geo_info = cached
-        else:
-            response = requests.get(
-                f"{API_IPINFO_ENDPOINT}/{event_out['ip']}", params={"token": os.environ["IP_INFO_API_TOKEN"]},
-            )
-            response.raise_for_status()
-            response_json = response.json()
-
-            # split lon lat string in coords
-            # e.g "48.1374,11.5755" => [latitude=48.1374, longitude=11.5755]
-            long_lat_str = response_json.get("loc", "")
-            if "," in long_lat_str:
-                response_json["loc"] = {}
-                response_json["loc"]["latitude"], response_json["loc"]["longitude"] = long_lat_str.split(",")
-                response_json["loc"]["latitude"] = float(response_json["loc"]["latitude"])
-                response_json["loc"]["longitude"] = float(response_json["loc"]["longitude"])
-            else:
-                response_json["loc"] = {
-                    "latitude": None,
-                    "longitude": None,
-                }
-
-            LOOKUP_CACHE["ip"][event_out["ip"]] = response_json
-            geo_info = response_json
-
-        event_out["geo_info"] = geo_info
+    decoded, errors = decode_params(request_data)
+    event_out.update(decoded)
+    if errors:
+        logger.warning(f"invalid params, ignored: {errors}")
 
     # event_datetime handling
-    # 1. try to read from event
-    event_datetime = event_out.get("event_datetime")
-    if event_datetime:
-        if event_datetime.isnumeric():
-            # a) unix timestamp?
-            event_datetime = datetime.fromtimestamp(int(event_datetime))
-        else:
-            # b) try to parse string
-            event_datetime = date_parse(event_datetime)
-    # 2. Fallback if not set, use API Gateway requestTime
-    if event_datetime is None:
-        # use api gw info requestContext.requestTime
-        # e.g. '06/Apr/2020:09:07:05 +0000' => 2020-04-06T10:37:38+00:00
-        # parse
-        event_datetime = datetime.strptime(event_in["requestContext"]["requestTime"], "%d/%b/%Y:%H:%M:%S %z")
-
-    # to e.g. 2020-04-07T11:04.01.1586251321
-    event_datetime = event_datetime.astimezone(timezone.utc).replace(tzinfo=None)
-    event_out["event_datetime"] = (
-        event_datetime.astimezone(timezone.utc).replace(tzinfo=None).strftime("%Y-%m-%d %H:%M:%S")
-    )
+    with metrics.timer("datetime"):
+        # 1. try to read from event
+        event_datetime = None
+        if event_out.get("event_datetime"):
+            try:
+                event_datetime = timestamps.parse(event_out["event_datetime"])
+            except (ValueError, OverflowError) as e:
+                logger.warning(f"invalid event_datetime {event_out['event_datetime']}, ignored: {e}")
+        # 2. Fallback if not set, use API Gateway requestTime
+        if event_datetime is None:
+            # use api gw info requestContext.requestTime
+            # e.g. '06/Apr/2020:09:07:05 +0000' => 2020-04-06T10:37:38+00:00
+            event_datetime = timestamps.parse_request_time(event_in["requestContext"]["requestTime"])
+
+        # to e.g. 2020-04-07 11:04:01
+        event_out["event_datetime"] = timestamps.format_utc(event_datetime)
 
     # language handling
     if not event_out.get("language"):
         # fallback to HTTP Accept-Language
-        language = event_in.get("headers", {}).get("Accept-Language")
+        language = (event_in.get("headers") or {}).get("Accept-Language")
         if language:
             event_out["language"] = language
 
-    # send event_to firehose
-    firehose_client.put_record(
-        DeliveryStreamName=os.environ["DELIVERY_STREAM_NAME"], Record={"Data": json.dumps(event_out) + "\n"},
-    )
+    return event_out
+
+
+def mask_ips(events_out):
+    from anonymizeip import anonymize_ip
+
+    for event_out in events_out:
+        if event_out["ip"]:
+            event_out["ip"] = anonymize_ip(event_out["ip"])
+    return events_out
+
+
+def process_event(event_in, delivery):
+    """
+    parses, enriches and validates the events of an API Gateway proxy event, valid records are added to delivery
+    :return: dead letters of the invalid events, bot records to route
+    """
+    with metrics.timer("parse"):
+        requests_data = parse_requests(event_in)
+    # includes the datetime handling
+    with metrics.timer("decode"):
+        events_out = [decode_event(event_in, request_data) for request_data in requests_data]
+    metrics.put("events", len(events_out))
+
+    # before the sampling and the enrichment => bots neither count for the site rate limit nor cost lookups
+    bots = []
+    if bot_filter is not None:
+        with metrics.timer("bot_filter"):
+            events_out, bots = bot_filter.split(events_out)
+        metrics.put("bots", len(bots))
+        if BOT_FILTER_MODE == "drop":
+            bots = []
+
+    # before the enrichment => dropped events cost no lookups
+    if sampler is not None:
+        with metrics.timer("sample"):
+            sampled = sampler.sample(events_out)
+        metrics.put("sampled_out", len(events_out) - len(sampled))
+        events_out = sampled
+
+    # mask ip address, always done by the receiver => raw ips are never written
+    if os.environ.get("IP_ADDRESS_MASKING_ENABLED") == "true":
+        with metrics.timer("anonymize"):
+            mask_ips(events_out)
+            mask_ips([bot["event"] for bot in bots])
+
+    # async mode: the raw events are enriched by the enricher lambda as firehose data transformation
+    if os.environ.get("ENRICHMENT_MODE", "sync") == "sync":
+        from enrichment import LOOKUP_CACHE, enrich_events
+
+        if metrics.enabled:
+            cache_stats = {namespace: LOOKUP_CACHE.stats(namespace) for namespace in ("user_agent", "ip")}
+        with metrics.timer("enrich"):
+            enrich_events(events_out, metrics)
+        if metrics.enabled:
+            metrics.put_cache_stats(LOOKUP_CACHE, cache_stats)
+
+    dead_letters = []
+    with metrics.timer("validate_serialize"):
+        for event_out in events_out:
+            validated, errors = validate_event(event_out, skip_none=SKIP_NONE_FIELDS)
+            if errors:
+                dead_letters.append(dead_letter(event_out, errors))
+                continue
+            delivery.add(CODEC.dumps_line(validated))
+    return dead_letters, bots
+
+
+def lambda_handler(event_in, context):
+    # the metrics of a failed invocation are emitted as well => nothing is carried over to the next invocation
+    try:
+        return _handle(event_in, context)
+    finally:
+        metrics.flush()
+
+
+def _handle(event_in, context):
+    # send valid events to firehose, batched by put_record_batch limits. Nothing is kept across invocations, a frozen
+    # or reclaimed container holds no events => the buffer is flushed before the invocation times out and at its end
+    delivery = FirehoseDelivery(firehose_client, os.environ["DELIVERY_STREAM_NAME"])
+    buffer = BoundedBuffer(delivery.put, context=context)
+    try:
+        dead_letters, bots = process_event(event_in, buffer)
+        with metrics.timer("firehose_put"):
+            buffer.flush(force=True)
+    finally:
+        # a failed invocation is retried by the client => its spill files would only fill /tmp of the container
+        discarded = buffer.discard()
+        if discarded:
+            logger.error(f"{discarded} records not delivered")
+    metrics.put("firehose_records", buffer.flushed)
+
+    # the valid events are delivered => a failing write must not fail the request, the client would send them again
+    if bots:
+        with metrics.timer("bots_put"):
+            try:
+                write_bots(bots)
+            except Exception:
+                logger.exception(f"{len(bots)} bot events not written")
+
+    if dead_letters:
+        with metrics.timer("dead_letter_put"):
+            try:
+                logger.warning(f"{len(dead_letters)} invalid events written to {write_dead_letters(dead_letters)}")
+            except Exception:
+                logger.exception(f"{len(dead_letters)} invalid events not written")
+    metrics.put("dead_letters", len(dead_letters))
     return {"statusCode": 200}
@@ -0,0 +1,133 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "StreamSteam")
+
+
+def stdout_sink(record):
+    # lambda writes stdout to cloudwatch logs, lines in embedded metric format are extracted as metrics
+    sys.stdout.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+class MemorySink:
+    """
+    local sink, e.g. for the benchmark harness
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+
+class Metrics:
+    """
+    Collects timings and values of one invocation, flush emits them as one CloudWatch Embedded Metric Format record.
+    see https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    Timings of the same stage are summed up e.g. decode of every event of a bulk request.
+    """
+
+    enabled = True
+
+    def __init__(self, namespace=METRICS_NAMESPACE, dimensions=None, sink=stdout_sink, clock=time.perf_counter):
+        self.namespace = namespace
+        self.dimensions = dimensions or {"FunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")}
+        self.sink = sink
+        self.clock = clock
+        self._values = {}
+        self._units = {}
+
+    @contextmanager
+    def timer(self, stage):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add_timing(stage, self.clock() - start)
+
+    def add_timing(self, stage, seconds):
+        name = f"{stage}_ms"
+        self._values[name] = self._values.get(name, 0) + seconds * 1000
+        self._units[name] = "Milliseconds"
+
+    def put(self, name, value, unit="Count"):
+        self._values[name] = value
+        self._units[name] = unit
+
+    def put_cache_stats(self, cache, stats_before):
+        """
+        hits, misses and hit ratio of the lookup cache since stats_before e.g. cache_hits_user_agent
+        """
+        for namespace, before in stats_before.items():
+            after = cache.stats(namespace)
+            hits, misses = after["hits"] - before["hits"], after["misses"] - before["misses"]
+            self.put(f"cache_hits_{namespace}", hits)
+            self.put(f"cache_misses_{namespace}", misses)
+            if hits + misses:
+                self.put(f"cache_hit_ratio_{namespace}", hits / (hits + misses) * 100, "Percent")
+
+    def to_emf(self, timestamp_ms=None):
+        return {
+            "_aws": {
+                "Timestamp": timestamp_ms or int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [list(self.dimensions)],
+                        "Metrics": [{"Name": name, "Unit": self._units[name]} for name in self._values],
+                    }
+                ],
+            },
+            **self.dimensions,
+            **self._values,
+        }
+
+    def flush(self):
+        if self._values:
+            self.sink(self.to_emf())
+        self._values, self._units = {}, {}
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullMetrics:
+    """
+    metrics disabled => no clock reads, no records
+    """
+
+    enabled = False
+    _timer = _NullTimer()
+
+    def timer(self, stage):
+        return self._timer
+
+    def add_timing(self, stage, seconds):
+        pass
+
+    def put(self, name, value, unit="Count"):
+        pass
+
+    def put_cache_stats(self, cache, stats_before):
+        pass
+
+    def flush(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def get_metrics(sink=stdout_sink):
+    if os.environ.get("METRICS_ENABLED") == "true":
+        return Metrics(sink=sink)
+    return NULL_METRICS
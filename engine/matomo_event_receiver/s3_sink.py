@@ -0,0 +1,26 @@
+import os
+import uuid
+from datetime import datetime, timezone
+
+# dead letter objects are rare => the client is created on first use, not as part of the cold start
+_s3_client = None
+
+
+def _client():
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+
+        _s3_client = boto3.client("s3")
+    return _s3_client
+
+
+def put(prefix, body):
+    """
+    writes a json lines body as one object below prefix/dt=YYYY-MM-DD/ of the S3_BUCKET
+    e.g. events/dead-letter/dt=2020-04-06/1586164025123-3f2c....json
+    """
+    now = datetime.now(timezone.utc)
+    key = f"{prefix}dt={now:%Y-%m-%d}/{int(now.timestamp() * 1000)}-{uuid.uuid4().hex}.json"
+    _client().put_object(Bucket=os.environ["S3_BUCKET"], Key=key, Body=body)
+    return key
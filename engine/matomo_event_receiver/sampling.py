@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import os
+import time
+import zlib
+from array import array
+
+# fields sample rates can be configured for
+SAMPLING_FIELDS = ("site_id", "event_category")
+
+DEFAULT_WINDOW_SECONDS = 60
+# a window's count is projected from at least this much time => a burst at the start of a window is shaped hard
+MIN_PROJECTION_SECONDS = 1
+# estimates exceed the true count by at most e / width * events per window with probability 1 - e ** -depth
+DEFAULT_SKETCH_WIDTH = 2048
+DEFAULT_SKETCH_DEPTH = 4
+
+logger = logging.getLogger()
+
+
+def parse_sample_rates(spec):
+    """
+    e.g. "site_id:3=0.1, event_category:scroll=0.01" => {"site_id": {"3": 0.1}, "event_category": {"scroll": 0.01}}
+    """
+    rates = {}
+    for rule in filter(None, (rule.strip() for rule in (spec or "").split(","))):
+        field_value, _, rate = rule.rpartition("=")
+        field, _, value = field_value.partition(":")
+        if field not in SAMPLING_FIELDS or not value:
+            raise ValueError(f"Invalid sample rate '{rule}', expected <{'|'.join(SAMPLING_FIELDS)}>:<value>=<rate>")
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError(f"Invalid sample rate '{rule}', the rate has to be between 0 and 1")
+        rates.setdefault(field, {})[value] = rate
+    return rates
+
+
+def sample_bucket(event):
+    """
+    deterministic position of the visitor in [0, 1) => all events of a visitor are kept or dropped by a rate,
+    user agent and ip for clients without visitor id
+    """
+    key = event.get("visitor_id") or f"{event.get('user_agent')}|{event.get('ip')}"
+    return zlib.crc32(key.encode("utf-8")) / 0x100000000
+
+
+class CountMinSketch:
+    """
+    Approximate counts of an unbounded number of keys e.g. site ids sent by clients in fixed memory, never
+    underestimates. The rows are indexed by double hashing of one blake2b digest, crc32 is linear => keys colliding
+    in one row would collide in all rows.
+    """
+
+    def __init__(self, width=DEFAULT_SKETCH_WIDTH, depth=DEFAULT_SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self._rows = [array("L", [0]) * width for _ in range(depth)]
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        h1, h2 = int.from_bytes(digest[:4], "little"), int.from_bytes(digest[4:], "little") | 1
+        return [(h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """
+        :return: estimated count of key including count
+        """
+        estimate = None
+        for row, index in zip(self._rows, self._indexes(key)):
+            row[index] += count
+            estimate = row[index] if estimate is None else min(estimate, row[index])
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+    def clear(self):
+        self._rows = [array("L", [0]) * self.width for _ in range(self.depth)]
+
+
+class SiteRateShaper:
+    """
+    Caps runaway sites per container: sites above limit events per window are heavy hitters and sampled down to about
+    limit events per window, the other sites are not affected. The rate of a heavy hitter is based on its count
+    projected to the whole window and on its count of the previous window => a burst or a steady rate is shaped from
+    the start of a window. The limit applies per container, concurrent containers keep up to limit events each.
+    """
+
+    def __init__(
+        self,
+        limit,
+        window_seconds=DEFAULT_WINDOW_SECONDS,
+        width=DEFAULT_SKETCH_WIDTH,
+        depth=DEFAULT_SKETCH_DEPTH,
+        clock=time.monotonic,
+    ):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self.sketch = CountMinSketch(width, depth)
+        # site id => estimated count, sites above limit only
+        self.heavy_hitters = {}
+        self._previous_heavy_hitters = {}
+        self._window_start = clock()
+
+    def rate(self, site_id):
+        now = self.clock()
+        if now - self._window_start >= self.window_seconds:
+            self.sketch.clear()
+            self._previous_heavy_hitters, self.heavy_hitters = self.heavy_hitters, {}
+            self._window_start = now
+
+        site_id = site_id or ""
+        count = self.sketch.add(site_id)
+        if count > self.limit:
+            if site_id not in self.heavy_hitters:
+                logger.warning(f"site '{site_id}' exceeds {self.limit} events per {self.window_seconds}s, sampled")
+            self.heavy_hitters[site_id] = count
+        count = max(count, self._previous_heavy_hitters.get(site_id, 0))
+        if count <= self.limit:
+            return 1.0
+        # e.g. 400 events within the first second of a window => 400 * 60 per window
+        elapsed = max(now - self._window_start, MIN_PROJECTION_SECONDS)
+        return self.limit / max(count, self.heavy_hitters.get(site_id, 0) * self.window_seconds / elapsed)
+
+
+class Sampler:
+    """
+    :param rates: see parse_sample_rates, the lowest rate of the matching rules applies
+    :param site_rate_limit: events per site and minute before a site is shaped, see SiteRateShaper. 0 => no limit
+    """
+
+    def __init__(self, rates=None, site_rate_limit=0, clock=time.monotonic):
+        self.rates = rates or {}
+        self.shaper = SiteRateShaper(site_rate_limit, clock=clock) if site_rate_limit else None
+
+    def sample_rate(self, event):
+        rate = 1.0
+        for field, field_rates in self.rates.items():
+            rate = min(rate, field_rates.get(event.get(field), 1.0))
+        if self.shaper is not None:
+            rate = min(rate, self.shaper.rate(event.get("site_id")))
+        return rate
+
+    def sample(self, events):
+        """
+        :return: kept events, the sample_rate field is set => counts can be weighted by 1 / sample_rate
+        """
+        kept = []
+        for event in events:
+            rate = self.sample_rate(event)
+            if rate >= 1 or sample_bucket(event) < rate:
+                event["sample_rate"] = rate
+                kept.append(event)
+        return kept
+
+
+def get_sampler():
+    """
+    None if neither sample rates nor a site rate limit are configured, SAMPLE_RATES and SITE_RATE_LIMIT
+    """
+    rates = parse_sample_rates(os.environ.get("SAMPLE_RATES"))
+    site_rate_limit = int(os.environ.get("SITE_RATE_LIMIT") or 0)
+    if not rates and not site_rate_limit:
+        return None
+    return Sampler(rates, site_rate_limit)
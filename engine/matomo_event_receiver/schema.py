@@ -1,4 +1,4 @@
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 
 Field = namedtuple("Field", ["name_in", "name_out", "type"])
 
@@ -47,6 +47,7 @@ INCOMING = [
     Field("e_a", "event_action", str),
     Field("e_n", "event_value_name", str),
     Field("e_v", "event_value_numeric", float),
+    Field("_id", "visitor_id", str),
 ]
 
 # geo coding resolved data
@@ -129,98 +130,91 @@ PROCESSING = [
     Field("user_agent", None, str),
     Field("ip", None, str),
     Field("event_datetime", None, str),
+    # share of the events of the site / category kept by the receiver, see sampling.py
+    Field("sample_rate", None, float),
 ]
 
 # final schema for enriched events
 ENRICHED = INCOMING + PROCESSING + GEO_INFO + DEVICE_INFO
 
 
-def schema_to_flat_json(schema, converted, level=0, level_prev=0, path="", use_glue_types=True):
-    # takes an event schema and creates a flat json
-    # e.g.:
-    #
-    # {'action_name': 'action_name:string',
-    #  'device_info': ['ua:string',
-    #                  'type:string',
-    #                   ...
-    #  'device_info.os': ['name:string',
-    #                     'code:string',
-    #                   ...
-    #  'display_resolutions': 'display_resolutions:string',
+# python type => glue type
+GLUE_TYPES = {str: "string", int: "int", float: "double", bool: "boolean"}
+
+# compiled schema, children is None for scalar fields and a list of SchemaNodes for structs
+SchemaNode = namedtuple("SchemaNode", ["name", "type", "children"])
+
+
+def compile_schema(schema):
+    """
+    Compiles an event schema to a tree of SchemaNodes in one pass, supports any nesting depth.
+    Fields with the same output name are merged, the first occurrence defines the position
+    e.g. ip of INCOMING and PROCESSING => one ip node
+    """
+    field_types = {}
     for field in schema:
-        field_name = field.name_out or field.name_in
-        if level == 0:
-            path = field_name
-        elif level_prev > level:
-            path = ".".join(path.split(".")[:-1])
-
-        if isinstance(field.type, list):
-            # nested struct
-            if level != 0:
-                # nested path => extend current path
-                if path:
-                    path = f"{path}.{field_name}"
-                else:
-                    path = field_name
-            level_prev = schema_to_flat_json(
-                field.type, converted=converted, level_prev=level_prev, level=level + 1, path=path
-            )
-        else:
-            # flat struct
-            if use_glue_types:
-                if field_name in TIMESTAMP_FIELDS:
-                    data_type = "timestamp"
-                elif field.type == str:
-                    data_type = "string"
-                elif field.type == int:
-                    data_type = "int"
-                elif field.type == float:
-                    data_type = "double"
-                elif field.type == bool:
-                    data_type = "boolean"
-                else:
-                    raise NotImplementedError(f"Unknown type {field.type}")
-            else:
-                data_type = field.type
-
-            if level == 0:
-                converted[path] = data_type
-            else:
-                converted[path].append(f"{field_name}:{data_type}")
-
-    return level
-
-
-# _schema_to_glue_table_struct
+        name = field.name_out or field.name_in
+        if isinstance(field.type, list) and isinstance(field_types.get(name), list):
+            field_types[name] = field_types[name] + field.type
+        elif name not in field_types:
+            field_types[name] = field.type
+
+    return [
+        SchemaNode(name, None, compile_schema(field_type))
+        if isinstance(field_type, list)
+        else SchemaNode(name, field_type, None)
+        for name, field_type in field_types.items()
+    ]
+
+
+def glue_type(node):
+    """
+    e.g. struct<longitude:double,latitude:double>
+    """
+    if node.children is not None:
+        return f"struct<{','.join(f'{child.name}:{glue_type(child)}' for child in node.children)}>"
+    if node.name in TIMESTAMP_FIELDS:
+        return "timestamp"
+    try:
+        return GLUE_TYPES[node.type]
+    except KeyError:
+        raise NotImplementedError(f"Unknown type {node.type}")
+
+
 def schema_to_glue_schema(schema):
-    json_schema = defaultdict(list)
-    schema_to_flat_json(schema, converted=json_schema, use_glue_types=True)
-
-    # sort by . to get deepest elements first
-    nested_targets = defaultdict(dict)
-    schema_glue = []
-
-    for key in sorted(json_schema.keys(), key=lambda s: s.count("."), reverse=True):
-        value = json_schema[key]
-
-        if key in nested_targets:
-            for sub_key, sub_value in nested_targets[key].items():
-                value.append(f"{sub_key}:{sub_value}")
-            struct_str = ",".join(value)
-            struct_str = f"struct<{struct_str}>"
-            schema_glue.append([key, struct_str])
-        if isinstance(value, str):
-            # flat value
-            schema_glue.append([key, value])
-        else:
-            # e.g. from list to
-            # struct<longitude:double,latitude:double>
-            nested_struct_str = ",".join(value)
-            nested_struct_str = f"struct<{nested_struct_str}>"
-            if "." in key:
-                # e.g. device_info.os => device_info
-                # TODO make dynamic to support more than two nested levels
-                target_key_l1, target_key_l2 = key.split(".")
-                nested_targets[target_key_l1][target_key_l2] = nested_struct_str
-
-    return schema_glue
+    """
+    :return: list of [column name, glue type] e.g. [["site_id", "string"], ["geo_info", "struct<ip:string,...>"]]
+    """
+    return [[node.name, glue_type(node)] for node in compile_schema(schema)]
+
+
+def schema_to_json_paths(schema):
+    """
+    top level keys for the JsonSerDe paths property
+    """
+    return [node.name for node in compile_schema(schema)]
+
+
+def arrow_type(node, timestamps_as_strings=False):
+    import pyarrow as pa
+
+    if node.children is not None:
+        return pa.struct([pa.field(child.name, arrow_type(child, timestamps_as_strings)) for child in node.children])
+    if node.name in TIMESTAMP_FIELDS and not timestamps_as_strings:
+        return pa.timestamp("ms")
+    # matches the glue types, int is 32 bit
+    types = {str: pa.string(), int: pa.int32(), float: pa.float64(), bool: pa.bool_()}
+    try:
+        return types[node.type]
+    except KeyError:
+        raise NotImplementedError(f"Unknown type {node.type}")
+
+
+def schema_to_arrow_schema(schema, timestamps_as_strings=False):
+    """
+    parquet / arrow schema, pyarrow is an optional dependency and only imported here
+    timestamps_as_strings: e.g. to build tables from json events, event_datetime is a "%Y-%m-%d %H:%M:%S" string
+    """
+    import pyarrow as pa
+
+    return pa.schema([pa.field(node.name, arrow_type(node, timestamps_as_strings)) for node in compile_schema(schema)])
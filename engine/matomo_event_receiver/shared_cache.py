@@ -0,0 +1,187 @@
+import hashlib
+import os
+import threading
+import time
+
+from cache import NOT_FOUND
+from codec import CODEC
+
+# limits of BatchGetItem / BatchWriteItem
+BATCH_GET_MAX_KEYS = 100
+BATCH_WRITE_MAX_ITEMS = 25
+# unprocessed keys / items are retried with backoff, what is left is treated as a miss / not written
+BATCH_MAX_ATTEMPTS = 3
+BATCH_BACKOFF_SECONDS = 0.025
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_NEGATIVE_TTL = 60 * 60
+
+# a partition key has at most 2048 bytes, a character at most 4 => longer keys e.g. user agents are hashed
+MAX_KEY_CHARS = 500
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        end = start + size
+        yield items[start:end]
+
+
+def item_id(namespace, key):
+    """
+    e.g. ("ip", "1.2.3.0") => "ip#1.2.3.0"
+    """
+    if len(key) > MAX_KEY_CHARS:
+        key = f"sha1:{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+    return f"{namespace}#{key}"
+
+
+class DynamoDBSharedCache:
+    """
+    Lookup results shared by all containers of the receiver and the enricher, survives cold starts.
+    Items: id (partition key), value (json, absent for negative entries), expires_at (epoch seconds, table TTL attribute)
+
+    :param ttl: seconds an entry stays valid per namespace e.g. {"ip": 86400}
+    :param negative_ttl: seconds a key without lookup result stays cached
+    """
+
+    name = "dynamodb"
+
+    def __init__(self, table_name=None, ttl=None, negative_ttl=DEFAULT_NEGATIVE_TTL, client=None, clock=time.time):
+        self.table_name = table_name or os.environ["SHARED_CACHE_TABLE"]
+        self.ttl = ttl or {}
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self._client = client
+
+    @property
+    def client(self):
+        # created on first use => containers without cache misses never set up the client
+        if self._client is None:
+            import boto3
+
+            self._client = boto3.client("dynamodb")
+        return self._client
+
+    def get_many(self, keys):
+        """
+        :param keys: (namespace, key) pairs
+        :return: {(namespace, key): value or NOT_FOUND} of the found, unexpired entries
+        """
+        ids = {item_id(namespace, key): (namespace, key) for namespace, key in keys}
+        now = self.clock()
+        found = {}
+        for batch in chunks(list(ids), BATCH_GET_MAX_KEYS):
+            request = {self.table_name: {"Keys": [{"id": {"S": id_}} for id_ in batch]}}
+            for attempt in range(BATCH_MAX_ATTEMPTS):
+                if attempt:
+                    time.sleep(BATCH_BACKOFF_SECONDS * 2 ** attempt)
+                response = self.client.batch_get_item(RequestItems=request)
+                for item in response["Responses"].get(self.table_name, []):
+                    # expired items are deleted by dynamodb within days, not at expires_at
+                    if int(item["expires_at"]["N"]) <= now:
+                        continue
+                    found[ids[item["id"]["S"]]] = CODEC.loads(item["value"]["B"]) if "value" in item else NOT_FOUND
+                request = response.get("UnprocessedKeys")
+                if not request:
+                    break
+        return found
+
+    def put_many(self, entries):
+        """
+        :param entries: {(namespace, key): value or NOT_FOUND}
+        """
+        now = int(self.clock())
+        requests = []
+        for (namespace, key), value in entries.items():
+            item = {"id": {"S": item_id(namespace, key)}}
+            if value is NOT_FOUND:
+                item["expires_at"] = {"N": str(now + self.negative_ttl)}
+            else:
+                item["value"] = {"B": CODEC.dumps_line(value)}
+                item["expires_at"] = {"N": str(now + self.ttl.get(namespace, DEFAULT_TTL))}
+            requests.append({"PutRequest": {"Item": item}})
+
+        for batch in chunks(requests, BATCH_WRITE_MAX_ITEMS):
+            request = {self.table_name: batch}
+            for attempt in range(BATCH_MAX_ATTEMPTS):
+                if attempt:
+                    time.sleep(BATCH_BACKOFF_SECONDS * 2 ** attempt)
+                request = self.client.batch_write_item(RequestItems=request).get("UnprocessedItems")
+                if not request:
+                    break
+
+
+class LocalSharedCache:
+    """
+    In process stand-in for the DynamoDB cache with the same semantics e.g. for the benchmark harness.
+
+    :param latency_ms: simulated round trip per batch request
+    :param items: dict like store e.g. a multiprocessing manager dict shared by worker processes
+    """
+
+    name = "local"
+
+    def __init__(self, ttl=None, negative_ttl=DEFAULT_NEGATIVE_TTL, latency_ms=0, items=None, clock=time.time):
+        self.ttl = ttl or {}
+        self.negative_ttl = negative_ttl
+        self.latency_ms = latency_ms
+        self.clock = clock
+        self.requests = 0
+        # id => (expires_at, value)
+        self._items = {} if items is None else items
+        # written by the write behind thread
+        self._lock = threading.Lock()
+
+    def _request(self):
+        self.requests += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        now = self.clock()
+        found = {}
+        for batch in chunks(keys, BATCH_GET_MAX_KEYS):
+            self._request()
+            with self._lock:
+                for namespace, key in batch:
+                    item = self._items.get(item_id(namespace, key))
+                    if item is not None and item[0] > now:
+                        found[(namespace, key)] = NOT_FOUND if item[1] is None else CODEC.loads(item[1])
+        return found
+
+    def put_many(self, entries):
+        now = int(self.clock())
+        entries = list(entries.items())
+        for batch in chunks(entries, BATCH_WRITE_MAX_ITEMS):
+            self._request()
+            items = {}
+            for (namespace, key), value in batch:
+                if value is NOT_FOUND:
+                    items[item_id(namespace, key)] = (now + self.negative_ttl, None)
+                else:
+                    expires_at = now + self.ttl.get(namespace, DEFAULT_TTL)
+                    items[item_id(namespace, key)] = (expires_at, CODEC.dumps_line(value))
+            # one update => one round trip to a manager dict
+            with self._lock:
+                self._items.update(items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+SHARED_CACHES = {cache.name: cache for cache in (DynamoDBSharedCache, LocalSharedCache)}
+
+
+def get_shared_cache(name, **kwargs):
+    """
+    off => None, the per container cache is the only cache tier
+    """
+    if name == "off":
+        return None
+    try:
+        shared_cache_class = SHARED_CACHES[name]
+    except KeyError:
+        raise ValueError(f"Unknown shared lookup cache '{name}', choose one of off, {', '.join(SHARED_CACHES)}")
+    return shared_cache_class(**kwargs)
@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta, timezone
+
+MONTHS = {
+    "Jan": 1,
+    "Feb": 2,
+    "Mar": 3,
+    "Apr": 4,
+    "May": 5,
+    "Jun": 6,
+    "Jul": 7,
+    "Aug": 8,
+    "Sep": 9,
+    "Oct": 10,
+    "Nov": 11,
+    "Dec": 12,
+}
+
+# unix timestamps above are treated as milliseconds, in seconds this would be the year 5138
+UNIX_MS_THRESHOLD = 10 ** 11
+
+
+def parse_unix(value):
+    """
+    e.g. 1586176391 or 1586176391123 (ms) or 1586176391.123
+    """
+    timestamp = float(value)
+    if timestamp >= UNIX_MS_THRESHOLD:
+        timestamp /= 1000
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+def parse_iso(value):
+    """
+    e.g. 2020-04-06T09:07:05Z, 2020-04-06 09:07:05+02:00 or 2020-04-06 09:07:05
+    """
+    if value[-1] in "Zz":
+        value = f"{value[:-1]}+00:00"
+    return datetime.fromisoformat(value)
+
+
+def parse_request_time(value):
+    """
+    API Gateway requestContext.requestTime e.g. 06/Apr/2020:09:07:05 +0000
+    equivalent of datetime.strptime(value, "%d/%b/%Y:%H:%M:%S %z")
+    """
+    if len(value) != 26 or value[2] != "/" or value[6] != "/" or value[11] != ":" or value[20] != " ":
+        raise ValueError(f"{value} does not match format %d/%b/%Y:%H:%M:%S %z")
+    offset = timedelta(hours=int(value[22:24]), minutes=int(value[24:26]))
+    if value[21] == "-":
+        offset = -offset
+    return datetime(
+        int(value[7:11]),
+        MONTHS[value[3:6]],
+        int(value[0:2]),
+        int(value[12:14]),
+        int(value[15:17]),
+        int(value[18:20]),
+        tzinfo=timezone.utc if not offset else timezone(offset),
+    )
+
+
+def parse_dateutil(value):
+    # slow, only for formats none of the fast parsers understands
+    from dateutil.parser import parse as date_parse
+
+    return date_parse(value)
+
+
+# tried in this order, the first parser accepting a value wins e.g. 20200406 is a unix timestamp
+PARSERS = [parse_unix, parse_iso, parse_request_time]
+
+# clients of a site send the same format => the parser that succeeded last is tried first
+_last_parser = parse_unix
+
+
+def _fast_path(parser, value):
+    """
+    the result of parser is the result of PARSERS in order if none of the parsers before it accepts the value:
+    request times contain a /, extended iso dates a - at position 4, floats neither
+    """
+    return parser is parse_request_time or (parser is parse_iso and value[4:5] == "-")
+
+
+def parse(value):
+    global _last_parser
+    if _fast_path(_last_parser, value):
+        try:
+            return _last_parser(value)
+        except (KeyError, ValueError, OverflowError, OSError):
+            pass
+
+    for parser in PARSERS:
+        try:
+            parsed = parser(value)
+        except (KeyError, ValueError, OverflowError, OSError):
+            continue
+        _last_parser = parser
+        return parsed
+
+    return parse_dateutil(value)
+
+
+def format_utc(value):
+    """
+    e.g. 2020-04-06 11:07:05+02:00 => 2020-04-06 09:07:05, datetimes without tzinfo are treated as local time
+    """
+    if value.tzinfo is not timezone.utc:
+        value = value.astimezone(timezone.utc)
+    date = f"{value.year:04d}-{value.month:02d}-{value.day:02d}"
+    return f"{date} {value.hour:02d}:{value.minute:02d}:{value.second:02d}"
@@ -0,0 +1,160 @@
+import logging
+import math
+import os
+
+import s3_sink
+import schema
+from codec import CODEC
+
+logger = logging.getLogger()
+
+# invalid events are written here instead of to firehose => they never reach the table
+DEAD_LETTER_PREFIX = os.environ.get("DEAD_LETTER_PREFIX", "events/dead-letter/")
+
+# an event is useless without these => dead lettered if invalid, invalid values of other fields are set to NULL
+REQUIRED_FIELDS = {"site_id", "event_datetime"}
+
+INT_MIN, INT_MAX = -(2 ** 31), 2 ** 31 - 1
+# timestamps.format_utc output e.g. 2020-04-06 09:07:05
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+TIMESTAMP_SEPARATORS = ((4, "-"), (7, "-"), (10, " "), (13, ":"), (16, ":"))
+
+
+def _coerce_str(value):
+    if value.__class__ is str:
+        return value
+    if value.__class__ in (int, float):
+        return str(value)
+    raise TypeError(f"expected string, got {value.__class__.__name__}")
+
+
+def _coerce_site_id(value):
+    # value of the site_id partitions of the enriched events => digits only, e.g. no / or = of an s3 key
+    value = _coerce_str(value)
+    if not (value.isascii() and value.isdigit()):
+        raise ValueError(f"expected numeric site id, got {value!r}")
+    return value
+
+
+def _coerce_int(value):
+    if value.__class__ is not int:
+        if value.__class__ is float and value.is_integer():
+            value = int(value)
+        elif value.__class__ is str:
+            value = int(value)
+        else:
+            raise TypeError(f"expected int, got {value.__class__.__name__}")
+    # glue int is 32 bit
+    if not INT_MIN <= value <= INT_MAX:
+        raise ValueError(f"{value} out of int range")
+    return value
+
+
+def _coerce_float(value):
+    if value.__class__ is not float:
+        if value.__class__ in (int, str):
+            value = float(value)
+        else:
+            raise TypeError(f"expected double, got {value.__class__.__name__}")
+    if not math.isfinite(value):
+        raise ValueError(f"{value} is not a finite number")
+    return value
+
+
+# matomo flags and json booleans
+BOOL_VALUES = {True: True, False: False, 0: False, 1: True, "0": False, "1": True, "true": True, "false": False}
+
+
+def _coerce_bool(value):
+    try:
+        return BOOL_VALUES[value]
+    except (KeyError, TypeError):
+        raise ValueError(f"expected boolean, got {value!r}")
+
+
+def _coerce_timestamp(value):
+    if value.__class__ is not str or len(value) != 19:
+        raise ValueError(f"expected timestamp {TIMESTAMP_FORMAT}, got {value!r}")
+    for position, separator in TIMESTAMP_SEPARATORS:
+        if value[position] != separator:
+            raise ValueError(f"expected timestamp {TIMESTAMP_FORMAT}, got {value!r}")
+    return value
+
+
+COERCERS = {str: _coerce_str, int: _coerce_int, float: _coerce_float, bool: _coerce_bool}
+# fields with checks beyond their type
+FIELD_COERCERS = {"site_id": _coerce_site_id}
+
+
+def compile_validator(nodes):
+    """
+    compiles schema nodes into a tuple of (name, coerce, children) per level, children is the compiled struct
+    e.g. (("site_id", _coerce_str, None), ..., ("geo_info", None, (("ip", _coerce_str, None), ...)))
+    """
+    compiled = []
+    for node in nodes:
+        if node.children is not None:
+            compiled.append((node.name, None, compile_validator(node.children)))
+        elif node.name in schema.TIMESTAMP_FIELDS:
+            compiled.append((node.name, _coerce_timestamp, None))
+        elif node.name in FIELD_COERCERS:
+            compiled.append((node.name, FIELD_COERCERS[node.name], None))
+        else:
+            compiled.append((node.name, COERCERS[node.type], None))
+    return tuple(compiled)
+
+
+VALIDATOR = compile_validator(schema.compile_schema(schema.ENRICHED))
+
+
+def _validate(validator, value, path, errors, nulled, skip_none):
+    validated = {}
+    for name, coerce, children in validator:
+        field_value = value.get(name)
+        error = None
+        if field_value is None:
+            pass
+        elif children is not None:
+            if field_value.__class__ is dict:
+                validated[name] = _validate(children, field_value, f"{path}{name}.", errors, nulled, skip_none)
+                continue
+            error = f"expected struct, got {field_value.__class__.__name__}"
+        else:
+            try:
+                validated[name] = coerce(field_value)
+                continue
+            except (TypeError, ValueError) as e:
+                error = str(e)
+
+        if error is not None:
+            (errors if f"{path}{name}" in REQUIRED_FIELDS else nulled)[f"{path}{name}"] = error
+        # missing keys are read as NULL by the JsonSerDe and the parquet conversion
+        if not skip_none:
+            validated[name] = None
+    return validated
+
+
+def validate_event(event, validator=VALIDATOR, skip_none=False):
+    """
+    checks and coerces an event in one pass, keys are in schema order, keys not in the schema are dropped.
+    Invalid values of fields not in REQUIRED_FIELDS are set to NULL and logged, the event is kept.
+    skip_none: fields without value are left out => smaller records
+    e.g. {"site_id": 1, "random_part": "x"} => ({"site_id": "1", "random_part": None, ...}, {})
+    :return: validated event, errors of required fields e.g. {"event_datetime": "expected timestamp ..."}
+    """
+    if event.__class__ is not dict:
+        return None, {"": f"expected struct, got {event.__class__.__name__}"}
+    errors, nulled = {}, {}
+    validated = _validate(validator, event, "", errors, nulled, skip_none)
+    if nulled:
+        logger.warning(f"invalid fields set to NULL: {nulled}")
+    return validated, errors
+
+
+def dead_letter(event, errors):
+    return {"errors": errors, "event": event}
+
+
+def write_dead_letters(dead_letters):
+    # default=str => events which are not json serializable are kept as well
+    return s3_sink.put(DEAD_LETTER_PREFIX, CODEC.dumps_lines(dead_letters, default=str))
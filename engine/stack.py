@@ -27,11 +27,31 @@ from troposphere.apigateway import (
 )
 from troposphere.awslambda import Code, Environment, Function
 from troposphere.cloudformation import Stack
-from troposphere.firehose import BufferingHints, DeliveryStream, S3DestinationConfiguration
+from troposphere.dynamodb import AttributeDefinition, KeySchema
+from troposphere.dynamodb import Table as DynamoDBTable
+from troposphere.dynamodb import TimeToLiveSpecification
+from troposphere.firehose import (
+    BufferingHints,
+    DataFormatConversionConfiguration,
+    DeliveryStream,
+    Deserializer,
+    DynamicPartitioningConfiguration,
+    ExtendedS3DestinationConfiguration,
+    InputFormatConfiguration,
+    OpenXJsonSerDe,
+    OutputFormatConfiguration,
+    ParquetSerDe,
+    ProcessingConfiguration,
+    Processor,
+    ProcessorParameter,
+    SchemaConfiguration,
+    Serializer,
+)
 from troposphere.glue import Column, Database, DatabaseInput, SerdeInfo, StorageDescriptor, Table, TableInput
 from troposphere.iam import Policy, Role
 from troposphere.s3 import Bucket, Private
 
+from . import delivery_profiles
 from .matomo_event_receiver import schema as event_schema
 from .utils import camel_case_to_dashed, dashed_to_camel_case
 
@@ -41,9 +61,38 @@ PROJECT_ROOT = os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", ""
 OUTPUT_API_GATEWAY_ENDPOINT = "APIGatewayEndpoint"
 S3_TEPM_PREFIX = "tmp/"
 S3_ENRICHED_PREFIX = "events/enriched/"
+S3_ENRICHED_PARQUET_PREFIX = "events/enriched-parquet/"
+S3_ENRICHED_ERROR_PREFIX = "events/enriched-errors/"
+# events failing validation against the enriched schema
+S3_DEAD_LETTER_PREFIX = "events/dead-letter/"
+# crawler events routed by the receiver, see BOT_FILTER_MODE
+S3_BOTS_PREFIX = "events/bots/"
+GLUE_TABLE_EVENTS_ENRICHED = "events_enriched"
+
+# Hive style partitions below the enriched prefix, time partitions depend on the delivery profile
+# e.g. events/enriched/dt=2020-04-06/hour=09/ or events/enriched/dt=2020-04-06/hour=09/site_id=1/
+ENRICHED_SITE_PARTITION_PREFIX = "site_id=!{partitionKeyFromQuery:site_id}/"
+ENRICHED_PARTITION_PROJECTION_START = "2020-01-01"
 S3_DEPLOYMENT_PREFIX = f"{S3_TEPM_PREFIX}deployment/"
 
+# API Gateway usage plan, see ./stream-steam config
+DEFAULT_API_QUOTA_LIMIT = 50000
+DEFAULT_API_QUOTA_PERIOD = "MONTH"
+DEFAULT_API_THROTTLE_BURST_LIMIT = 500
+DEFAULT_API_THROTTLE_RATE_LIMIT = 5000
+
 event_receiver_zip_path = Path(PROJECT_ROOT, "engine", "matomo_event_receiver", "dist", "matomo_event_receiver.zip")
+# files not required at runtime, removed from the package to keep the cold start short
+event_receiver_zip_excludes = [
+    "*.dist-info/*",
+    "*/__pycache__/*",
+    "*.pyc",
+    "bin/*",
+    "benchmarks/*",
+    "data/.gitkeep",
+    # only the parser of dateutil is used, no tz database required
+    "dateutil/zoneinfo/*.tar.gz",
+]
 
 
 class CloudformationStack:
@@ -186,6 +235,49 @@ class CloudformationStack:
                     echo.enum_elm(f"running post deploy code for module {module.id}")
                     module.post_deploy()
 
+    @property
+    def enriched_output_format(self):
+        return self.cfg.get("enriched_output_format") or "json"
+
+    @property
+    def enriched_prefix(self):
+        # json and parquet files must not be mixed below one table location
+        if self.enriched_output_format == "parquet":
+            return S3_ENRICHED_PARQUET_PREFIX
+        return S3_ENRICHED_PREFIX
+
+    @property
+    def delivery_profile(self):
+        return delivery_profiles.get_profile(self.cfg.get("delivery_profile"))
+
+    @property
+    def remote_lookups_enabled(self):
+        """
+        ipinfo / userstack, the only lookups worth a shared cache
+        """
+        return (
+            self.cfg.get("ip_geocoding_enabled") == "true"
+            and (self.cfg.get("geolocation_backend") or "ipinfo") != "local"
+        ) or (
+            self.cfg.get("device_detection_enabled") == "true"
+            and (self.cfg.get("device_detection_backend") or "userstack") != "local"
+        )
+
+    @property
+    def partition_by_site_id(self):
+        return self.cfg.get("partition_by_site_id") == "true"
+
+    @property
+    def enriched_prefix_expression(self):
+        """
+        Firehose prefix of the enriched events including the partitions
+        e.g. events/enriched/dt=!{timestamp:yyyy-MM-dd}/hour=!{timestamp:HH}/
+        """
+        prefix = self.enriched_prefix + delivery_profiles.partition_prefix(self.delivery_profile)
+        if self.partition_by_site_id:
+            prefix += ENRICHED_SITE_PARTITION_PREFIX
+        return prefix
+
     @property
     def exists(self):
         return self.stack_id
@@ -279,25 +371,133 @@ class CloudformationStack:
         self.template_initial.add_resource(s3_bucket_obj)
         self.template_initial.add_output(s3_bucket_output_res)
 
+        # sync: events are enriched by the event receiver before they are sent to firehose
+        # async: the event receiver sends raw events, firehose enriches them in batches via the enricher lambda
+        enrichment_mode = self.cfg.get("enrichment_mode") or "sync"
+
         # Kinesis Firehose event_in compressor
         event_compressor_name = self.build_resource_name("event-compressor")
+        processors = []
+        if enrichment_mode == "async":
+            processors.append(
+                Processor(
+                    Type="Lambda",
+                    Parameters=[
+                        ProcessorParameter(
+                            ParameterName="LambdaArn", ParameterValue=GetAtt("LambdaMatomoEventEnricher", "Arn")
+                        ),
+                        # the enricher responds with the base64 encoded, enriched records => the response is about
+                        # 1.33 * (growth by device_info / geo_info) times the batch, lambda responses are limited to
+                        # 6 MB. Batches of 1 MB leave room for events growing to four times their size
+                        ProcessorParameter(ParameterName="BufferSizeInMBs", ParameterValue="1"),
+                        ProcessorParameter(ParameterName="BufferIntervalInSeconds", ParameterValue="60"),
+                    ],
+                )
+            )
+
+        # site_id partitions: firehose extracts the partition key from every record (dynamic partitioning)
+        # note: dynamic partitioning can only be enabled when the delivery stream is created
+        delivery_profile = self.delivery_profile
+        enriched_prefix = self.enriched_prefix_expression
+        dynamic_partitioning_configuration = DynamicPartitioningConfiguration(Enabled=False)
+        if self.partition_by_site_id:
+            dynamic_partitioning_configuration = DynamicPartitioningConfiguration(Enabled=True)
+            processors.append(
+                Processor(
+                    Type="MetadataExtraction",
+                    Parameters=[
+                        ProcessorParameter(
+                            ParameterName="MetadataExtractionQuery",
+                            ParameterValue='{site_id: (.site_id // "unknown")}',
+                        ),
+                        ProcessorParameter(ParameterName="JsonParsingEngine", ParameterValue="JQ-1.6"),
+                    ],
+                )
+            )
+
+        processing_configuration = ProcessingConfiguration(Enabled=False)
+        if processors:
+            processing_configuration = ProcessingConfiguration(Enabled=True, Processors=processors)
+
+        # parquet: firehose converts the json events to parquet files by using the schema of the glue table
+        buffering_hints = BufferingHints(
+            IntervalInSeconds=delivery_profile.interval_seconds,
+            SizeInMBs=delivery_profiles.buffer_size_mb(
+                delivery_profile, self.enriched_output_format, dynamic_partitioning=self.partition_by_site_id
+            ),
+        )
+        compression_format = delivery_profile.json_compression
+        data_format_conversion_configuration = DataFormatConversionConfiguration(Enabled=False)
+        if self.enriched_output_format == "parquet":
+            # compression is done by parquet
+            compression_format = "UNCOMPRESSED"
+            data_format_conversion_configuration = DataFormatConversionConfiguration(
+                Enabled=True,
+                InputFormatConfiguration=InputFormatConfiguration(
+                    Deserializer=Deserializer(OpenXJsonSerDe=OpenXJsonSerDe())
+                ),
+                OutputFormatConfiguration=OutputFormatConfiguration(
+                    Serializer=Serializer(ParquetSerDe=ParquetSerDe(Compression=delivery_profile.parquet_compression))
+                ),
+                SchemaConfiguration=SchemaConfiguration(
+                    CatalogId=Ref("AWS::AccountId"),
+                    DatabaseName=Ref("GlueDatabase"),
+                    TableName=GLUE_TABLE_EVENTS_ENRICHED,
+                    Region=Ref("AWS::Region"),
+                    RoleARN=GetAtt("LambdaExecutionRole", "Arn"),
+                    VersionId="LATEST",
+                ),
+            )
+
         event_compressor = DeliveryStream(
             "EventCompressor",
+            DependsOn="GlueTableEventsEnriched",
             DeliveryStreamName=event_compressor_name,
-            S3DestinationConfiguration=S3DestinationConfiguration(
+            ExtendedS3DestinationConfiguration=ExtendedS3DestinationConfiguration(
                 BucketARN=GetAtt("S3Bucket", "Arn"),
-                BufferingHints=BufferingHints(IntervalInSeconds=60, SizeInMBs=25),
+                BufferingHints=buffering_hints,
                 # TODO
                 # CloudWatchLoggingOptions=CloudWatchLoggingOptions(
                 #     Enabled=True, LogGroupName="FirehosEventCompressor", LogStreamName="FirehosEventCompressor",
                 # ),
-                CompressionFormat="GZIP",
-                Prefix=S3_ENRICHED_PREFIX,
+                CompressionFormat=compression_format,
+                DataFormatConversionConfiguration=data_format_conversion_configuration,
+                DynamicPartitioningConfiguration=dynamic_partitioning_configuration,
+                # required as soon as the prefix contains expressions
+                ErrorOutputPrefix=f"{S3_ENRICHED_ERROR_PREFIX}!{{firehose:error-output-type}}/dt=!{{timestamp:yyyy-MM-dd}}/",
+                Prefix=enriched_prefix,
+                ProcessingConfiguration=processing_configuration,
                 RoleARN=GetAtt("LambdaExecutionRole", "Arn"),
             ),
         )
         self.template.add_resource(event_compressor)
 
+        # Shared lookup cache, 2nd tier behind the per container cache of the receiver / enricher
+        lambda_policy_statements = []
+        shared_lookup_cache_environment = {"SHARED_CACHE": "off"}
+        if self.cfg.get("shared_lookup_cache_enabled") == "true" and self.remote_lookups_enabled:
+            shared_lookup_cache = self.template.add_resource(
+                DynamoDBTable(
+                    "DynamoDBLookupCache",
+                    TableName=self.build_resource_name("lookup-cache"),
+                    AttributeDefinitions=[AttributeDefinition(AttributeName="id", AttributeType="S")],
+                    KeySchema=[KeySchema(AttributeName="id", KeyType="HASH")],
+                    BillingMode="PAY_PER_REQUEST",
+                    TimeToLiveSpecification=TimeToLiveSpecification(AttributeName="expires_at", Enabled=True),
+                )
+            )
+            lambda_policy_statements.append(
+                {
+                    "Action": ["dynamodb:BatchGetItem", "dynamodb:BatchWriteItem"],
+                    "Resource": GetAtt(shared_lookup_cache, "Arn"),
+                    "Effect": "Allow",
+                }
+            )
+            shared_lookup_cache_environment = {
+                "SHARED_CACHE": "dynamodb",
+                "SHARED_CACHE_TABLE": Ref(shared_lookup_cache),
+            }
+
         # Lambda Execution Role
         self.template.add_resource(
             Role(
@@ -316,7 +516,18 @@ class CloudformationStack:
                                     "Resource": Join("", [GetAtt("S3Bucket", "Arn"), "/*"]),
                                     "Effect": "Allow",
                                 },
-                                {"Action": ["firehose:PutRecord"], "Resource": "*", "Effect": "Allow"},
+                                {
+                                    "Action": ["firehose:PutRecord", "firehose:PutRecordBatch"],
+                                    "Resource": "*",
+                                    "Effect": "Allow",
+                                },
+                                # firehose reads the table schema for the parquet conversion
+                                {
+                                    "Action": ["glue:GetTable", "glue:GetTableVersion", "glue:GetTableVersions"],
+                                    "Resource": "*",
+                                    "Effect": "Allow",
+                                },
+                                *lambda_policy_statements,
                             ],
                         },
                     )
@@ -342,25 +553,41 @@ class CloudformationStack:
 
         # Event Receiver Lambda
         matomo_event_receiver_lambda_name = self.build_resource_name("matomo-event-receiver")
+        matomo_event_receiver_code = Code(
+            S3Bucket=Ref(s3_bucket),
+            S3Key=f"{S3_DEPLOYMENT_PREFIX}{self.artifact_filename_hashed(event_receiver_zip_path)}",
+        )
+        enrichment_environment = {
+            "IP_GEOCODING_ENABLED": self.cfg.get("ip_geocoding_enabled"),
+            "GEOLOCATION_BACKEND": self.cfg.get("geolocation_backend") or "ipinfo",
+            "IP_INFO_API_TOKEN": self.cfg.get("ip_info_api_token"),
+            "USERSTACK_API_TOKEN": self.cfg.get("userstack_api_token"),
+            "DEVICE_DETECTION_ENABLED": self.cfg.get("device_detection_enabled"),
+            "DEVICE_DETECTION_BACKEND": self.cfg.get("device_detection_backend") or "userstack",
+            **shared_lookup_cache_environment,
+        }
 
         self.template.add_resource(
             Function(
                 "LambdaMatomoEventReceiver",
                 FunctionName=matomo_event_receiver_lambda_name,
-                Code=Code(
-                    S3Bucket=Ref(s3_bucket),
-                    S3Key=f"{S3_DEPLOYMENT_PREFIX}{self.artifact_filename_hashed(event_receiver_zip_path)}",
-                ),
+                Code=matomo_event_receiver_code,
                 Handler="lambda.lambda_handler",
                 Environment=Environment(
                     Variables={
                         "S3_BUCKET": Ref(s3_bucket),
+                        "DEAD_LETTER_PREFIX": S3_DEAD_LETTER_PREFIX,
+                        "SKIP_NONE_FIELDS": self.cfg.get("skip_none_fields") or "false",
                         "DELIVERY_STREAM_NAME": event_compressor_name,
-                        "IP_GEOCODING_ENABLED": self.cfg.get("ip_geocoding_enabled"),
-                        "IP_INFO_API_TOKEN": self.cfg.get("ip_info_api_token"),
-                        "USERSTACK_API_TOKEN": self.cfg.get("userstack_api_token"),
-                        "DEVICE_DETECTION_ENABLED": self.cfg.get("device_detection_enabled"),
+                        "ENRICHMENT_MODE": enrichment_mode,
                         "IP_ADDRESS_MASKING_ENABLED": self.cfg.get("ip_address_masking_enabled"),
+                        "METRICS_ENABLED": self.cfg.get("metrics_enabled") or "false",
+                        "SAMPLE_RATES": self.cfg.get("sample_rates") or "",
+                        "SITE_RATE_LIMIT": self.cfg.get("site_rate_limit") or "0",
+                        "BOT_FILTER_MODE": self.cfg.get("bot_filter_mode") or "off",
+                        "BOTS_PREFIX": S3_BOTS_PREFIX,
+                        "BOT_IP_RANGES": self.cfg.get("bot_ip_ranges") or "",
+                        **enrichment_environment,
                     }
                 ),
                 Role=GetAtt("LambdaExecutionRole", "Arn"),
@@ -368,6 +595,29 @@ class CloudformationStack:
             )
         )
 
+        # Event Enricher Lambda, invoked by firehose with batches of raw events
+        if enrichment_mode == "async":
+            self.template.add_resource(
+                Function(
+                    "LambdaMatomoEventEnricher",
+                    FunctionName=self.build_resource_name("matomo-event-enricher"),
+                    Code=matomo_event_receiver_code,
+                    Handler="enricher.lambda_handler",
+                    Environment=Environment(
+                        Variables={
+                            "S3_BUCKET": Ref(s3_bucket),
+                            "DEAD_LETTER_PREFIX": S3_DEAD_LETTER_PREFIX,
+                            "SKIP_NONE_FIELDS": self.cfg.get("skip_none_fields") or "false",
+                            **enrichment_environment,
+                        }
+                    ),
+                    Role=GetAtt("LambdaExecutionRole", "Arn"),
+                    Runtime="python3.7",
+                    # firehose waits up to 5 minutes for a transformation
+                    Timeout=180,
+                )
+            )
+
         # API Gateway
         api_gateway = self.template.add_resource(RestApi("APIGateway", Name=self.build_resource_name("api-gateway")))
 
@@ -388,13 +638,19 @@ class CloudformationStack:
             )
         )
 
-        # API Gateway usage plan
+        # API Gateway usage plan, applies to all sites. Single sites are shaped by the receiver, see SITE_RATE_LIMIT
         self.template.add_resource(
             UsagePlan(
                 "APIGatewayUsagePlan",
                 UsagePlanName="APIGatewayUsagePlan",
-                Quota=QuotaSettings(Limit=50000, Period="MONTH"),
-                Throttle=ThrottleSettings(BurstLimit=500, RateLimit=5000),
+                Quota=QuotaSettings(
+                    Limit=int(self.cfg.get("api_quota_limit") or DEFAULT_API_QUOTA_LIMIT),
+                    Period=self.cfg.get("api_quota_period") or DEFAULT_API_QUOTA_PERIOD,
+                ),
+                Throttle=ThrottleSettings(
+                    BurstLimit=int(self.cfg.get("api_throttle_burst_limit") or DEFAULT_API_THROTTLE_BURST_LIMIT),
+                    RateLimit=int(self.cfg.get("api_throttle_rate_limit") or DEFAULT_API_THROTTLE_RATE_LIMIT),
+                ),
                 ApiStages=[ApiStage(ApiId=Ref(api_gateway), Stage=Ref(api_gateway_stage))],
             )
         )
@@ -563,33 +819,85 @@ class CloudformationStack:
         )
 
         # build enriched table schema
-        table_schema = []
-        table_fields = []
-        for field, data_type in event_schema.schema_to_glue_schema(event_schema.ENRICHED):
-            table_schema.append(Column(Name=field, Type=data_type))
-            table_fields.append(field)
+        # partition keys must not be columns of the table as well
+        partition_columns = ["site_id"] if self.partition_by_site_id else []
+        table_schema = [
+            Column(Name=field, Type=data_type)
+            for field, data_type in event_schema.schema_to_glue_schema(event_schema.ENRICHED)
+            if field not in partition_columns
+        ]
+        table_fields = [
+            field
+            for field in event_schema.schema_to_json_paths(event_schema.ENRICHED)
+            if field not in partition_columns
+        ]
+
+        # partition projection => athena computes the partitions from the table properties, no crawler required
+        partition_keys = [Column(Name="dt", Type="string")]
+        storage_location_template = ["s3://", Ref(s3_bucket), "/", self.enriched_prefix, "dt=${dt}/"]
+        table_parameters = {
+            "projection.enabled": "true",
+            "projection.dt.type": "date",
+            "projection.dt.format": "yyyy-MM-dd",
+            "projection.dt.range": f"{ENRICHED_PARTITION_PROJECTION_START},NOW",
+            "projection.dt.interval": "1",
+            "projection.dt.interval.unit": "DAYS",
+        }
+        if self.delivery_profile.hourly_partitions:
+            partition_keys.append(Column(Name="hour", Type="int"))
+            storage_location_template.append("hour=${hour}/")
+            table_parameters.update(
+                {"projection.hour.type": "integer", "projection.hour.range": "0,23", "projection.hour.digits": "2"}
+            )
+        if self.partition_by_site_id:
+            # injected => queries have to filter by site_id
+            partition_keys.append(Column(Name="site_id", Type="string"))
+            storage_location_template.append("site_id=${site_id}/")
+            table_parameters["projection.site_id.type"] = "injected"
+        table_parameters["storage.location.template"] = Join("", storage_location_template)
 
         # Glue events enriched table
+        if self.enriched_output_format == "parquet":
+            storage_descriptor = StorageDescriptor(
+                Columns=table_schema,
+                InputFormat="org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                OutputFormat="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+                Location=Join("", ["s3://", Ref(s3_bucket), "/", self.enriched_prefix]),
+                Parameters={"classification": "parquet", "typeOfData": "file"},
+                SerdeInfo=SerdeInfo(
+                    Parameters={"serialization.format": "1"},
+                    SerializationLibrary="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
+                ),
+            )
+        else:
+            storage_descriptor = StorageDescriptor(
+                Columns=table_schema,
+                InputFormat="org.apache.hadoop.mapred.TextInputFormat",
+                OutputFormat="org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
+                Location=Join("", ["s3://", Ref(s3_bucket), "/", self.enriched_prefix]),
+                Compressed=True,
+                Parameters={
+                    "classification": "json",
+                    "compressionType": delivery_profiles.JSON_COMPRESSION_TYPES[self.delivery_profile.json_compression],
+                    "typeOfData": "file",
+                },
+                SerdeInfo=SerdeInfo(
+                    Parameters={"paths": ",".join(table_fields)},
+                    SerializationLibrary="org.openx.data.jsonserde.JsonSerDe",
+                ),
+            )
+
         self.template.add_resource(
             Table(
                 "GlueTableEventsEnriched",
                 DatabaseName=Ref(glue_database),
                 CatalogId=glue_catalog_id,
                 TableInput=TableInput(
-                    Name="events_enriched",
+                    Name=GLUE_TABLE_EVENTS_ENRICHED,
                     TableType="EXTERNAL_TABLE",
-                    StorageDescriptor=StorageDescriptor(
-                        Columns=table_schema,
-                        InputFormat="org.apache.hadoop.mapred.TextInputFormat",
-                        OutputFormat="org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
-                        Location=Join("", ["s3://", Ref(s3_bucket), "/", S3_ENRICHED_PREFIX]),
-                        Compressed=True,
-                        Parameters={"classification": "json", "compressionType": "gzip", "typeOfData": "file"},
-                        SerdeInfo=SerdeInfo(
-                            Parameters={"paths": ",".join(table_fields)},
-                            SerializationLibrary="org.openx.data.jsonserde.JsonSerDe",
-                        ),
-                    ),
+                    Parameters=table_parameters,
+                    PartitionKeys=partition_keys,
+                    StorageDescriptor=storage_descriptor,
                 ),
             )
         )
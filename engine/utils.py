@@ -1,4 +1,7 @@
+import os
 import re
+import zipfile
+from fnmatch import fnmatch
 
 RE_CAMELCASE_TO_DASHED = re.compile(r"(?<!^)(?=[A-Z][^A-Z]+)")
 
@@ -16,3 +19,19 @@ def camel_case_to_dashed(camel_str):
     e.g. FooBar => foo-bar
     """
     return RE_CAMELCASE_TO_DASHED.sub("-", camel_str).lower()
+
+
+def trim_zip(zip_path, exclude_patterns):
+    """
+    removes all files matching one of the exclude_patterns (fnmatch) from the zip file
+    :return: (size before, size after) in bytes
+    """
+    size_before = os.path.getsize(zip_path)
+    trimmed_path = f"{zip_path}.trimmed"
+    with zipfile.ZipFile(zip_path) as zip_in, zipfile.ZipFile(trimmed_path, "w", zipfile.ZIP_DEFLATED) as zip_out:
+        for item in zip_in.infolist():
+            if any(fnmatch(item.filename, pattern) for pattern in exclude_patterns):
+                continue
+            zip_out.writestr(item, zip_in.read(item.filename))
+    os.replace(trimmed_path, zip_path)
+    return size_before, os.path.getsize(zip_path)
@@ -1,9 +1,9 @@
+from datetime import datetime
 from pathlib import Path
 
 from botocore.exceptions import ClientError
 from cached_property import cached_property
 from cli import echo
-from engine.stack import S3_ENRICHED_PREFIX
 
 from ..manifest import AbstractManifest
 from . import stack
@@ -28,9 +28,11 @@ class Manifest(AbstractManifest):
 
         echo.h2("run the following example code")
         echo.code("from pyspark.sql.functions import year, month, dayofmonth")
-        echo.code(
-            f"df = spark.read.json('s3a://{self.root_stack.get_output('S3BucketName')}/{S3_ENRICHED_PREFIX}*/*/*/*/*.gz')"
-        )
+        # read only the partition of today, basePath => dt, hour (and site_id) are added as columns
+        base_path = f"s3a://{self.root_stack.get_output('S3BucketName')}/{self.root_stack.enriched_prefix}"
+        events_path = f"{base_path}dt={datetime.utcnow():%Y-%m-%d}/"
+        read_format = "parquet" if self.root_stack.enriched_output_format == "parquet" else "json"
+        echo.code(f"df = spark.read.option('basePath', '{base_path}').{read_format}('{events_path}')")
         echo.code("df.count()")
         echo.code(
             "df.groupBy("
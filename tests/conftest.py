@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the event receiver is deployed as a flat lambda package, its modules import each other without package
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "engine", "matomo_event_receiver")
+)
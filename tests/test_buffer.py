@@ -0,0 +1,126 @@
+import pytest
+from buffer import BoundedBuffer, BufferFull
+from delivery import DeliveryError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Context:
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+class Sink:
+    """
+    flush_func, rejects the records in reject once
+    """
+
+    def __init__(self, reject=()):
+        self.reject = set(reject)
+        self.delivered = []
+
+    def __call__(self, records):
+        rejected = [record for record in records if record in self.reject]
+        self.delivered.extend(record for record in records if record not in self.reject)
+        self.reject.clear()
+        if rejected:
+            raise DeliveryError("rejected", rejected)
+
+
+def buffer(sink, **kwargs):
+    return BoundedBuffer(sink, clock=Clock(), sleep=lambda seconds: None, **kwargs)
+
+
+def test_flush_on_record_count():
+    sink = Sink()
+    records_buffer = buffer(sink, max_records=2)
+
+    records_buffer.add(b"r0")
+    assert sink.delivered == []
+    records_buffer.add(b"r1")
+
+    assert sink.delivered == [b"r0", b"r1"]
+    assert len(records_buffer) == 0
+
+
+def test_rejected_records_are_requeued_first():
+    sink = Sink(reject={b"r1"})
+    records_buffer = buffer(sink, max_records=3)
+    for record in (b"r0", b"r1", b"r2"):
+        records_buffer.add(record)
+
+    assert sink.delivered == [b"r0", b"r2"]
+    assert len(records_buffer) == 1
+
+    records_buffer.add(b"r3")
+    records_buffer.flush(force=True)
+
+    assert sink.delivered == [b"r0", b"r2", b"r1", b"r3"]
+    assert records_buffer.flushed == 4
+
+
+def test_force_flush_raises_after_max_attempts():
+    def fail(records):
+        raise ConnectionError("down")
+
+    records_buffer = buffer(fail)
+    records_buffer.add(b"r0")
+
+    with pytest.raises(ConnectionError):
+        records_buffer.flush(force=True)
+    assert len(records_buffer) == 1
+
+
+def test_spill_keeps_order(tmp_path):
+    sink = Sink()
+    records_buffer = buffer(sink, max_records=4, max_memory_bytes=3, spill_dir=str(tmp_path))
+    records = [f"r{index}".encode() for index in range(3)]
+    for record in records:
+        records_buffer.add(record)
+
+    assert len(list(tmp_path.iterdir())) == 1
+    records_buffer.flush(force=True)
+
+    assert sink.delivered == records
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_buffer_full():
+    records_buffer = buffer(Sink(), max_memory_bytes=4, max_spill_bytes=0)
+    records_buffer.add(b"r0")
+
+    with pytest.raises(BufferFull):
+        records_buffer.add(b"r1r1")
+
+
+def test_deadline_flushes_everything():
+    sink = Sink()
+    context = Context(remaining_ms=5000)
+    records_buffer = buffer(sink, context=context)
+    records_buffer.add(b"r0")
+    assert sink.delivered == []
+
+    context.remaining_ms = 500
+    records_buffer.add(b"r1")
+
+    assert sink.delivered == [b"r0", b"r1"]
+
+
+def test_discard_removes_spill_files(tmp_path):
+    records_buffer = buffer(Sink(), max_records=4, max_memory_bytes=3, spill_dir=str(tmp_path))
+    for record in (b"r0", b"r1", b"r2"):
+        records_buffer.add(record)
+
+    assert records_buffer.discard() == 3
+    assert len(records_buffer) == 0
+    assert records_buffer.pending_bytes == 0
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,49 @@
+from cache import NOT_FOUND, LookupCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_is_evicted():
+    cache = LookupCache(max_entries=2)
+    cache.set("ip", "a", 1)
+    cache.set("ip", "b", 2)
+    assert cache.get("ip", "a") == 1
+
+    cache.set("user_agent", "c", 3)
+
+    assert cache.get("ip", "b") is None
+    assert cache.get("ip", "a") == 1
+    assert cache.get("user_agent", "c") == 3
+    assert cache.evictions["ip"] == 1
+
+
+def test_ttl_per_namespace():
+    clock = Clock()
+    cache = LookupCache(ttl={"ip": 10}, clock=clock)
+    cache.set("ip", "a", 1)
+    cache.set("ip", "b", NOT_FOUND, ttl=1)
+    cache.set("user_agent", "c", 3)
+
+    clock.now = 1
+    assert cache.get("ip", "a") == 1
+    assert cache.get("ip", "b") is None
+    clock.now = 10
+    assert cache.get("ip", "a") is None
+    assert cache.get("user_agent", "c") == 3
+    assert len(cache) == 1
+
+
+def test_stats():
+    cache = LookupCache()
+    cache.set("ip", "a", 1)
+    cache.get("ip", "a")
+    cache.get("ip", "b")
+
+    assert cache.stats("ip") == {"hits": 1, "misses": 1, "evictions": 0, "hit_ratio": 0.5}
+    assert cache.stats("user_agent")["hit_ratio"] is None
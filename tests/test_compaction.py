@@ -0,0 +1,92 @@
+import gzip
+import json
+
+import pytest
+
+from engine import compaction
+
+PARTITION = "events/enriched/dt=2020-04-06/hour=09/"
+EVENTS = [
+    {"site_id": str(index % 3), "event_datetime": "2020-04-06 09:00:00", "action_name": "a"} for index in range(50)
+]
+
+
+def json_lines(events):
+    return b"".join(json.dumps(event).encode("utf-8") + b"\n" for event in events)
+
+
+def hadoop_snappy(data, block_size=1000):
+    """
+    the framing of firehose HADOOP_SNAPPY objects, one chunk per block
+    """
+    pa = pytest.importorskip("pyarrow")
+    codec = pa.Codec("snappy")
+    out = b""
+    for start in range(0, len(data), block_size):
+        end = start + block_size
+        compressed = codec.compress(data[start:end]).to_pybytes()
+        out += len(data[start:end]).to_bytes(4, "big") + len(compressed).to_bytes(4, "big") + compressed
+    return out
+
+
+def compact(storage):
+    compactor = compaction.Compactor(storage, "events/enriched/", grace_seconds=0)
+    return compactor.run()
+
+
+def read_events(storage):
+    events = []
+    for key, _ in storage.list("events/enriched/"):
+        events.extend(json.loads(line) for line in gzip.decompress(storage.read(key)).splitlines())
+    return events
+
+
+@pytest.mark.parametrize(
+    "encode", [gzip.compress, hadoop_snappy, lambda data: data], ids=["gzip", "hadoop-snappy", "uncompressed"]
+)
+def test_compact_round_trip(tmp_path, encode):
+    storage = compaction.LocalStorage(str(tmp_path))
+    storage.write(f"{PARTITION}a.gz", encode(json_lines(EVENTS[:20])))
+    storage.write(f"{PARTITION}b.gz", encode(json_lines(EVENTS[20:])))
+
+    results = compact(storage)
+
+    assert [(result.objects_in, result.objects_out) for result in results] == [(2, 1)]
+    assert read_events(storage) == EVENTS
+
+
+def test_unknown_compression_keeps_sources(tmp_path):
+    storage = compaction.LocalStorage(str(tmp_path))
+    storage.write(f"{PARTITION}a.gz", gzip.compress(json_lines(EVENTS[:20])))
+    storage.write(f"{PARTITION}b.bz2", b"BZh91AY&SY not json")
+    objects = storage.list("events/enriched/")
+
+    assert compact(storage) == []
+    assert storage.list("events/enriched/") == objects
+
+
+def test_migrate_legacy_layout(tmp_path):
+    storage = compaction.LocalStorage(str(tmp_path))
+    storage.write("events/enriched/2020/04/06/09/a.gz", b"a")
+    storage.write(PARTITION + "b.gz", b"b")
+
+    moves = compaction.migrate_legacy_layout(storage, "events/enriched/")
+
+    assert moves == [("events/enriched/2020/04/06/09/a.gz", PARTITION + "a.gz")]
+    assert storage.list("events/enriched/") == [(PARTITION + "a.gz", 1), (PARTITION + "b.gz", 1)]
+    assert compaction.migrate_legacy_layout(storage, "events/enriched/") == []
+
+
+def test_convert_json_to_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    storage = compaction.LocalStorage(str(tmp_path))
+    storage.write(f"{PARTITION}a.gz", gzip.compress(json_lines(EVENTS)))
+    compactor = compaction.Compactor(
+        storage, "events/enriched/", target_prefix="events/enriched-parquet/", parquet=True, grace_seconds=0
+    )
+
+    assert [(result.objects_in, result.objects_out) for result in compactor.run()] == [(1, 1)]
+    assert storage.list("events/enriched/") == []
+    [(key, _)] = storage.list("events/enriched-parquet/")
+    assert key.startswith("events/enriched-parquet/dt=2020-04-06/hour=09/")
+    assert pq.read_table(str(tmp_path / key)).num_rows == len(EVENTS)
@@ -0,0 +1,56 @@
+import pytest
+from delivery import MAX_BATCH_RECORDS, DeliveryError, FirehoseDelivery
+
+
+class FirehoseClient:
+    """
+    put_record_batch of the boto3 firehose client, rejects the records in reject
+    """
+
+    def __init__(self, reject=(), error=None):
+        self.reject = set(reject)
+        self.error = error
+        self.delivered = []
+        self.calls = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        responses = []
+        for record in Records:
+            if record["Data"] in self.reject:
+                responses.append({"ErrorCode": "ServiceUnavailableException", "ErrorMessage": "Slow down."})
+            else:
+                self.delivered.append(record["Data"])
+                responses.append({"RecordId": "id"})
+        return {"FailedPutCount": sum("ErrorCode" in response for response in responses), "RequestResponses": responses}
+
+
+def test_put_batches_by_record_limit():
+    client = FirehoseClient()
+    records = [f"r{index}".encode() for index in range(MAX_BATCH_RECORDS + 1)]
+
+    assert FirehoseDelivery(client, "stream").put(records) == len(records)
+    assert client.calls == 2
+    assert client.delivered == records
+
+
+def test_partial_failure_raises_the_rejected_records_only():
+    client = FirehoseClient(reject={b"r1"})
+
+    with pytest.raises(DeliveryError) as error:
+        FirehoseDelivery(client, "stream").put([b"r0", b"r1", b"r2"])
+
+    assert error.value.records == [b"r1"]
+    assert client.delivered == [b"r0", b"r2"]
+    assert client.calls == 1
+
+
+def test_request_failure_raises_all_records():
+    client = FirehoseClient(error=ConnectionError("down"))
+
+    with pytest.raises(DeliveryError) as error:
+        FirehoseDelivery(client, "stream").put([b"r0", b"r1"])
+
+    assert error.value.records == [b"r0", b"r1"]
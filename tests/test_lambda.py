@@ -0,0 +1,33 @@
+import importlib
+import os
+
+import pytest
+
+# lambda.py creates its firehose client at import
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+lambda_function = importlib.import_module("lambda")
+
+
+def test_parse_requests_query_string():
+    event = {"queryStringParameters": {"idsite": "1", "action_name": "foo"}}
+
+    assert lambda_function.parse_requests(event) == [{"idsite": "1", "action_name": "foo"}]
+    assert lambda_function.parse_requests({"queryStringParameters": None}) == [{}]
+
+
+def test_parse_requests_bulk():
+    event = {
+        "queryStringParameters": {"idsite": "1", "token_auth": "x"},
+        "body": '{"requests": ["?action_name=foo&idsite=2#hash", "?action_name=b%20ar", "action_name=baz"]}',
+    }
+
+    assert lambda_function.parse_requests(event) == [
+        {"idsite": "2", "token_auth": "x", "action_name": "foo"},
+        {"idsite": "1", "token_auth": "x", "action_name": "b ar"},
+        {"idsite": "1", "token_auth": "x"},
+    ]
+
+
+def test_parse_requests_invalid_body():
+    with pytest.raises(Exception):
+        lambda_function.parse_requests({"body": "{}"})
@@ -0,0 +1,11 @@
+from engine import local_server
+
+
+def test_proxy_event_user_agent_header_is_case_insensitive():
+    for name in ("User-Agent", "user-agent", "USER-AGENT"):
+        event = local_server.proxy_event("GET", "/matomo.php", "idsite=1", {name: "Mozilla/5.0"}, None, "1.2.3.4")
+        assert event["requestContext"]["identity"] == {"sourceIp": "1.2.3.4", "userAgent": "Mozilla/5.0"}
+    assert local_server.proxy_event("GET", "/matomo.php", "", {}, None, "1.2.3.4")["requestContext"]["identity"] == {
+        "sourceIp": "1.2.3.4",
+        "userAgent": None,
+    }
@@ -0,0 +1,63 @@
+import pytest
+from sampling import Sampler, parse_sample_rates
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def events(count, site_id="1", event_category=None):
+    return [
+        {"site_id": site_id, "event_category": event_category, "visitor_id": f"{index:016x}"} for index in range(count)
+    ]
+
+
+def test_parse_sample_rates():
+    assert parse_sample_rates(" site_id:3=0.1, event_category:scroll=0.01,") == {
+        "site_id": {"3": 0.1},
+        "event_category": {"scroll": 0.01},
+    }
+    assert parse_sample_rates(None) == {}
+
+
+@pytest.mark.parametrize("spec", ["site_id=0.1", "visitor_id:1=0.1", "site_id:1=2"])
+def test_parse_sample_rates_invalid(spec):
+    with pytest.raises(ValueError):
+        parse_sample_rates(spec)
+
+
+def test_sample_rates():
+    sampler = Sampler(parse_sample_rates("site_id:1=0.1, event_category:scroll=0.5"))
+
+    kept = sampler.sample(events(2000))
+    assert 150 < len(kept) < 250
+    assert {event["sample_rate"] for event in kept} == {0.1}
+    assert len(sampler.sample(events(100, site_id="2"))) == 100
+    # the lowest rate of the matching rules applies
+    assert sampler.sample_rate({"site_id": "2", "event_category": "scroll"}) == 0.5
+
+
+def test_visitors_are_sampled_consistently():
+    sampler = Sampler(parse_sample_rates("site_id:1=0.5"))
+
+    kept = [event["visitor_id"] for event in sampler.sample(events(200))]
+    assert kept == [event["visitor_id"] for event in sampler.sample(events(200))]
+
+
+def test_site_rate_limit():
+    clock = Clock()
+    sampler = Sampler(site_rate_limit=100, clock=clock)
+
+    assert len(sampler.sample(events(100, site_id="2"))) == 100
+    kept = sampler.sample(events(5000))
+    assert len(kept) < 500
+    assert min(event["sample_rate"] for event in kept) < 0.1
+
+    # a heavy hitter of the previous window is shaped from the start of the next one
+    clock.now = 60
+    assert sampler.sample_rate({"site_id": "1"}) < 1
+    assert sampler.sample_rate({"site_id": "2"}) == 1
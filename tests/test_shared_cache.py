@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import enrichment
+import pytest
+from cache import NOT_FOUND, LookupCache
+from shared_cache import LocalSharedCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1586164025.0
+
+    def __call__(self):
+        return self.now
+
+
+class RemoteBackend:
+    name = "remote"
+    remote = True
+
+    def __init__(self, results):
+        self.results = results
+        self.lookups = []
+
+    def lookup(self, key):
+        self.lookups.append(key)
+        return self.results.get(key)
+
+
+@pytest.fixture
+def shared_cache(monkeypatch):
+    cache = LocalSharedCache(ttl={"ip": 100}, negative_ttl=10, clock=Clock())
+    monkeypatch.setattr(enrichment, "SHARED_CACHE", cache)
+    monkeypatch.setattr(enrichment, "LOOKUP_CACHE", LookupCache(ttl={"ip": 100}))
+    monkeypatch.setattr(enrichment, "LOOKUP_BACKENDS", {})
+    monkeypatch.setattr(enrichment, "_EXECUTOR", ThreadPoolExecutor(max_workers=2))
+    return cache
+
+
+def lookup(ips):
+    results = enrichment.lookup({"ip": set(ips)})
+    # waits for the write behind
+    enrichment._EXECUTOR.shutdown(wait=True)
+    enrichment._EXECUTOR = ThreadPoolExecutor(max_workers=2)
+    return results["ip"]
+
+
+def test_ttl_expiry():
+    clock = Clock()
+    cache = LocalSharedCache(ttl={"ip": 100}, negative_ttl=10, clock=clock)
+    cache.put_many({("ip", "1.2.3.4"): {"country": "AT"}, ("ip", "10.0.0.1"): NOT_FOUND})
+
+    assert cache.get_many([("ip", "1.2.3.4"), ("ip", "10.0.0.1")]) == {
+        ("ip", "1.2.3.4"): {"country": "AT"},
+        ("ip", "10.0.0.1"): NOT_FOUND,
+    }
+    clock.now += 10
+    assert cache.get_many([("ip", "1.2.3.4"), ("ip", "10.0.0.1")]) == {("ip", "1.2.3.4"): {"country": "AT"}}
+    clock.now += 90
+    assert cache.get_many([("ip", "1.2.3.4")]) == {}
+
+
+def test_write_behind(shared_cache):
+    backend = enrichment.LOOKUP_BACKENDS["ip"] = RemoteBackend({"1.2.3.4": {"country": "AT"}})
+
+    assert lookup(["1.2.3.4", "10.0.0.1"]) == {"1.2.3.4": {"country": "AT"}, "10.0.0.1": None}
+    assert sorted(backend.lookups) == ["1.2.3.4", "10.0.0.1"]
+    assert shared_cache.get_many([("ip", "1.2.3.4"), ("ip", "10.0.0.1")]) == {
+        ("ip", "1.2.3.4"): {"country": "AT"},
+        ("ip", "10.0.0.1"): NOT_FOUND,
+    }
+
+
+def test_read_through(shared_cache):
+    shared_cache.put_many({("ip", "1.2.3.4"): {"country": "AT"}, ("ip", "10.0.0.1"): NOT_FOUND})
+    backend = enrichment.LOOKUP_BACKENDS["ip"] = RemoteBackend({})
+
+    assert lookup(["1.2.3.4", "10.0.0.1"]) == {"1.2.3.4": {"country": "AT"}, "10.0.0.1": None}
+    assert backend.lookups == []
+    # copied to the per container cache => no further shared cache request
+    requests = shared_cache.requests
+    assert lookup(["1.2.3.4", "10.0.0.1"]) == {"1.2.3.4": {"country": "AT"}, "10.0.0.1": None}
+    assert shared_cache.requests == requests
+
+
+def test_negative_entries_expire(shared_cache):
+    shared_cache.put_many({("ip", "10.0.0.1"): NOT_FOUND})
+    shared_cache.clock.now += 10
+    backend = enrichment.LOOKUP_BACKENDS["ip"] = RemoteBackend({"10.0.0.1": {"country": "AT"}})
+
+    assert lookup(["10.0.0.1"]) == {"10.0.0.1": {"country": "AT"}}
+    assert backend.lookups == ["10.0.0.1"]
@@ -0,0 +1,41 @@
+from datetime import datetime, timezone
+
+import pytest
+import timestamps
+
+UTC = datetime(2020, 4, 6, 9, 7, 5, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "1586164025",
+        "1586164025000",
+        "1586164025.0",
+        "2020-04-06T09:07:05Z",
+        "2020-04-06 11:07:05+02:00",
+        "06/Apr/2020:09:07:05 +0000",
+        "06/Apr/2020:05:07:05 -0400",
+        "Mon, 06 Apr 2020 09:07:05 GMT",
+    ],
+)
+def test_parse(value):
+    assert timestamps.parse(value) == UTC
+
+
+def test_parse_after_format_switch():
+    # the last successful parser is tried first, other formats still parse
+    assert timestamps.parse("06/Apr/2020:09:07:05 +0000") == UTC
+    assert timestamps.parse("1586164025") == UTC
+    assert timestamps.parse("2020-04-06T09:07:05Z") == UTC
+    assert timestamps.parse("20200406") == datetime.fromtimestamp(20200406, timezone.utc)
+
+
+def test_parse_request_time_invalid():
+    with pytest.raises(ValueError):
+        timestamps.parse_request_time("2020-04-06T09:07:05+00:00")
+
+
+def test_format_utc():
+    assert timestamps.format_utc(UTC) == "2020-04-06 09:07:05"
+    assert timestamps.format_utc(timestamps.parse("2020-04-06 11:07:05+02:00")) == "2020-04-06 09:07:05"
@@ -0,0 +1,50 @@
+from validator import validate_event
+
+EVENT = {"site_id": "1", "event_datetime": "2020-04-06 09:07:05"}
+
+
+def test_coercion():
+    validated, errors = validate_event(
+        dict(EVENT, site_id=1, random_part="123", supports_cookie="1", event_value_numeric=3, unknown="x")
+    )
+
+    assert errors == {}
+    assert validated["site_id"] == "1"
+    assert validated["random_part"] == 123
+    assert validated["supports_cookie"] is True
+    assert validated["event_value_numeric"] == 3.0
+    assert "unknown" not in validated
+    assert list(validated)[:2] == ["site_id", "random_part"]
+
+
+def test_skip_none():
+    validated, errors = validate_event(dict(EVENT), skip_none=True)
+
+    assert errors == {}
+    assert validated == EVENT
+
+
+def test_invalid_optional_fields_are_nulled():
+    validated, errors = validate_event(
+        dict(EVENT, random_part=2 ** 31, event_value_numeric=float("nan"), geo_info="AT", supports_cookie="yes")
+    )
+
+    assert errors == {}
+    assert validated["random_part"] is None
+    assert validated["event_value_numeric"] is None
+    assert validated["geo_info"] is None
+    assert validated["supports_cookie"] is None
+
+
+def test_invalid_required_fields():
+    _, errors = validate_event(dict(EVENT, site_id=["1"], event_datetime="06/Apr/2020:09:07:05 +0000"))
+
+    assert set(errors) == {"site_id", "event_datetime"}
+    assert validate_event([EVENT])[1] == {"": "expected struct, got list"}
+
+
+def test_site_id_is_numeric():
+    # site_id is the value of the site_id partitions
+    for site_id in ("1/dt=2020-01-01", "../1", "１", ""):
+        assert set(validate_event(dict(EVENT, site_id=site_id))[1]) == {"site_id"}
+    assert validate_event(dict(EVENT, site_id=12))[0]["site_id"] == "12"